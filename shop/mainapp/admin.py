@@ -56,3 +56,4 @@ admin.site.register(CartProduct)
 admin.site.register(Cart)
 admin.site.register(Customer)
 admin.site.register(Order)
+admin.site.register(OutgoingEmail)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class MainappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'mainapp'
+
+    def ready(self):
+        # подключение обработчиков сигналов (счетчики категорий, подсчет SQL-запросов для метрик и т.п.)
+        from . import metrics, signals  # noqa: F401
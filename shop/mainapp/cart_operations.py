@@ -0,0 +1,94 @@
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Q
+
+from .models import CartProduct, CatalogItem
+from .product_types import registry as product_types
+from .utils import add_cart_line, change_cart_totals, remove_cart_line, set_cart_line_qty
+
+# пакетное изменение корзины: операции применяются по порядку в одной транзакции,
+# при ошибке в любой из них корзина не меняется
+ADD, REMOVE, SET_QTY = 'add', 'remove', 'set_qty'
+OPERATIONS = (ADD, REMOVE, SET_QTY)
+MAX_OPERATIONS = 100
+
+
+def parse_operations(data):
+    # [{"op": "add", "ct_model": "washer", "slug": "...", "qty": 2}, ...] -> [(op, (ct_model, slug), qty)]
+    operations = data.get('operations') if isinstance(data, dict) else None
+    if not isinstance(operations, list) or not operations:
+        raise ValidationError('Ожидается непустой список operations')
+    if len(operations) > MAX_OPERATIONS:
+        raise ValidationError('Не больше {} операций за запрос'.format(MAX_OPERATIONS))
+    result = []
+    for number, operation in enumerate(operations, 1):
+        if not isinstance(operation, dict) or operation.get('op') not in OPERATIONS:
+            raise ValidationError('Операция {}: op должен быть одним из {}'.format(number, ', '.join(OPERATIONS)))
+        key = (operation.get('ct_model'), operation.get('slug'))
+        if not all(isinstance(value, str) and value for value in key):
+            raise ValidationError('Операция {}: не указан товар (ct_model, slug)'.format(number))
+        qty = operation.get('qty', 1)
+        if operation['op'] != REMOVE and (not isinstance(qty, int) or isinstance(qty, bool) or qty < 1):
+            raise ValidationError('Операция {}: qty должно быть целым числом больше 0'.format(number))
+        result.append((operation['op'], key, qty))
+    return result
+
+
+def resolve_items(keys):
+    # карточки всех товаров пакета одним запросом к каталогу (условие по slug для каждого типа)
+    slugs = {}
+    for ct_model, slug in keys:
+        slugs.setdefault(ct_model, set()).add(slug)
+    condition, content_types = Q(), {}
+    for ct_model, type_slugs in slugs.items():
+        product_type = product_types.get(ct_model)
+        if product_type is None:
+            raise ValidationError('Неизвестный тип товара: {}'.format(ct_model))
+        content_types[product_type.content_type_id] = ct_model
+        condition |= Q(content_type_id=product_type.content_type_id, slug__in=type_slugs)
+    items = {(content_types[item.content_type_id], item.slug): item for item in CatalogItem.objects.filter(condition)}
+    missing = sorted('{}/{}'.format(*key) for key in set(keys) - set(items))
+    if missing:
+        raise ValidationError('Товары не найдены: {}'.format(', '.join(missing)))
+    return items
+
+
+def apply_operations(cart, operations, items):
+    # каждая операция - один оператор над строкой корзины (без блокировки корзины на время пакета),
+    # итоги корзины меняются одним UPDATE на сумму изменений; items - результат resolve_items
+    price_delta, products_delta = 0, 0
+    # пакет откатывается целиком, поэтому внутри транзакции вызывающего кода точка сохранения не нужна
+    with transaction.atomic(savepoint=False):
+        for op, key, qty in operations:
+            item = items[key]
+            if op == ADD:
+                # товар, уже лежащий в корзине, добавляется к количеству в его строке
+                delta = add_cart_line(cart, item, qty)
+            elif op == REMOVE:
+                delta = remove_cart_line(cart, item)
+            else:
+                delta = set_cart_line_qty(cart, item, qty)
+                if delta is None:
+                    raise ValidationError('Товара {}/{} нет в корзине'.format(*key))
+            price_delta += delta[0]
+            products_delta += delta[1]
+        if price_delta or products_delta:
+            change_cart_totals(cart, price_delta, products_delta)
+    return list(CartProduct.objects.select_related('catalog_item').filter(cart=cart).order_by('pk'))
+
+
+def get_summary(cart, lines):
+    return {
+        'total_products': cart.total_products,
+        'final_price': str(cart.final_price),
+        'items': [
+            {
+                'ct_model': line.catalog_item.get_model_name(),
+                'slug': line.catalog_item.slug,
+                'title': line.catalog_item.title,
+                'qty': line.qty,
+                'final_price': str(line.final_price),
+            }
+            for line in lines if line.catalog_item is not None
+        ],
+    }
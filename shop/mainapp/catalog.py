@@ -0,0 +1,84 @@
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+
+from .models import CartProduct, CatalogItem
+
+# поля товара, копируемые в карточку каталога
+CARD_FIELDS = ('category', 'title', 'slug', 'price', 'image')
+BATCH_SIZE = 2000
+
+
+def get_card_values(product):
+    return dict(
+        category_id=product.category_id, title=product.title, slug=product.slug, price=product.price,
+        image=product.image.name
+    )
+
+
+def sync_product(product):
+    # обычно один UPDATE по уникальному ключу; INSERT - только для нового товара
+    content_type = ContentType.objects.get_for_model(product)
+    values = get_card_values(product)
+    if not CatalogItem.objects.filter(content_type=content_type, object_id=product.pk).update(**values):
+        CatalogItem.objects.create(content_type=content_type, object_id=product.pk, **values)
+
+
+def sync_products(products):
+    # карточки пачки товаров одного типа: существующие обновляются, недостающие создаются
+    products = list(products)
+    if not products:
+        return
+    content_type = ContentType.objects.get_for_model(products[0])
+    with transaction.atomic():
+        items = {
+            item.object_id: item
+            for item in CatalogItem.objects.filter(content_type=content_type, object_id__in=[p.pk for p in products])
+        }
+        changed, missing = [], []
+        for product in products:
+            values = get_card_values(product)
+            item = items.get(product.pk)
+            if item is None:
+                missing.append(CatalogItem(content_type=content_type, object_id=product.pk, **values))
+                continue
+            for name, value in values.items():
+                setattr(item, name, value)
+            changed.append(item)
+        CatalogItem.objects.bulk_update(changed, CARD_FIELDS, batch_size=BATCH_SIZE)
+        CatalogItem.objects.bulk_create(missing, batch_size=BATCH_SIZE)
+
+
+def remove_product(product):
+    content_type = ContentType.objects.get_for_model(product)
+    CatalogItem.objects.filter(content_type=content_type, object_id=product.pk).delete()
+
+
+def link_cart_products():
+    # строки корзин без карточки (созданные до каталога) получают ее одним UPDATE
+    return CartProduct.objects.filter(catalog_item__isnull=True).update(catalog_item=Subquery(
+        CatalogItem.objects.filter(
+            content_type=OuterRef('content_type'), object_id=OuterRef('object_id')
+        ).values('pk')[:1]
+    ))
+
+
+def rebuild_catalog(models, chunk_size=BATCH_SIZE):
+    # сверка каталога с таблицами товаров: карточки обновляются на месте (ссылки строк корзин
+    # сохраняются), карточки удаленных товаров удаляются
+    total = 0
+    for model in models:
+        content_type = ContentType.objects.get_for_model(model)
+        CatalogItem.objects.filter(content_type=content_type).exclude(
+            object_id__in=model._base_manager.values('pk')
+        ).delete()
+        chunk = []
+        for product in model._base_manager.order_by('pk').iterator(chunk_size=chunk_size):
+            chunk.append(product)
+            if len(chunk) == chunk_size:
+                sync_products(chunk)
+                total, chunk = total + len(chunk), []
+        sync_products(chunk)
+        total += len(chunk)
+    link_cart_products()
+    return total
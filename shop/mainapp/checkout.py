@@ -0,0 +1,52 @@
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+
+from . import outbox
+from .models import Cart, Customer, Order
+
+# оформление заказа: корзина помечается оформленной условным UPDATE (он же держит блокировку ее строки
+# до конца короткой транзакции), заказ создается одним INSERT сразу со ссылкой на корзину.
+# Повтор запроса - тот же ключ идемпотентности или уже оформленная корзина - возвращает прежний заказ
+ORDER_FIELDS = ('phone', 'buying_type', 'address', 'order_date', 'comment')
+
+
+def find_order(customer, cart=None, idempotency_key=None):
+    condition = Q()
+    if idempotency_key:
+        condition |= Q(idempotency_key=idempotency_key)
+    if cart is not None:
+        condition |= Q(cart=cart)
+    if not condition:
+        return None
+    return Order.objects.filter(condition, customer=customer).order_by('pk').first()
+
+
+def place_order(customer, cart, user, data, idempotency_key=None):
+    # (заказ, создан ли он этим вызовом); заказ None - оформлять нечего
+    if cart is not None:
+        try:
+            with transaction.atomic():
+                if Cart.objects.filter(pk=cart.pk, in_order=False).update(in_order=True):
+                    order = Order.objects.create(
+                        customer=customer, cart=cart, first_name=user.first_name, last_name=user.last_name,
+                        idempotency_key=idempotency_key or None, **{name: data[name] for name in ORDER_FIELDS}
+                    )
+                    Customer.orders.through.objects.create(customer_id=customer.pk, order_id=order.pk)
+                    if user.email:
+                        outbox.enqueue(
+                            'Заказ №{} принят'.format(order.pk),
+                            'Здравствуйте, {} {}!\nВаш заказ №{} на сумму {} принят, дата получения: {}.\n'
+                            'Администрация Shop'.format(
+                                order.first_name, order.last_name, order.pk, cart.final_price, order.order_date
+                            ),
+                            [user.email]
+                        )
+                    cart.in_order = True
+                    return order, True
+        except IntegrityError:
+            # ключ уже использован для другого заказа этого покупателя - изменения откатились
+            order = find_order(customer, idempotency_key=idempotency_key)
+            if order is None:
+                raise
+            return order, False
+    return find_order(customer, cart, idempotency_key), False
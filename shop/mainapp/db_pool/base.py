@@ -0,0 +1,60 @@
+from functools import partial
+
+from django.db.backends.base.base import NO_DB_ALIAS
+from django.db.backends.postgresql import base, creation
+from django.utils.asyncio import async_unsafe
+
+from .pool import close_pools, get_pool
+
+# PostgreSQL с пулом соединений (ENGINE = 'mainapp.db_pool'): закрытие соединения в Django
+# (конец запроса при CONN_MAX_AGE = 0, close_old_connections) возвращает его в пул процесса,
+# новое соединение берется из пула. Настройки пула - DATABASES[...]['POOL']
+POOL_DEFAULTS = {'MAX_SIZE': 20, 'MAX_AGE': 30 * 60, 'CHECK_INTERVAL': 30, 'TIMEOUT': 10, 'RESET': 'DISCARD ALL'}
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+    # простаивающие соединения пула с тестовой БД мешают ее удалению и копированию (CREATE DATABASE ... TEMPLATE)
+
+    def _destroy_test_db(self, test_database_name, verbosity):
+        close_pools()
+        super()._destroy_test_db(test_database_name, verbosity)
+
+    def _clone_test_db(self, suffix, verbosity, keepdb=False):
+        close_pools()
+        super()._clone_test_db(suffix, verbosity, keepdb)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = None
+
+    def get_pool(self, conn_params):
+        # служебные соединения без БД (создание и удаление тестовой БД) в пул не попадают
+        if self.alias == NO_DB_ALIAS:
+            return None
+        options = {**POOL_DEFAULTS, **self.settings_dict.get('POOL', {})}
+        # тестовый запуск меняет NAME: у соединений с другой БД (или под другим пользователем) свой пул
+        return get_pool(repr(sorted(conn_params.items())), **{key.lower(): value for key, value in options.items()})
+
+    @async_unsafe
+    def get_new_connection(self, conn_params):
+        self.pool = self.get_pool(conn_params)
+        if self.pool is None:
+            return super().get_new_connection(conn_params)
+        connection = self.pool.acquire(partial(super().get_new_connection, conn_params))
+        # у соединения из пула уровень изоляции уже установлен при открытии
+        self.isolation_level = self.settings_dict['OPTIONS'].get('isolation_level', connection.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.pool is None:
+            return super()._close()
+        with self.wrap_database_errors:
+            if self.in_atomic_block:
+                # после закрытия внутри atomic соединение остается у обертки до выхода из блока - в пул не возвращается
+                self.pool.discard(self.connection)
+            else:
+                self.pool.release(self.connection)
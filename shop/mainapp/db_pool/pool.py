@@ -0,0 +1,208 @@
+import collections
+import os
+import threading
+import time
+
+from psycopg2 import OperationalError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+# пул соединений рабочего процесса: DatabaseWrapper потока берет соединение в начале запроса
+# и возвращает его в конце (CONN_MAX_AGE = 0), поэтому соединений столько, сколько одновременных
+# запросов, но не больше max_size. Отдается последнее возвращенное соединение (LIFO): редко
+# используемые дольше простаивают и закрываются по max_age/проверке, а не держат открытыми все
+
+
+# параметры сеанса, которые Django задает при подключении (init_connection_state)
+RESTORED_PARAMETERS = ('TimeZone', 'client_encoding')
+
+
+class PoolTimeout(OperationalError):
+    pass
+
+
+class ConnectionPool:
+
+    def __init__(self, max_size=20, max_age=30 * 60, check_interval=30, timeout=10, reset='DISCARD ALL'):
+        # max_age - время жизни соединения, с (None - без ограничения); check_interval - простой,
+        # после которого соединение перед выдачей проверяется запросом SELECT 1 (0 - всегда);
+        # timeout - ожидание свободного места в пуле, с; reset - запрос, сбрасывающий состояние сеанса
+        # при возврате (None - не сбрасывать)
+        self.max_size = max_size
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self.reset = reset
+        self.condition = threading.Condition()
+        # очередь ожидающих потоков: свободное соединение получает первый, а не только что вернувший его
+        self.waiters = collections.deque()
+        # простаивающие соединения: (соединение, время открытия, время возврата)
+        self.idle = []
+        # время открытия выданных соединений по id соединения
+        self.opened = {}
+        # открытых соединений: простаивающих, выданных и открываемых сейчас
+        self.size = 0
+        self.stats = {'connects': 0, 'reuses': 0, 'discards': 0, 'waits': 0, 'timeouts': 0}
+
+    def acquire(self, connect):
+        # connect - функция, открывающая новое соединение, если свободного нет
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self.condition:
+                if self.waiters or self._full():
+                    self._wait(deadline)
+                if self.idle:
+                    connection, opened, returned = self.idle.pop()
+                else:
+                    connection = None
+                    # место занимается до подключения: подключение идет без блокировки пула
+                    self.size += 1
+            if connection is None:
+                return self._open(connect)
+            # проверка - вне блокировки: SELECT 1 не задерживает другие потоки
+            if self._usable(connection, opened, returned):
+                with self.condition:
+                    self.opened[id(connection)] = opened
+                    self.stats['reuses'] += 1
+                return connection
+            self._discard(connection)
+
+    def _full(self):
+        return not self.idle and self.size >= self.max_size
+
+    def _wait(self, deadline):
+        ticket = object()
+        self.waiters.append(ticket)
+        self.stats['waits'] += 1
+        try:
+            while self.waiters[0] is not ticket or self._full():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    raise PoolTimeout('Нет свободных соединений в пуле ({} шт.) за {} с'.format(
+                        self.max_size, self.timeout
+                    ))
+                self.condition.wait(remaining)
+        finally:
+            self.waiters.remove(ticket)
+            self.condition.notify_all()
+
+    def release(self, connection):
+        with self.condition:
+            opened = self.opened.pop(id(connection), None)
+        if opened is None:
+            # соединение не из этого пула (например, пул создан заново после fork)
+            return self._close(connection)
+        if not connection.closed and connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            # незавершенная транзакция (ошибка, закрытие внутри atomic) не переходит к следующему запросу
+            try:
+                connection.rollback()
+            except Exception:
+                pass
+        if connection.closed or connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            return self._discard(connection)
+        if self._expired(opened) or not self._reset(connection):
+            return self._discard(connection)
+        with self.condition:
+            self.idle.append((connection, opened, time.monotonic()))
+            self.condition.notify_all()
+
+    def discard(self, connection):
+        # выданное соединение закрывается, не возвращаясь в пул
+        with self.condition:
+            self.opened.pop(id(connection), None)
+        self._discard(connection)
+
+    def close_idle(self):
+        with self.condition:
+            idle, self.idle = self.idle, []
+        for connection, opened, returned in idle:
+            self._discard(connection)
+
+    def _open(self, connect):
+        try:
+            connection = connect()
+        except BaseException:
+            self._free_slot()
+            raise
+        with self.condition:
+            self.opened[id(connection)] = time.monotonic()
+            self.stats['connects'] += 1
+        return connection
+
+    def _expired(self, opened):
+        return self.max_age is not None and time.monotonic() - opened >= self.max_age
+
+    def _reset(self, connection):
+        # состояние сеанса прежнего запроса (SET, временные таблицы, advisory-блокировки, LISTEN)
+        # не переходит к следующему. DISCARD ALL сбрасывает и параметры, заданные при подключении
+        # (часовой пояс Django, кодировка): они восстанавливаются, чтобы не повторять SET при каждой выдаче
+        if self.reset is None:
+            return True
+        restore = {name: connection.get_parameter_status(name) for name in RESTORED_PARAMETERS}
+        try:
+            # DISCARD ALL не выполняется внутри транзакции; autocommit Django все равно задает при выдаче
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(self.reset)
+                for name, value in restore.items():
+                    if value is not None and connection.get_parameter_status(name) != value:
+                        cursor.execute('SELECT set_config(%s, %s, false)', [name, value])
+        except Exception:
+            return False
+        return True
+
+    def _usable(self, connection, opened, returned):
+        if connection.closed or self._expired(opened):
+            return False
+        if time.monotonic() - returned < self.check_interval:
+            return True
+        # соединение могло быть закрыто сервером (перезапуск, idle_session_timeout, pg_terminate_backend)
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+        except Exception:
+            return False
+        return True
+
+    def _discard(self, connection):
+        self._close(connection)
+        with self.condition:
+            self.stats['discards'] += 1
+        self._free_slot()
+
+    def _free_slot(self):
+        with self.condition:
+            self.size -= 1
+            self.condition.notify_all()
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(key, **options):
+    # пулы - свои у каждого процесса: соединения родителя после fork не используются и не закрываются
+    # (закрытие в дочернем процессе оборвало бы их и у родителя)
+    key = (os.getpid(), key)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool(**options)
+    return pool
+
+
+def close_pools():
+    # закрывает простаивающие соединения всех пулов процесса (выданные закроются при возврате)
+    with _pools_lock:
+        pools = [pool for (pid, key), pool in _pools.items() if pid == os.getpid()]
+    for pool in pools:
+        pool.close_idle()
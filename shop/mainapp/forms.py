@@ -18,6 +18,7 @@ class OrderForm(forms.ModelForm):
         self.fields['address'].label = 'Адрес доставки'
 
     order_date = forms.DateField(widget=forms.TextInput(attrs={'type': 'date'}))
+    idempotency_key = forms.CharField(max_length=64, required=False, widget=forms.HiddenInput)
 
     def clean_order_date(self):
         order_date = self.cleaned_data['order_date']
@@ -34,7 +35,7 @@ class OrderForm(forms.ModelForm):
     class Meta:
         model = Order
         fields = (
-            'phone', 'buying_type', 'address', 'order_date', 'comment'
+            'phone', 'buying_type', 'address', 'order_date', 'comment', 'idempotency_key'
             # 'first_name', 'last_name', 'phone', 'address', 'buying_type', 'order_date', 'comment'
         )
 
@@ -0,0 +1,143 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import sys
+import zlib
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# журнал приложения (settings.LOGGING): в потоке запроса запись только кладется в очередь,
+# JSON собирается и пишется в файл потоком QueueListener
+
+# id текущего запроса (RequestIdMiddleware); контекст копируется в потоки sync_to_async
+request_id = ContextVar('request_id', default=None)
+
+# атрибуты, которые есть у любой записи; остальные (переданные через extra) попадают в JSON отдельными полями
+RECORD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'request_id'}
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+            'process': record.process,
+        }
+        data.update((key, value) for key, value in vars(record).items() if key not in RECORD_ATTRS)
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class RequestIdFilter(logging.Filter):
+
+    def filter(self, record):
+        record.request_id = request_id.get()
+        if record.request_id is None:
+            # django.request пишет ответ (log_response) уже после выхода из RequestIdMiddleware,
+            # когда id сброшен, но передает сам запрос в extra
+            record.request_id = getattr(getattr(record, 'request', None), 'id', None)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    # rates - {логгер: доля}: записи этих логгеров (и дочерних) уровня INFO и ниже пропускаются
+    # в указанной доле. Решение принимается по id запроса, поэтому записи одного запроса
+    # попадают в журнал все вместе или не попадают совсем. Предупреждения и ошибки не отбрасываются
+
+    def __init__(self, rates=None, level=logging.INFO):
+        super().__init__()
+        self.rates = sorted((rates or {}).items(), key=lambda item: -len(item[0]))
+        self.level = logging._checkLevel(level)
+        self.skipped = 0
+
+    def filter(self, record):
+        if record.levelno > self.level:
+            return True
+        for name, rate in self.rates:
+            if record.name == name or record.name.startswith(name + '.'):
+                break
+        else:
+            return True
+        key = getattr(record, 'request_id', None) or '{}:{}'.format(record.created, record.thread)
+        if zlib.crc32(key.encode()) % 10000 < rate * 10000:
+            return True
+        self.skipped += 1
+        return False
+
+
+class BackgroundHandler(QueueHandler):
+    # записи уходят в ограниченную очередь, запись в файл (с ротацией) или в stderr - в отдельном потоке.
+    # В имени файла можно указать {pid}: у каждого рабочего процесса будет свой файл и своя ротация.
+    # При переполнении очереди записи отбрасываются (счетчик dropped), а не задерживают запрос
+
+    def __init__(self, filename=None, max_bytes=10 * 1024 * 1024, backup_count=5, queue_size=10000):
+        super().__init__(queue.Queue(queue_size))
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.dropped = 0
+        self.listener = None
+        self._pid = None
+        atexit.register(self.stop)
+
+    def create_target(self):
+        if not self.filename:
+            target = logging.StreamHandler(sys.stderr)
+        else:
+            target = RotatingFileHandler(
+                self.filename.format(pid=os.getpid()), maxBytes=self.max_bytes, backupCount=self.backup_count,
+                encoding='utf-8', delay=True
+            )
+        target.setFormatter(self.formatter)
+        return target
+
+    def start(self):
+        # поток записи запускается при первой записи в процессе: после fork (рабочие процессы
+        # сервера) потоки родителя не работают, поэтому у дочернего процесса свои очередь и поток
+        self.queue = queue.Queue(self.queue.maxsize)
+        self.listener = QueueListener(self.queue, self.create_target())
+        self.listener.start()
+        self._pid = os.getpid()
+
+    def stop(self):
+        if self.listener is not None and self._pid == os.getpid():
+            self.listener.stop()
+            for target in self.listener.handlers:
+                target.close()
+        self.listener = None
+
+    def prepare(self, record):
+        # в потоке запроса фиксируется только текст сообщения (аргументы могут измениться позже)
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self.acquire()
+            try:
+                if self._pid != os.getpid():
+                    self.start()
+            finally:
+                self.release()
+        super().emit(record)
+
+    def close(self):
+        self.stop()
+        super().close()
@@ -0,0 +1,127 @@
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections, transaction
+from django.utils import timezone
+
+from mainapp import checkout
+from mainapp.models import Cart, CatalogItem, Customer, Order
+from mainapp.utils import add_cart_line, change_cart_totals
+
+BENCH_USERNAME = 'bench-checkout-{}'
+
+
+def legacy_place_order(customer, cart, user, data, idempotency_key=None):
+    # оформление в прежнем виде (MakeOrderView до ключей идемпотентности) - для сравнения
+    with transaction.atomic():
+        customer = Customer.objects.get(user=user)
+        order = Order(customer=customer, first_name=user.first_name, last_name=user.last_name,
+                      **{name: data[name] for name in checkout.ORDER_FIELDS})
+        order.save()
+        cart.in_order = True
+        cart.save()
+        order.cart = cart
+        order.save()
+        customer.orders.add(order)
+    return order, True
+
+
+class Command(BaseCommand):
+    help = 'Замеряет оформление заказов из нескольких потоков: заказов в секунду, длительность транзакции ' \
+           '(столько держится блокировка строки корзины) и число SQL-запросов. С --double-submit каждая ' \
+           'корзина оформляется дважды одновременно с одним ключом; заказ должен получиться один'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=200)
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--lines', type=int, default=3, help='товаров в каждой корзине')
+        parser.add_argument('--double-submit', action='store_true')
+        parser.add_argument('--legacy', action='store_true', help='сравнить с прежним оформлением')
+
+    def handle(self, *args, **options):
+        items = list(CatalogItem.objects.order_by('pk')[:options['lines']])
+        if not items:
+            raise CommandError('В каталоге нет товаров')
+        modes = [('checkout', checkout.place_order)]
+        if options['legacy']:
+            modes.insert(0, ('legacy', legacy_place_order))
+        for name, place_order in modes:
+            shoppers = self.create_shoppers(items, options['orders'])
+            try:
+                self.run(name, place_order, shoppers, options)
+            finally:
+                get_user_model().objects.filter(pk__in=[user.pk for user, customer, cart in shoppers]).delete()
+
+    def create_shoppers(self, items, count):
+        shoppers = []
+        with transaction.atomic():
+            for n in range(count):
+                user, _ = get_user_model().objects.get_or_create(username=BENCH_USERNAME.format(n))
+                customer = Customer.objects.create(user=user)
+                cart = Cart.objects.create(owner=customer)
+                price, products = 0, 0
+                for item in items:
+                    delta = add_cart_line(cart, item)
+                    price, products = price + delta[0], products + delta[1]
+                change_cart_totals(cart, price, products)
+                shoppers.append((user, customer, cart))
+        return shoppers
+
+    def run(self, name, place_order, shoppers, options):
+        data = {'phone': '+375(44)1112233', 'address': 'Минск', 'buying_type': 'self', 'comment': '',
+                'order_date': timezone.now().date()}
+        submits = 2 if options['double_submit'] else 1
+        tasks = [(user, customer, cart, 'bench-{}'.format(cart.pk)) for user, customer, cart in shoppers] * submits
+        timings, statements, rejected = [], [], []
+        lock = threading.Lock()
+
+        def submit(task):
+            user, customer, cart, key = task
+            # у каждого потока свои копии объектов: корзина меняется при оформлении
+            cart = Cart.objects.get(pk=cart.pk)
+            queries = []
+
+            def count_queries(execute, sql, params, many, context):
+                queries.append(sql)
+                return execute(sql, params, many, context)
+
+            try:
+                with connection.execute_wrapper(count_queries):
+                    started = time.perf_counter()
+                    order, created = place_order(customer, cart, user, data, key)
+                    elapsed = time.perf_counter() - started
+            except OperationalError:
+                # SQLite: конкурентная запись не дождалась блокировки
+                with lock:
+                    rejected.append(key)
+                return
+            finally:
+                connections.close_all()
+            if created:
+                with lock:
+                    timings.append(elapsed * 1000)
+                    statements.append(len(queries))
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(options['threads']) as pool:
+            list(pool.map(submit, tasks))
+        elapsed = time.perf_counter() - started
+
+        orders = Order.objects.filter(customer__in=[customer for user, customer, cart in shoppers])
+        duplicates = orders.count() - orders.values('cart').distinct().count()
+        timings.sort()
+        self.stdout.write(
+            '{}: {} заказов за {:.2f} с ({:.0f} заказов/с), отклонено блокировкой: {}, лишних заказов: {}'.format(
+                name, len(timings), elapsed, len(timings) / elapsed, len(rejected), duplicates
+            )
+        )
+        if timings:
+            self.stdout.write('  транзакция: p50 {:.1f} мс, p95 {:.1f} мс, макс {:.1f} мс; '
+                              'SQL-запросов на заказ: {:.1f}'.format(
+                                  statistics.median(timings), timings[int(len(timings) * 0.95) - 1], timings[-1],
+                                  statistics.mean(statements)
+                              ))
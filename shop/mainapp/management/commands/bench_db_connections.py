@@ -0,0 +1,91 @@
+import json
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.utils import load_backend
+
+MODES = {
+    # новое соединение на каждый запрос (прежние настройки: postgresql_psycopg2 без CONN_MAX_AGE)
+    'connect': 'django.db.backends.postgresql',
+    'pool': 'mainapp.db_pool',
+}
+QUERY = 'SELECT id, app_label, model FROM django_content_type WHERE id = %s'
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает накладные расходы на соединение с PostgreSQL: подключение на каждый запрос и пул ' \
+           '(mainapp.db_pool). Запрос имитируется как в Django: соединение закрывается в начале и в конце ' \
+           '(close_if_unusable_or_obsolete при CONN_MAX_AGE = 0), между ними - несколько коротких SQL-запросов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=tuple(MODES) + ('both',), default='both')
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--queries', type=int, default=5, help='SQL-запросов на запрос')
+        parser.add_argument('--threads', type=int, default=1, help='одновременных запросов')
+        parser.add_argument('--pool-size', type=int, help='по умолчанию - POOL.MAX_SIZE из настроек')
+        parser.add_argument('--json', action='store_true')
+
+    def handle(self, *args, **options):
+        settings_dict = connections[DEFAULT_DB_ALIAS].settings_dict
+        if connections[DEFAULT_DB_ALIAS].vendor != 'postgresql':
+            raise CommandError('Замер имеет смысл только для PostgreSQL')
+        modes = tuple(MODES) if options['mode'] == 'both' else (options['mode'],)
+        results = [self.run(mode, settings_dict, options) for mode in modes]
+        if options['json']:
+            self.stdout.write(json.dumps(results))
+            return
+        for result in results:
+            self.write_result(result)
+        if len(results) == 2:
+            connect, pool = results
+            self.stdout.write('Пул / подключение на запрос: {:.2f}x запросов в секунду, p50 {:.2f} -> {:.2f} мс'
+                              .format(pool['rps'] / connect['rps'], connect['p50'], pool['p50']))
+
+    def run(self, mode, settings_dict, options):
+        pool_options = dict(settings_dict.get('POOL', {}))
+        if options['pool_size']:
+            pool_options['MAX_SIZE'] = options['pool_size']
+        settings_dict = dict(settings_dict, ENGINE=MODES[mode], CONN_MAX_AGE=0, POOL=pool_options)
+        backend = load_backend(MODES[mode])
+        # обертка соединения - своя у каждого потока, как у потоков сервера
+        local = threading.local()
+        wrappers = []
+
+        def request(number):
+            wrapper = getattr(local, 'wrapper', None)
+            if wrapper is None:
+                wrapper = local.wrapper = backend.DatabaseWrapper(settings_dict, 'bench-{}'.format(mode))
+                wrappers.append(wrapper)
+            started = time.perf_counter()
+            wrapper.close_if_unusable_or_obsolete()
+            with wrapper.cursor() as cursor:
+                for query in range(options['queries']):
+                    cursor.execute(QUERY, [number + query])
+                    cursor.fetchall()
+            wrapper.close_if_unusable_or_obsolete()
+            return time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(options['threads']) as executor:
+            timings = list(executor.map(request, range(options['requests'])))
+        elapsed = time.perf_counter() - started
+        # соединения уже закрыты (возвращены в пул) в конце каждого запроса
+        pool = wrappers[0].pool if mode == 'pool' else None
+        if pool is not None:
+            pool.close_idle()
+        timings = sorted(timing * 1000 for timing in timings)
+        return {
+            'mode': mode, 'requests': len(timings), 'threads': options['threads'], 'rps': len(timings) / elapsed,
+            'p50': statistics.median(timings), 'p95': timings[int(len(timings) * 0.95) - 1], 'max': timings[-1],
+            'connects': pool.stats['connects'] if pool else len(timings),
+            'waits': pool.stats['waits'] if pool else 0,
+        }
+
+    def write_result(self, result):
+        self.stdout.write('{mode}: {requests} запросов в {threads} потоках, {rps:.0f} запр/с, p50 {p50:.2f} мс, '
+                          'p95 {p95:.2f} мс, макс {max:.2f} мс, подключений {connects}, ожиданий пула {waits}'
+                          .format(**result))
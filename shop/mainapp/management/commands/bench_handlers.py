@@ -0,0 +1,172 @@
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from django.core.wsgi import get_wsgi_application
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+
+from mainapp.models import CatalogItem, Category
+
+HOST = 'localhost'
+
+
+def get_urls():
+    item = CatalogItem.objects.order_by('pk').first()
+    category = Category.objects.order_by('pk').first()
+    if item is None or category is None:
+        raise CommandError('Каталог пуст: сначала создайте товары и категории')
+    return ['/', category.get_absolute_url(), item.get_absolute_url(), '/contacts/']
+
+
+def add_db_latency(seconds):
+    # имитация медленной БД: задержка перед каждым запросом во всех соединениях, в том числе новых
+    def wrapper(execute, sql, params, many, context):
+        time.sleep(seconds)
+        return execute(sql, params, many, context)
+
+    def install(connection, **kwargs):
+        connection.execute_wrappers.append(wrapper)
+
+    connection_created.connect(install, weak=False)
+    connections.close_all()
+
+
+def wsgi_environ(path, query):
+    return {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query, 'SCRIPT_NAME': '',
+        'SERVER_NAME': HOST, 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1', 'HTTP_HOST': HOST,
+        'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http', 'wsgi.input': BytesIO(), 'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+    }
+
+
+def asgi_scope(path, query):
+    return {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+        'path': path, 'raw_path': path.encode(), 'query_string': query.encode(), 'root_path': '',
+        'headers': [(b'host', HOST.encode())], 'server': (HOST, 80), 'client': ('127.0.0.1', 0),
+    }
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает пропускную способность страниц каталога под WSGI (синхронные страницы, пул потоков) ' \
+           'и ASGI (асинхронные страницы) при большом числе одновременных запросов. Обработчики Django ' \
+           'вызываются в процессе, без сетевого сервера; каждый режим - в отдельном процессе'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--handler', choices=('wsgi', 'asgi', 'both'), default='both')
+        parser.add_argument('--requests', type=int, default=400)
+        parser.add_argument('--concurrency', type=int, default=50, help='одновременных запросов')
+        parser.add_argument('--db-latency', type=float, default=0, help='задержка каждого SQL-запроса, мс')
+        parser.add_argument('--cold', action='store_true', help='уникальный query string: мимо кэша страниц')
+        parser.add_argument('--json', action='store_true')
+
+    def handle(self, *args, **options):
+        if options['handler'] == 'both':
+            return self.compare(options)
+        if (options['handler'] == 'asgi') != settings.ASYNC_VIEWS:
+            raise CommandError('Режим {} запускается с SHOP_ASYNC_VIEWS={}'.format(
+                options['handler'], int(options['handler'] == 'asgi')
+            ))
+        if options['db_latency']:
+            add_db_latency(options['db_latency'] / 1000)
+        urls = get_urls()
+        if options['handler'] == 'wsgi':
+            timings, errors, elapsed = self.run_wsgi(urls, options)
+        else:
+            # у асинхронных страниц столько же потоков для запросов к БД, сколько у WSGI-пула
+            with override_settings(ASYNC_VIEWS_DB_WORKERS=options['concurrency']):
+                timings, errors, elapsed = asyncio.run(self.run_asgi(urls, options))
+        result = self.summarize(options['handler'], timings, errors, elapsed)
+        if options['json']:
+            self.stdout.write(json.dumps(result))
+        else:
+            self.write_result(result)
+
+    def compare(self, options):
+        results = []
+        for handler in ('wsgi', 'asgi'):
+            argv = [
+                sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), 'bench_handlers', '--json',
+                '--handler', handler, '--requests', str(options['requests']),
+                '--concurrency', str(options['concurrency']), '--db-latency', str(options['db_latency'])
+            ] + (['--cold'] if options['cold'] else [])
+            env = dict(os.environ, SHOP_ASYNC_VIEWS=str(int(handler == 'asgi')))
+            output = subprocess.run(argv, env=env, check=True, capture_output=True, text=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+        for result in results:
+            self.write_result(result)
+        wsgi, asgi = results
+        self.stdout.write('ASGI / WSGI: {:.2f}x запросов в секунду'.format(asgi['rps'] / wsgi['rps']))
+
+    @staticmethod
+    def requests(urls, options):
+        for n in range(options['requests']):
+            query = 'bench={}'.format(n) if options['cold'] else ''
+            yield urls[n % len(urls)], query
+
+    def run_wsgi(self, urls, options):
+        application = get_wsgi_application()
+
+        def call(path, query):
+            status = []
+            started = time.perf_counter()
+            response = application(wsgi_environ(path, query), lambda line, headers: status.append(line))
+            try:
+                b''.join(response)
+            finally:
+                response.close()
+            return time.perf_counter() - started, status[0].startswith('200')
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(options['concurrency']) as pool:
+            results = list(pool.map(lambda request: call(*request), self.requests(urls, options)))
+        elapsed = time.perf_counter() - started
+        return [timing for timing, ok in results], sum(not ok for timing, ok in results), elapsed
+
+    async def run_asgi(self, urls, options):
+        application = get_asgi_application()
+        semaphore = asyncio.Semaphore(options['concurrency'])
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def call(path, query):
+            status = []
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    status.append(message['status'])
+
+            async with semaphore:
+                started = time.perf_counter()
+                await application(asgi_scope(path, query), receive, send)
+                return time.perf_counter() - started, status == [200]
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(call(*request) for request in self.requests(urls, options)))
+        elapsed = time.perf_counter() - started
+        return [timing for timing, ok in results], sum(not ok for timing, ok in results), elapsed
+
+    @staticmethod
+    def summarize(handler, timings, errors, elapsed):
+        timings = sorted(timing * 1000 for timing in timings)
+        return {
+            'handler': handler, 'requests': len(timings), 'errors': errors, 'rps': len(timings) / elapsed,
+            'p50': statistics.median(timings), 'p95': timings[int(len(timings) * 0.95) - 1], 'max': timings[-1],
+        }
+
+    def write_result(self, result):
+        self.stdout.write('{handler}: {requests} запросов, ошибок {errors}, {rps:.0f} запр/с, '
+                          'p50 {p50:.1f} мс, p95 {p95:.1f} мс, макс {max:.1f} мс'.format(**result))
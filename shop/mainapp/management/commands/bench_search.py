@@ -0,0 +1,58 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mainapp import catalog, search, synthetic
+
+QUERIES = (
+    'холодильник bosch', 'стиральная машина 1200 об/мин', 'посудомоечная машина турбосушка', 'samsung белый',
+    'сенсорное управление', 'холодильники lg', 'стиральные машины candy 7 кг', 'черный', 'midea', 'электронное'
+)
+
+
+class Command(BaseCommand):
+    help = 'Замеряет построение поискового индекса и время запросов на синтетическом каталоге (данные откатываются)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100000, help='всего товаров (делятся между типами)')
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.run(options)
+            # каталог нужен только на время замера
+            transaction.set_rollback(True)
+
+    def run(self, options):
+        per_model = options['products'] // len(synthetic.CATALOG)
+        started = time.perf_counter()
+        synthetic.generate_products(per_model, seed=options['seed'])
+        # bulk_create не вызывает сигналов, поэтому карточки каталога собираются отдельно
+        catalog.rebuild_catalog(synthetic.CATALOG)
+        self.stdout.write('Каталог: {} товаров за {:.1f} с'.format(
+            per_model * len(synthetic.CATALOG), time.perf_counter() - started
+        ))
+
+        started = time.perf_counter()
+        documents = search.rebuild_index(synthetic.CATALOG)
+        self.stdout.write('Индекс: {} документов за {:.1f} с'.format(documents, time.perf_counter() - started))
+
+        rnd = random.Random(options['seed'])
+        timings = []
+        for _ in range(options['queries']):
+            query = rnd.choice(QUERIES)
+            started = time.perf_counter()
+            rows = list(search.search(query)[:12])
+            search.load_results(rows)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        self.stdout.write('Запросы: p50 {:.1f} мс, p95 {:.1f} мс, p99 {:.1f} мс, макс {:.1f} мс'.format(
+            statistics.median(timings),
+            timings[int(len(timings) * 0.95) - 1],
+            timings[int(len(timings) * 0.99) - 1],
+            timings[-1]
+        ))
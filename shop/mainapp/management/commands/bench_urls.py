@@ -0,0 +1,317 @@
+import json
+import math
+import os
+import random
+import statistics
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+from django.test import Client
+from django.test.utils import setup_test_environment
+
+from mainapp import synthetic
+from mainapp.product_types import registry as product_types
+from mainapp.models import Cart, CatalogItem, Customer, Refrigerator
+from mainapp.urls import urlpatterns
+from mainapp.utils import add_cart_line, change_cart_totals
+
+# бюджеты по маршрутам для каждого вида БД: {"sqlite": {"base": {"queries": 5, "p95_ms": 150}, ...}}
+BUDGETS_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'bench_budgets.json')
+SEED_PREFIX = 'bench'
+USERNAME = 'bench-user-{}'
+REGISTRATION_USERNAME = 'bench-reg-'
+PASSWORD = 'bench-password'
+SEARCH_QUERIES = ('холодильник bosch', 'стиральная машина', 'посудомоечная турбосушка', 'samsung белый', 'midea')
+ORDER_DATA = {'phone': '+375(44)1112233', 'address': 'Минск', 'buying_type': 'self', 'order_date': '2099-01-01',
+              'comment': ''}
+
+
+class Route:
+    # запрос к маршруту: client - чей клиент ('user' - вошедший покупатель потока, 'anonymous' - аноним потока,
+    # 'new_user' / 'new_anonymous' - новый клиент на каждый запрос); prepare выполняется до замера;
+    # writes - запрос или подготовка пишут в БД
+
+    def __init__(self, request, status=200, client='anonymous', prepare=None, writes=None):
+        self.request = request
+        self.status = status
+        self.client = client
+        self.prepare = prepare
+        self.writes = client != 'anonymous' if writes is None else writes
+
+
+def fill_cart(ctx):
+    cart = Cart.objects.filter(owner=ctx.customer, in_order=False).first() or Cart.objects.create(owner=ctx.customer)
+    item = ctx.rnd.choice(ctx.items)
+    with transaction.atomic():
+        delta = add_cart_line(cart, item)
+        if delta[1]:
+            change_cart_totals(cart, *delta)
+    return item
+
+
+def item_path(action, item):
+    return '/{}/{}/{}/'.format(action, item.get_model_name(), item.slug)
+
+
+ROUTES = {
+    'base': Route(lambda ctx, _: ('get', '/', None)),
+    'product_detail': Route(lambda ctx, _: ('get', ctx.rnd.choice(ctx.items).get_absolute_url(), None)),
+    'category_detail': Route(lambda ctx, _: ('get', '/category/{}/'.format(ctx.rnd.choice(ctx.categories)), None)),
+    'cart': Route(lambda ctx, _: ('get', '/cart/', None), client='user', prepare=fill_cart),
+    'add_to_cart': Route(
+        lambda ctx, _: ('get', item_path('add-to-cart', ctx.rnd.choice(ctx.items)), None), 302, 'user'
+    ),
+    'delete_from_cart': Route(
+        lambda ctx, item: ('get', item_path('remove-from-cart', item), None), 302, 'user', fill_cart
+    ),
+    'change_qty_in_cart': Route(
+        lambda ctx, item: ('post', item_path('change-qty-in-cart', item), {'qty': ctx.rnd.randint(1, 5)}),
+        302, 'user', fill_cart
+    ),
+    'checkout': Route(lambda ctx, _: ('get', '/checkout/', None), client='user', prepare=fill_cart),
+    'make_order': Route(
+        lambda ctx, _: ('post', '/make-order/', dict(ORDER_DATA, idempotency_key=uuid.uuid4().hex)),
+        302, 'user', fill_cart
+    ),
+    'contacts': Route(lambda ctx, _: ('get', '/contacts/', None)),
+    'login': Route(
+        lambda ctx, _: ('post', '/login/', {'username': ctx.user.username, 'password': PASSWORD}), 302, 'new_anonymous'
+    ),
+    'logout': Route(lambda ctx, _: ('get', '/logout/', None), 302, 'new_user'),
+    'registration': Route(lambda ctx, _: ('post', '/registration/', {
+        'username': REGISTRATION_USERNAME + uuid.uuid4().hex[:12], 'password': PASSWORD,
+        'confirm_password': PASSWORD, 'first_name': 'Bench', 'last_name': 'User', 'address': 'Минск',
+        'phone': '+375(44)1112233', 'email': '{}@example.com'.format(uuid.uuid4().hex)
+    }), 302, 'new_anonymous'),
+    'profile': Route(lambda ctx, _: ('get', '/profile/', None), client='user', writes=False),
+    'search': Route(lambda ctx, _: ('get', '/search/?q={}'.format(ctx.rnd.choice(SEARCH_QUERIES)), None)),
+    'cart_api': Route(lambda ctx, _: ('post', '/api/cart/', {'operations': [
+        {'op': 'add', 'ct_model': item.get_model_name(), 'slug': item.slug, 'qty': ctx.rnd.randint(1, 3)}
+        for item in ctx.rnd.sample(ctx.items, 2)
+    ]}), client='user'),
+}
+
+
+class WorkerContext:
+    # клиенты и покупатель одного потока нагрузки
+
+    def __init__(self, route_name, number, users, items, categories):
+        # у каждого маршрута своя последовательность товаров: иначе add_to_cart выбирал бы те же товары,
+        # что fill_cart предыдущего маршрута, и замерялся бы только путь без вставки строки
+        self.rnd = random.Random('{}-{}'.format(route_name, number))
+        self.user = users[number % len(users)]
+        self.customer = Customer.objects.get(user=self.user)
+        # открытая корзина есть до замера: иначе первый запрос маршрута создавал бы ее сам
+        # и число SQL-запросов зависело бы от порядка маршрутов
+        if not Cart.objects.filter(owner=self.customer, in_order=False).exists():
+            Cart.objects.create(owner=self.customer)
+        self.items = items
+        self.categories = categories
+        self.anonymous = Client()
+        self.client = Client()
+        self.client.force_login(self.user)
+
+
+class Command(BaseCommand):
+    help = 'Нагрузочный замер всех маршрутов mainapp.urls на синтетическом каталоге: задержки p50/p95/p99, ' \
+           'запросов в секунду и число SQL-запросов на запрос. Результаты сверяются с bench_budgets.json; ' \
+           'превышение бюджета - ошибка команды. Данные (префикс bench) создаются один раз и переиспользуются'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=1000, help='товаров каждого типа при создании данных')
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--requests', type=int, default=50, help='запросов на маршрут')
+        parser.add_argument('--concurrency', type=int, default=4)
+        parser.add_argument('--routes', nargs='+', help='только эти маршруты (имена из mainapp.urls)')
+        parser.add_argument('--queries-only', action='store_true', help='не проверять бюджеты задержек')
+        parser.add_argument('--update-budgets', action='store_true', help='записать бюджеты по этому замеру')
+
+    def handle(self, *args, **options):
+        names = [pattern.name for pattern in urlpatterns]
+        missing = sorted(set(names) - set(ROUTES))
+        if missing:
+            raise CommandError('Нет сценария нагрузки для маршрутов: {}'.format(', '.join(missing)))
+        routes = options['routes'] or names
+        unknown = sorted(set(routes) - set(ROUTES))
+        if unknown:
+            raise CommandError('Неизвестные маршруты: {}'.format(', '.join(unknown)))
+
+        # тестовый клиент: ответы без проверки CSRF, ALLOWED_HOSTS с testserver
+        try:
+            setup_test_environment()
+        except RuntimeError:
+            # уже настроено - команда запущена из тестов
+            pass
+        self.seed(options)
+        users = list(get_user_model().objects.filter(username__startswith=USERNAME.format('')).order_by('pk'))
+        # заказы и корзины прошлых замеров удаляются, чтобы данные не росли от запуска к запуску
+        Cart.objects.filter(owner__user__in=users).delete()
+        items = list(CatalogItem.objects.filter(slug__contains='-{}-'.format(SEED_PREFIX)).order_by('pk')[:500])
+        categories = [info['category'][0] for info in synthetic.CATALOG.values()]
+        # кэш ContentType прогревается заранее, как при старте сервера, а не первым замеренным запросом
+        product_types.warm_up()
+        try:
+            results = [self.run_route(name, users, items, categories, options) for name in routes]
+        finally:
+            get_user_model().objects.filter(username__startswith=REGISTRATION_USERNAME).delete()
+
+        for result in results:
+            self.stdout.write(
+                '{name:<20} {requests:>4} запр. x{concurrency:<3} {rps:>7.1f} запр/с  '
+                'p50 {p50:>7.1f}  p95 {p95:>7.1f}  p99 {p99:>7.1f} мс  SQL {queries_p50:>3} / макс {queries_max:>3}  ошибок {errors}'.format(**result)
+            )
+        if options['update_budgets']:
+            self.update_budgets(results)
+        else:
+            self.check_budgets(results, options['queries_only'])
+
+    def seed(self, options):
+        if not Refrigerator.objects.filter(slug__contains='-{}-'.format(SEED_PREFIX)).exists():
+            call_command('generate_synthetic', products=options['products'], seed=0, prefix=SEED_PREFIX,
+                         stdout=self.stdout)
+        User = get_user_model()
+        existing = User.objects.filter(username__startswith=USERNAME.format('')).count()
+        if existing < options['users']:
+            # один хэш пароля на всех: PBKDF2 для каждого пользователя занял бы минуты
+            password = make_password(PASSWORD)
+            User.objects.bulk_create(
+                User(username=USERNAME.format(n), password=password, first_name='Bench', last_name='User')
+                for n in range(existing, options['users'])
+            )
+        # id после bulk_create есть не во всех БД, поэтому покупатели создаются по выборке
+        Customer.objects.bulk_create(
+            Customer(user_id=pk, phone='+375(44)1112233')
+            for pk in User.objects.filter(
+                username__startswith=USERNAME.format(''), customer__isnull=True
+            ).values_list('pk', flat=True)
+        )
+
+    def run_route(self, name, users, items, categories, options):
+        route = ROUTES[name]
+        local, numbers, lock = threading.local(), count(), threading.Lock()
+        contexts = []
+
+        def get_context():
+            if not hasattr(local, 'context'):
+                local.context = WorkerContext(name, next(numbers), users, items, categories)
+                with lock:
+                    contexts.append(local.context)
+            return local.context
+
+        def call(_):
+            ctx = get_context()
+            prepared = route.prepare(ctx) if route.prepare else None
+            if route.client.startswith('new_'):
+                client = Client()
+                if route.client == 'new_user':
+                    client.force_login(ctx.user)
+            else:
+                client = ctx.client if route.client == 'user' else ctx.anonymous
+            method, path, data = route.request(ctx, prepared)
+            kwargs = {'data': json.dumps(data), 'content_type': 'application/json'} \
+                if name == 'cart_api' else {'data': data}
+            queries = []
+
+            def count_queries(execute, sql, params, many, context):
+                queries.append(sql)
+                return execute(sql, params, many, context)
+
+            error = None
+            with connection.execute_wrapper(count_queries):
+                started = time.perf_counter()
+                try:
+                    response = getattr(client, method)(path, **kwargs)
+                except Exception as exc:
+                    error = repr(exc)
+                else:
+                    if response.status_code != route.status:
+                        error = '{} {}: {}'.format(method.upper(), path, response.status_code)
+                elapsed = time.perf_counter() - started
+            return elapsed * 1000, len(queries), error
+
+        concurrency = options['concurrency']
+        if route.writes and connection.vendor == 'sqlite':
+            # SQLite не ждет блокировку при переходе транзакции от чтения к записи, а сразу отвечает
+            # "database is locked": пишущие маршруты замеряются в один поток, параллельно - только на Postgres
+            concurrency = 1
+        started = time.perf_counter()
+        if concurrency == 1:
+            results = [call(n) for n in range(options['requests'])]
+        else:
+            def call_in_thread(n):
+                try:
+                    return call(n)
+                finally:
+                    connections.close_all()
+
+            with ThreadPoolExecutor(concurrency) as pool:
+                results = list(pool.map(call_in_thread, range(options['requests'])))
+        elapsed = time.perf_counter() - started
+
+        timings = sorted(timing for timing, _, _ in results)
+        queries = sorted(number for _, number, _ in results)
+        errors = [error for _, _, error in results if error]
+        if errors:
+            self.stderr.write('{}: {}'.format(name, errors[0]))
+        return {
+            'name': name, 'requests': len(results), 'concurrency': concurrency, 'rps': len(results) / elapsed,
+            'errors': len(errors),
+            'p50': statistics.median(timings), 'p95': self.percentile(timings, 95), 'p99': self.percentile(timings, 99),
+            'queries_p50': int(statistics.median(queries)), 'queries_max': queries[-1],
+        }
+
+    @staticmethod
+    def percentile(values, percent):
+        return values[max(math.ceil(len(values) * percent / 100) - 1, 0)]
+
+    @staticmethod
+    def load_budgets():
+        if not os.path.exists(BUDGETS_FILE):
+            return {}
+        with open(BUDGETS_FILE) as file:
+            return json.load(file)
+
+    def check_budgets(self, results, queries_only):
+        budgets = self.load_budgets().get(connection.vendor)
+        if budgets is None:
+            raise CommandError('Нет бюджетов для {}: запишите их с --update-budgets'.format(connection.vendor))
+        violations = []
+        for result in results:
+            budget = budgets.get(result['name'])
+            if budget is None:
+                violations.append('{name}: нет бюджета'.format(**result))
+                continue
+            if result['errors']:
+                violations.append('{name}: ошибок {errors}'.format(**result))
+            if result['queries_max'] > budget['queries']:
+                violations.append('{}: SQL-запросов {} при бюджете {}'.format(
+                    result['name'], result['queries_max'], budget['queries']
+                ))
+            if not queries_only and result['p95'] > budget['p95_ms']:
+                violations.append('{}: p95 {:.1f} мс при бюджете {} мс'.format(
+                    result['name'], result['p95'], budget['p95_ms']
+                ))
+        if violations:
+            raise CommandError('Превышены бюджеты:\n' + '\n'.join(violations))
+        self.stdout.write('Бюджеты соблюдены')
+
+    def update_budgets(self, results):
+        # запас по задержке - втрое от замера (машины разработчиков и CI отличаются), по запросам - без запаса
+        all_budgets = self.load_budgets()
+        budgets = all_budgets.setdefault(connection.vendor, {})
+        for result in results:
+            budgets[result['name']] = {
+                'queries': result['queries_max'], 'p95_ms': max(int(math.ceil(result['p95'] * 3 / 10)) * 10, 50)
+            }
+        with open(BUDGETS_FILE, 'w') as file:
+            json.dump(all_budgets, file, ensure_ascii=False, indent=2, sort_keys=True)
+            file.write('\n')
+        self.stdout.write('Бюджеты {} записаны в {}'.format(connection.vendor, BUDGETS_FILE))
@@ -0,0 +1,51 @@
+import time
+from io import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from mainapp import synthetic
+
+
+class Command(BaseCommand):
+    help = 'Создает синтетический каталог (N товаров каждого типа) и историю заказов (M покупателей с корзинами ' \
+           'и заказами) для замеров на больших объемах. Строки пишутся bulk_create пачками, миниатюры строятся ' \
+           'один раз на тип товара. Данные не удаляются: для повторных замеров используйте отдельную БД'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=0, help='товаров каждого типа')
+        parser.add_argument('--customers', type=int, default=0)
+        parser.add_argument('--orders-per-customer', type=int, default=10)
+        parser.add_argument('--lines', type=int, default=3, help='наибольшее число строк в корзине')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int)
+        parser.add_argument('--prefix', help='префикс slug товаров и имен пользователей (по умолчанию случайный)')
+
+    def handle(self, *args, **options):
+        if not options['products'] and not options['customers']:
+            raise CommandError('Укажите --products и/или --customers')
+        if options['products']:
+            started = time.perf_counter()
+            prefix = synthetic.generate_products(
+                options['products'], options['batch_size'], options['seed'], options['prefix']
+            )
+            # bulk_create не вызывает сигналов: каталог, индекс, характеристики и счетчики - отдельно
+            for command in ('rebuild_catalog', 'rebuild_search_index', 'rebuild_spec_values'):
+                call_command(command, stdout=StringIO())
+            self.stdout.write('Товаров: {} (префикс {}) за {:.1f} с'.format(
+                options['products'] * len(synthetic.CATALOG), prefix, time.perf_counter() - started
+            ))
+        if options['customers']:
+            started = time.perf_counter()
+            try:
+                prefix = synthetic.generate_customers(
+                    options['customers'], options['orders_per_customer'], options['lines'], options['batch_size'],
+                    options['seed'], options['prefix']
+                )
+            except ValueError as exc:
+                raise CommandError(exc)
+            elapsed = time.perf_counter() - started
+            orders = options['customers'] * options['orders_per_customer']
+            self.stdout.write('Покупателей: {}, заказов: {} (префикс {}) за {:.1f} с, {:.0f} заказов/с'.format(
+                options['customers'], orders, prefix, elapsed, orders / elapsed
+            ))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mainapp import catalog, page_cache
+from mainapp.models import Category, LatestProducts, get_product_models
+
+
+class Command(BaseCommand):
+    help = 'Сверяет общий каталог карточек с таблицами товаров и пересчитывает счетчики категорий'
+
+    def handle(self, *args, **options):
+        product_models = get_product_models()
+        with transaction.atomic():
+            total = catalog.rebuild_catalog(product_models)
+            Category.objects.recalc_products_count()
+        Category.objects.invalidate_sidebar_cache()
+        LatestProducts.objects.invalidate_cache()
+        # закэшированные страницы и фрагменты со списками товаров
+        page_cache.bump_versions(*[page_cache.product_scope(model) for model in product_models])
+        self.stdout.write('Карточек в каталоге: {}'.format(total))
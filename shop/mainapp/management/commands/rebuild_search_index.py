@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mainapp import search
+from mainapp.models import get_product_models
+
+
+class Command(BaseCommand):
+    help = 'Полностью перестраивает поисковый индекс товаров'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            total = search.rebuild_index(get_product_models())
+        self.stdout.write('Проиндексировано товаров: {}'.format(total))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mainapp import specs
+from mainapp.models import Category, get_product_models
+
+
+class Command(BaseCommand):
+    help = 'Заново разбирает числовые значения характеристик всех товаров (для фильтров категорий)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        total = 0
+        for model in get_product_models():
+            chunk = []
+            for product in model._base_manager.order_by('pk').iterator(chunk_size=options['chunk_size']):
+                chunk.append(product)
+                if len(chunk) == options['chunk_size']:
+                    with transaction.atomic():
+                        specs.update_product_specs(chunk)
+                    total, chunk = total + len(chunk), []
+            with transaction.atomic():
+                specs.update_product_specs(chunk)
+            total += len(chunk)
+        for category_id in Category.objects.values_list('pk', flat=True):
+            specs.invalidate_facets(category_id)
+        self.stdout.write('Обработано товаров: {}'.format(total))
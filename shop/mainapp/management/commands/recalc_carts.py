@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from mainapp.models import Cart
+from mainapp.utils import get_cart_totals, recalc_cart
+
+
+class Command(BaseCommand):
+    help = 'Сверяет итоги корзин с их строками и исправляет расхождения'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='только вывести расхождения, не исправляя их')
+        parser.add_argument('--all', action='store_true', help='включая корзины оформленных заказов')
+
+    def handle(self, *args, **options):
+        carts = Cart.objects.all() if options['all'] else Cart.objects.filter(in_order=False)
+        mismatched = 0
+        for cart in carts.iterator():
+            final_price, total_products = get_cart_totals(cart)
+            if (final_price, total_products) == (cart.final_price, cart.total_products):
+                continue
+            mismatched += 1
+            self.stdout.write('Корзина {}: {} / {} -> {} / {}'.format(
+                cart.pk, cart.final_price, cart.total_products, final_price, total_products
+            ))
+            if not options['check']:
+                recalc_cart(cart)
+        self.stdout.write('Расхождений: {}'.format(mismatched))
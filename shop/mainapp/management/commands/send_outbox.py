@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from mainapp import outbox
+
+
+class Command(BaseCommand):
+    help = 'Отправляет письма из очереди пачками через одно SMTP-соединение; без --once работает постоянно ' \
+           '(отдельный обработчик очереди, в том числе для повторов после ошибок)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='разобрать очередь один раз и выйти')
+        parser.add_argument('--interval', type=float, default=5, help='пауза между проверками очереди, с')
+        parser.add_argument('--batch-size', type=int, default=outbox.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = outbox.drain(options['batch_size'])
+            if sent or failed or options['once']:
+                self.stdout.write('Отправлено: {}, ошибок: {}'.format(sent, failed))
+            if options['once']:
+                return
+            time.sleep(options['interval'])
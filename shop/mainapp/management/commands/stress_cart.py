@@ -0,0 +1,123 @@
+import random
+import threading
+import time
+from collections import Counter
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections, transaction
+from django.db.models import Count
+
+from mainapp.models import Cart, CartProduct, CatalogItem, Customer
+from mainapp.utils import add_cart_line, change_cart_totals, get_cart_totals, remove_cart_line, set_cart_line_qty
+
+STRESS_USERNAME = 'stress-cart'
+OPERATIONS = ('add', 'set_qty', 'remove')
+# счетчик добавленного общий для потоков
+_added_lock = threading.Lock()
+
+
+class Command(BaseCommand):
+    help = 'Параллельно меняет одну корзину из нескольких потоков и проверяет, что строки не задвоились, ' \
+           'а итоги совпадают с пересчетом по строкам (нужна БД с несколькими соединениями)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--iterations', type=int, default=200, help='операций на поток')
+        parser.add_argument('--products', type=int, default=5, help='сколько разных товаров в корзине')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--operations', default='add,add,set_qty,remove',
+            help='операции через запятую, выбираются случайно (повтор - больший вес); '
+                 'только add - проверяется и количество каждого товара'
+        )
+
+    def handle(self, *args, **options):
+        options['operations'] = options['operations'].split(',')
+        if set(options['operations']) - set(OPERATIONS):
+            raise CommandError('Допустимые операции: {}'.format(', '.join(OPERATIONS)))
+        items = list(CatalogItem.objects.order_by('pk')[:options['products']])
+        if not items:
+            raise CommandError('В каталоге нет товаров')
+        user, _ = get_user_model().objects.get_or_create(username=STRESS_USERNAME)
+        customer, _ = Customer.objects.get_or_create(user=user)
+        cart = Cart.objects.create(owner=customer)
+        try:
+            self.run(cart, items, options)
+        finally:
+            cart.products.clear()
+            CartProduct.objects.filter(cart=cart).delete()
+            cart.delete()
+
+    def run(self, cart, items, options):
+        errors = []
+        # {id карточки: добавлено штук} по зафиксированным add
+        added = Counter()
+        threads = [
+            threading.Thread(target=self.worker, args=(
+                cart.pk, items, options['operations'], options['iterations'], options['seed'] + n, errors, added
+            ))
+            for n in range(options['threads'])
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        operations = options['threads'] * options['iterations']
+        self.stdout.write('Операций: {} за {:.2f} с ({:.0f} оп/с), отклонено блокировкой: {}'.format(
+            operations, elapsed, operations / elapsed, len(errors)
+        ))
+
+        cart.refresh_from_db()
+        duplicates = CartProduct.objects.filter(cart=cart).values('content_type', 'object_id').annotate(
+            count=Count('id')
+        ).filter(count__gt=1).count()
+        lines = CartProduct.objects.filter(cart=cart).count()
+        expected = get_cart_totals(cart)
+        self.stdout.write('Строк: {}, дублей: {}, итоги: {} / {} (по строкам: {} / {})'.format(
+            lines, duplicates, cart.final_price, cart.total_products, *expected
+        ))
+        if duplicates or cart.products.count() != lines or (cart.final_price, cart.total_products) != expected:
+            raise CommandError('Итоги корзины разошлись со строками')
+        # стоимость строки меняется вместе с количеством (в том числе при увеличении на add)
+        prices = {item.pk: item.price for item in items}
+        for line in CartProduct.objects.filter(cart=cart):
+            if line.final_price != line.qty * prices[line.catalog_item_id]:
+                raise CommandError('Стоимость строки {} не равна цене, умноженной на количество'.format(line.pk))
+        if set(options['operations']) == {'add'}:
+            qty = dict(CartProduct.objects.filter(cart=cart).values_list('catalog_item_id', 'qty'))
+            if qty != dict(added):
+                raise CommandError('Количество товаров {} не совпадает с добавленным {}'.format(qty, dict(added)))
+            self.stdout.write('Количество совпадает с добавленным: {} шт.'.format(sum(added.values())))
+        self.stdout.write('Итоги совпадают')
+
+    @staticmethod
+    def worker(cart_pk, items, operations, iterations, seed, errors, added):
+        rnd = random.Random(seed)
+        try:
+            cart = Cart.objects.get(pk=cart_pk)
+            for _ in range(iterations):
+                item = rnd.choice(items)
+                op = rnd.choice(operations)
+                qty = rnd.randint(1, 5)
+                try:
+                    with transaction.atomic():
+                        if op == 'add':
+                            # повторное добавление товара увеличивает количество в строке
+                            delta = add_cart_line(cart, item, qty)
+                        elif op == 'remove':
+                            delta = remove_cart_line(cart, item)
+                        else:
+                            delta = set_cart_line_qty(cart, item, qty) or (0, 0)
+                        if delta != (0, 0):
+                            change_cart_totals(cart, *delta)
+                    if op == 'add':
+                        with _added_lock:
+                            added[item.pk] += qty
+                except OperationalError:
+                    # SQLite: конкурентная запись не дождалась блокировки (изменение отменено целиком)
+                    errors.append(op)
+        finally:
+            connections.close_all()
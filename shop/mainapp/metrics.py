@@ -0,0 +1,211 @@
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+# метрики запросов копятся в памяти процесса и отдаются в формате Prometheus (mainapp.views.MetricsView).
+# Границы гистограмм заданы заранее, на запрос создается только объект счетчиков RequestStats;
+# при нескольких рабочих процессах у каждого свои значения, и /metrics отдает значения одного процесса
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 20, 50, 100)
+SIZE_BUCKETS = (1000, 5000, 10000, 25000, 50000, 100000, 250000, 1000000)
+# кэши, чьи попадания считаются отдельно (record_cache)
+CACHES = ('page', 'latest_products', 'sidebar', 'facets', 'spec_table')
+UNRESOLVED_VIEW = '<unresolved>'
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # последний элемент - значения больше всех границ (+Inf)
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        total = 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            total += count
+            yield '{}_bucket'.format(name), dict(labels, le=str(bound)), total
+        yield '{}_sum'.format(name), labels, self.sum
+        yield '{}_count'.format(name), labels, total
+
+
+class ViewMetrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.responses = {}
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.query_seconds = 0
+        self.response_size = Histogram(SIZE_BUCKETS)
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def record(self, status, elapsed, stats, size):
+        with self.lock:
+            self.responses[status] = self.responses.get(status, 0) + 1
+            self.latency.observe(elapsed)
+            self.queries.observe(stats.queries)
+            self.query_seconds += stats.query_time
+            if size is not None:
+                self.response_size.observe(size)
+            self.cache_hits += stats.cache_hits
+            self.cache_misses += stats.cache_misses
+
+
+class RequestStats:
+    # счетчики одного запроса меняются и из нескольких потоков сразу (gather_sync асинхронных страниц)
+    __slots__ = ('lock', 'queries', 'query_time', 'cache_hits', 'cache_misses')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.query_time = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def add_query(self, elapsed):
+        with self.lock:
+            self.queries += 1
+            self.query_time += elapsed
+
+    def add_cache(self, hit):
+        with self.lock:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+
+
+# счетчики текущего запроса; контекст копируется в потоки sync_to_async, поэтому запросы к БД
+# асинхронных страниц из пула потоков тоже попадают в свой запрос
+_current = ContextVar('metrics_request_stats', default=None)
+_views = {}
+_views_lock = threading.Lock()
+_cache_counts = {name: [0, 0] for name in CACHES}
+_cache_lock = threading.Lock()
+
+
+def get_view_metrics(view_name):
+    metrics = _views.get(view_name)
+    if metrics is None:
+        with _views_lock:
+            metrics = _views.setdefault(view_name, ViewMetrics())
+    return metrics
+
+
+def start_request():
+    return _current.set(RequestStats())
+
+
+def finish_request(token, request, response, elapsed):
+    stats = _current.get()
+    _current.reset(token)
+    match = getattr(request, 'resolver_match', None)
+    size = None if response.streaming else len(response.content)
+    get_view_metrics(match.view_name if match else UNRESOLVED_VIEW).record(
+        response.status_code, elapsed, stats, size
+    )
+
+
+def record_cache(name, hit):
+    with _cache_lock:
+        _cache_counts[name][0 if hit else 1] += 1
+    stats = _current.get()
+    if stats is not None:
+        stats.add_cache(hit)
+
+
+def _count_query(execute, sql, params, many, context):
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.add_query(time.perf_counter() - started)
+
+
+@receiver(connection_created)
+def install_query_counter(sender, connection, **kwargs):
+    # соединение переоткрывается с тем же объектом DatabaseWrapper - обертка ставится один раз
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+def reset():
+    with _views_lock:
+        _views.clear()
+    with _cache_lock:
+        for counts in _cache_counts.values():
+            counts[:] = [0, 0]
+
+
+def _format_labels(labels):
+    return ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels.items()
+    )
+
+
+def render():
+    # текстовый формат Prometheus 0.0.4
+    families = (
+        ('shop_http_responses_total', 'counter', 'Ответы по представлениям и статусам'),
+        ('shop_http_request_duration_seconds', 'histogram', 'Время обработки запроса'),
+        ('shop_db_queries_per_request', 'histogram', 'SQL-запросов на запрос'),
+        ('shop_db_query_duration_seconds_total', 'counter', 'Суммарное время SQL-запросов'),
+        ('shop_http_response_size_bytes', 'histogram', 'Размер ответа'),
+        ('shop_view_cache_hits_total', 'counter', 'Попадания в кэш при обработке запросов'),
+        ('shop_view_cache_misses_total', 'counter', 'Промахи кэша при обработке запросов'),
+        ('shop_cache_hits_total', 'counter', 'Попадания по кэшам'),
+        ('shop_cache_misses_total', 'counter', 'Промахи по кэшам'),
+    )
+    samples = {name: [] for name, _, _ in families}
+    with _views_lock:
+        views = sorted(_views.items())
+    for view_name, metrics in views:
+        labels = {'view': view_name}
+        with metrics.lock:
+            for status, count in sorted(metrics.responses.items()):
+                samples['shop_http_responses_total'].append(
+                    ('shop_http_responses_total', dict(labels, status=status), count)
+                )
+            samples['shop_http_request_duration_seconds'].extend(
+                metrics.latency.samples('shop_http_request_duration_seconds', labels)
+            )
+            samples['shop_db_queries_per_request'].extend(
+                metrics.queries.samples('shop_db_queries_per_request', labels)
+            )
+            samples['shop_db_query_duration_seconds_total'].append(
+                ('shop_db_query_duration_seconds_total', labels, metrics.query_seconds)
+            )
+            samples['shop_http_response_size_bytes'].extend(
+                metrics.response_size.samples('shop_http_response_size_bytes', labels)
+            )
+            samples['shop_view_cache_hits_total'].append(('shop_view_cache_hits_total', labels, metrics.cache_hits))
+            samples['shop_view_cache_misses_total'].append(
+                ('shop_view_cache_misses_total', labels, metrics.cache_misses)
+            )
+    with _cache_lock:
+        for cache_name, (hits, misses) in _cache_counts.items():
+            samples['shop_cache_hits_total'].append(('shop_cache_hits_total', {'cache': cache_name}, hits))
+            samples['shop_cache_misses_total'].append(('shop_cache_misses_total', {'cache': cache_name}, misses))
+
+    lines = []
+    for family, kind, description in families:
+        lines.append('# HELP {} {}'.format(family, description))
+        lines.append('# TYPE {} {}'.format(family, kind))
+        for name, labels, value in samples[family]:
+            lines.append('{}{{{}}} {}'.format(name, _format_labels(labels), value))
+    return '\n'.join(lines) + '\n'
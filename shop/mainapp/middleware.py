@@ -0,0 +1,76 @@
+import asyncio
+import re
+import time
+import uuid
+
+from . import log, metrics
+
+# id запроса от балансировщика принимается, только если он похож на id
+REQUEST_ID_RE = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+
+class MetricsMiddleware:
+    # время ответа, SQL-запросы, попадания в кэш и размер ответа по представлениям (mainapp.metrics);
+    # стоит первым в MIDDLEWARE, чтобы учитывать и работу остальных промежуточных слоев.
+    # Поддерживает оба режима: под ASGI цепочка не переключается в поток ради этого слоя
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        token = metrics.start_request()
+        started = time.perf_counter()
+        response = self.get_response(request)
+        metrics.finish_request(token, request, response, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        token = metrics.start_request()
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        metrics.finish_request(token, request, response, time.perf_counter() - started)
+        return response
+
+
+class RequestIdMiddleware:
+    # id запроса (заголовок X-Request-ID или новый) для записей журнала (mainapp.log) и ответа
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    @staticmethod
+    def get_request_id(request):
+        value = request.headers.get('X-Request-ID', '')
+        return value if REQUEST_ID_RE.match(value) else uuid.uuid4().hex
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        request.id = self.get_request_id(request)
+        token = log.request_id.set(request.id)
+        try:
+            response = self.get_response(request)
+        finally:
+            log.request_id.reset(token)
+        response['X-Request-ID'] = request.id
+        return response
+
+    async def __acall__(self, request):
+        request.id = self.get_request_id(request)
+        token = log.request_id.set(request.id)
+        try:
+            response = await self.get_response(request)
+        finally:
+            log.request_id.reset(token)
+        response['X-Request-ID'] = request.id
+        return response
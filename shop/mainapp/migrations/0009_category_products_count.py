@@ -0,0 +1,29 @@
+# Generated by Django 3.2.4 on 2026-10-18 10:05
+
+from django.db import migrations, models
+
+
+def fill_products_count(apps, schema_editor):
+    Category = apps.get_model('mainapp', 'Category')
+    for category in Category.objects.all():
+        category.products_count = sum(
+            apps.get_model('mainapp', model_name).objects.filter(category=category).count()
+            for model_name in ('Refrigerator', 'Washer', 'Dishwasher')
+        )
+        category.save(update_fields=['products_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0008_auto_20210610_2020'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='products_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_products_count, migrations.RunPython.noop),
+    ]
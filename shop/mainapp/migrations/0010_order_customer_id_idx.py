@@ -0,0 +1,17 @@
+# Generated by Django 3.2.4 on 2026-10-18 10:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0009_category_products_count'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['customer', '-id'], name='order_customer_id_idx'),
+        ),
+    ]
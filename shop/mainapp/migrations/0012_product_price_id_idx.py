@@ -0,0 +1,25 @@
+# Generated by Django 3.2.4 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0011_product_image_hash'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='dishwasher',
+            index=models.Index(fields=['price', 'id'], name='dishwasher_price_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='refrigerator',
+            index=models.Index(fields=['price', 'id'], name='refrigerator_price_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='washer',
+            index=models.Index(fields=['price', 'id'], name='washer_price_id_idx'),
+        ),
+    ]
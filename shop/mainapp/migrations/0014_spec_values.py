@@ -0,0 +1,34 @@
+# Generated by Django 3.2.4 on 2026-10-18 10:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('mainapp', '0013_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpecValue',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('key', models.CharField(max_length=64)),
+                ('value', models.DecimalField(decimal_places=3, max_digits=12)),
+                ('unit', models.CharField(blank=True, max_length=32)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='specvalue',
+            index=models.Index(fields=['content_type', 'key', 'value', 'object_id'], name='specvalue_range_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='specvalue',
+            unique_together={('content_type', 'object_id', 'key')},
+        ),
+    ]
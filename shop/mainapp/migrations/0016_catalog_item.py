@@ -0,0 +1,75 @@
+# Generated by Django 3.2.4 on 2026-10-18 10:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_catalog(apps, schema_editor):
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    CatalogItem = apps.get_model('mainapp', 'CatalogItem')
+    CartProduct = apps.get_model('mainapp', 'CartProduct')
+    for model_name in ('Refrigerator', 'Washer', 'Dishwasher'):
+        model = apps.get_model('mainapp', model_name)
+        content_type = ContentType.objects.get_for_model(model)
+        CatalogItem.objects.bulk_create((
+            CatalogItem(
+                content_type=content_type, object_id=product.pk, category_id=product.category_id,
+                title=product.title, slug=product.slug, price=product.price, image=product.image.name
+            )
+            for product in model.objects.order_by('pk').iterator()
+        ), batch_size=2000)
+    CartProduct.objects.update(catalog_item=models.Subquery(
+        CatalogItem.objects.filter(
+            content_type=models.OuterRef('content_type'), object_id=models.OuterRef('object_id')
+        ).values('pk')[:1]
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('mainapp', '0015_product_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('title', models.CharField(max_length=255, verbose_name='Наименование')),
+                ('slug', models.SlugField()),
+                ('price', models.DecimalField(decimal_places=2, max_digits=9, verbose_name='Цена')),
+                ('image', models.ImageField(upload_to='', verbose_name='Изображение')),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='mainapp.category', verbose_name='Категория')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='cartproduct',
+            name='catalog_item',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='mainapp.catalogitem'),
+        ),
+        migrations.AddIndex(
+            model_name='catalogitem',
+            index=models.Index(fields=['category', '-id'], name='catalogitem_category_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='catalogitem',
+            index=models.Index(fields=['category', 'price', 'id'], name='catalogitem_category_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='catalogitem',
+            index=models.Index(fields=['content_type', 'slug'], name='catalogitem_type_slug_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='catalogitem',
+            index=models.Index(fields=['content_type', '-id'], name='catalogitem_type_id_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='catalogitem',
+            unique_together={('content_type', 'object_id')},
+        ),
+        migrations.RunPython(fill_catalog, migrations.RunPython.noop),
+    ]
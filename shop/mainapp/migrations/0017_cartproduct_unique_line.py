@@ -0,0 +1,45 @@
+# Generated by Django 3.2.4 on 2026-10-18 10:35
+
+from django.db import migrations, models
+
+
+def merge_duplicate_lines(apps, schema_editor):
+    # дубли строк (двойной клик, параллельные вкладки) сливаются в одну с наибольшим количеством,
+    # итоги затронутых корзин пересчитываются по оставшимся строкам
+    CartProduct = apps.get_model('mainapp', 'CartProduct')
+    Cart = apps.get_model('mainapp', 'Cart')
+    duplicates = CartProduct.objects.values('cart', 'content_type', 'object_id').annotate(
+        count=models.Count('id')
+    ).filter(count__gt=1)
+    carts = set()
+    for group in duplicates:
+        lines = list(CartProduct.objects.filter(
+            cart=group['cart'], content_type=group['content_type'], object_id=group['object_id']
+        ).order_by('-qty', 'id'))
+        Cart.products.through.objects.filter(cartproduct__in=lines[1:]).delete()
+        CartProduct.objects.filter(pk__in=[line.pk for line in lines[1:]]).delete()
+        carts.add(group['cart'])
+    for cart in Cart.objects.filter(pk__in=carts):
+        totals = cart.products.aggregate(models.Sum('final_price'), models.Count('id'))
+        cart.final_price = totals['final_price__sum'] or 0
+        cart.total_products = totals['id__count']
+        cart.save(update_fields=['final_price', 'total_products'])
+    if schema_editor.connection.vendor == 'postgresql':
+        # внешние ключи PostgreSQL проверяются в конце транзакции: с отложенными проверками после
+        # удаления строк AddConstraint в той же миграции падает ("pending trigger events")
+        schema_editor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0016_catalog_item'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_lines, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cartproduct',
+            constraint=models.UniqueConstraint(fields=('cart', 'content_type', 'object_id'), name='cartproduct_unique_line'),
+        ),
+    ]
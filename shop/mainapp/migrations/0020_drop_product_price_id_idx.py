@@ -0,0 +1,25 @@
+# Generated by Django 3.2.4 on 2026-10-18 11:47
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0019_order_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='dishwasher',
+            name='dishwasher_price_id_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='refrigerator',
+            name='refrigerator_price_id_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='washer',
+            name='washer_price_id_idx',
+        ),
+    ]
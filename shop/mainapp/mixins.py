@@ -1,40 +1,226 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial, update_wrapper, wraps
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections, connection
+from django.http import Http404, QueryDict
+from django.utils.functional import SimpleLazyObject, cached_property
 from django.views.generic.detail import SingleObjectMixin
 from django.views.generic import View
 
-from .models import Category, Cart, Customer, Refrigerator, Washer, Dishwasher
+from . import metrics, page_cache
+from .models import Category, Cart, CatalogItem, Customer
+from .product_types import registry as product_types
+from .specs import filter_products, get_facets, parse_filters
+from .utils import keyset_paginate
 
 
 class CategoryDetailMixin(SingleObjectMixin):
-    CATEGORY_SLUG_TO_PRODUCT_MODEL = {
-        'refrigerators': Refrigerator,
-        'washers': Washer,
-        'dishwashers': Dishwasher
+    # порядок сортировки товаров категории; последним идет уникальный id для постраничного вывода
+    SORT_ORDERS = {
+        'new': ('-id',),
+        'price': ('price', 'id'),
+        '-price': ('-price', '-id'),
     }
+    DEFAULT_SORT = 'new'
+    paginate_by = 12
+
+    def get_sort(self):
+        sort = self.request.GET.get('sort')
+        return sort if sort in self.SORT_ORDERS else self.DEFAULT_SORT
+
+    def get_category_page(self, model, filters, sort):
+        # карточки товаров берутся из общего каталога, характеристики для фильтров - из SpecValue
+        queryset = filter_products(CatalogItem.objects.filter(category=self.object), model, filters)
+        try:
+            page = keyset_paginate(queryset, self.SORT_ORDERS[sort], self.request.GET.get('after'), self.paginate_by)
+        except ValidationError:
+            raise Http404('Неверная страница')
+        return page
 
     def get_context_data(self, **kwargs):
-        if isinstance(self.get_object(), Category):
-            model = self.CATEGORY_SLUG_TO_PRODUCT_MODEL[self.get_object().slug]
-            context = super().get_context_data(**kwargs)
-            context['categories'] = Category.objects.get_categories_for_up_sidebar()
-            context['category_products'] = model.objects.all()
-            return context
         context = super().get_context_data(**kwargs)
-        context['categories'] = Category.objects.get_categories_for_up_sidebar()
+        if 'categories' not in context:
+            context['categories'] = Category.objects.get_categories_for_up_sidebar()
+        if isinstance(self.object, Category):
+            product_type = product_types.for_category(self.object.slug)
+            if product_type is None:
+                raise Http404('В категории нет товаров известного типа')
+            model = product_type.model
+            filters = parse_filters(model, self.request.GET)
+            context['sort'] = sort = self.get_sort()
+            # товары запрашиваются лениво: если список взят из фрагментного кэша шаблона, запроса нет
+            page = SimpleLazyObject(partial(self.get_category_page, model, filters, sort))
+            context['page'] = page
+            context['category_products'] = SimpleLazyObject(lambda: page.items)
+            context['facets'] = self.get_facet_links(get_facets(self.object, model), filters)
+            context['filter_query'] = self.get_filter_query(filters).urlencode()
         return context
 
+    def get_filter_query(self, filters, **extra):
+        query = QueryDict(mutable=True)
+        for name, bounds in dict(filters, **extra).items():
+            for suffix, value in zip(('min', 'max'), bounds):
+                if value is not None:
+                    query['{}_{}'.format(name, suffix)] = value
+        return query
+
+    def get_facet_links(self, facets, filters):
+        # ссылки интервалов гистограмм сохраняют остальные фильтры и сортировку
+        result = []
+        for facet in facets:
+            buckets = []
+            for bucket in facet['buckets']:
+                query = self.get_filter_query(filters, **{facet['key']: (bucket['start'], bucket['end'])})
+                query['sort'] = self.request.GET.get('sort', self.DEFAULT_SORT)
+                active = filters.get(facet['key']) == (bucket['start'], bucket['end'])
+                buckets.append(dict(bucket, url='?' + query.urlencode(), active=active))
+            reset = self.get_filter_query({k: v for k, v in filters.items() if k != facet['key']})
+            result.append(dict(facet, buckets=buckets, reset_url='?' + reset.urlencode(), filtered=facet['key'] in filters))
+        return result
+
+
+class ShopperContext:
+    # покупатель и его открытая корзина в рамках одного запроса:
+    # вычисляются лениво, корзина с покупателем - одним запросом с JOIN,
+    # а новая корзина создается только при добавлении товара
+
+    def __init__(self, request):
+        self.user = request.user
+
+    @cached_property
+    def cart(self):
+        if not self.user.is_authenticated:
+            return None
+        return Cart.objects.select_related('owner').filter(owner__user=self.user, in_order=False).first()
+
+    @cached_property
+    def customer(self):
+        if not self.user.is_authenticated:
+            return None
+        if self.cart is not None:
+            return self.cart.owner
+        return Customer.objects.filter(user=self.user).first()
+
+    def get_or_create_cart(self):
+        if self.cart is None and self.customer is not None:
+            self.cart = Cart.objects.create(owner=self.customer)
+        return self.cart
+
 
 class CartMixin(View):
 
     def dispatch(self, request, *args, **kwargs):
-        if request.user.is_authenticated:
-            customer = Customer.objects.filter(user=request.user).first()
-            cart = Cart.objects.filter(owner=customer, in_order=False).first()
-            if not cart:
-                cart = Cart.objects.create(owner=customer)
-        else:
-            cart = None
-        #     cart = Cart.objects.filter(for_anonymous_user=True).first()
-        #     if not cart:
-        #         cart = Cart.objects.create(for_anonymous_user=True)
-        self.cart = cart
+        self.shopper = ShopperContext(request)
         return super().dispatch(request, *args, **kwargs)
+
+    @property
+    def cart(self):
+        return self.shopper.cart
+
+
+class PageCacheMixin(View):
+    # анонимам отдается готовая страница из кэша; для остальных в шаблонах кэшируются
+    # фрагменты по ключу cache_version, а корзина в шапке всегда рисуется заново.
+    # Ключи содержат версии областей (get_cache_scopes), которые увеличиваются при изменении товаров
+    page_cache_timeout = page_cache.PAGE_CACHE_TIMEOUT
+
+    def get_cache_scopes(self):
+        return (page_cache.SIDEBAR_SCOPE,)
+
+    def dispatch(self, request, *args, **kwargs):
+        key, response = self.get_cached_page(request)
+        if response is None:
+            response = super().dispatch(request, *args, **kwargs)
+            self.cache_page(key, response)
+        return response
+
+    def get_cached_page(self, request):
+        # (ключ, страница из кэша или None); ключ None - страницу для этого запроса не кэшируем
+        self.cache_version = page_cache.get_versions(self.get_cache_scopes())
+        if not page_cache.is_page_cacheable(request):
+            return None, None
+        key = page_cache.get_page_key(request, self.cache_version)
+        response = cache.get(key)
+        metrics.record_cache('page', response is not None)
+        return key, response
+
+    def cache_page(self, key, response):
+        if key is not None and response.status_code == 200 and not response.streaming:
+            if hasattr(response, 'render'):
+                response.render()
+            cache.set(key, response, self.page_cache_timeout)
+
+    def get_cache_context(self):
+        return {'cache_version': self.cache_version, 'cache_timeout': self.page_cache_timeout}
+
+
+@lru_cache(maxsize=None)
+def _db_executor():
+    # отдельный пул для запросов асинхронных страниц: пул по умолчанию - всего несколько потоков
+    return ThreadPoolExecutor(settings.ASYNC_VIEWS_DB_WORKERS, thread_name_prefix='async-db')
+
+
+def _in_own_connection(func):
+    # поток пула работает со своим соединением; после вызова оно закрывается по правилам CONN_MAX_AGE
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return wrapper
+
+
+class AsyncCartMixin(CartMixin):
+    # асинхронная версия страницы для ASGI. ORM в Django 3.2 синхронный, поэтому запросы выполняются
+    # в потоках пула (run_sync), а независимые - одновременно (gather_sync), не занимая общий поток
+    # синхронного кода. Обработчики get и т.п. - корутины
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Django 3.2 считает асинхронными только функции-корутины
+        view = super().as_view(**initkwargs)
+
+        async def async_view(request, *args, **kwargs):
+            return await view(request, *args, **kwargs)
+
+        return update_wrapper(async_view, view)
+
+    async def dispatch(self, request, *args, **kwargs):
+        # открытую транзакцию (ATOMIC_REQUESTS, тесты) другие соединения не видят:
+        # тогда запросы идут по очереди в ее потоке
+        self.sequential = await sync_to_async(lambda: connection.in_atomic_block)()
+        self.shopper = ShopperContext(request)
+        return await self.handle(request, *args, **kwargs)
+
+    async def handle(self, request, *args, **kwargs):
+        method = request.method.lower()
+        handler = getattr(self, method, None) if method in self.http_method_names else None
+        if handler is None:
+            return self.http_method_not_allowed(request, *args, **kwargs)
+        return await handler(request, *args, **kwargs)
+
+    def run_sync(self, func, *args, **kwargs):
+        if self.sequential:
+            return sync_to_async(func)(*args, **kwargs)
+        return sync_to_async(_in_own_connection(func), thread_sensitive=False, executor=_db_executor())(*args, **kwargs)
+
+    async def gather_sync(self, *funcs):
+        return await asyncio.gather(*(self.run_sync(func) for func in funcs))
+
+
+class AsyncPageCacheMixin(AsyncCartMixin):
+    # PageCacheMixin для асинхронных страниц: проверка кэша и сохранение страницы - в потоках пула
+
+    async def handle(self, request, *args, **kwargs):
+        key, response = await self.run_sync(self.get_cached_page, request)
+        if response is None:
+            response = await super().handle(request, *args, **kwargs)
+            await self.run_sync(self.cache_page, key, response)
+        return response
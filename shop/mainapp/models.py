@@ -1,15 +1,17 @@
-import sys
-from PIL import Image
+from functools import partial
+
+from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 
-from django.db import models
+from django.core.cache import cache
+from django.db import connection, models, transaction
 from django.contrib.auth import get_user_model
 from django.urls import reverse
 from django.utils import timezone
-from django.core.files.uploadedfile import InMemoryUploadedFile
 
-from io import BytesIO
+from . import metrics, page_cache, thumbnails
+from .product_types import registry as product_types
 
 
 # использование юзера из настроек (в начале создания проекта, был создан суперюзер)
@@ -17,30 +19,54 @@ from io import BytesIO
 User = get_user_model()
 
 
-def get_models_for_count(*model_names):
-    return [models.Count(model_name) for model_name in model_names]
+def get_product_models():
+    # все конкретные модели товаров приложения (Refrigerator, Washer, Dishwasher)
+    return product_types.models()
 
 
 class LatestProductsManager:
+    CACHE_KEY = 'latest_products_for_main_page'
 
     @staticmethod
     def get_products_for_main_page(*args, **kwargs):
         # приоритет выдачи списка из 5 товаров
         with_respect_to = kwargs.get('with_respect_to')
-        # список всех объектов моделей, для которых хотим вывести товары на главной странице
-        products = []
-        ct_models = ContentType.objects.filter(model__in=args)
-        for ct_model in ct_models:
-            model_products = ct_model.model_class()._base_manager.all().order_by('-id')[:5]
-            products.extend(model_products)
-        if with_respect_to:
-            ct_model = ContentType.objects.filter(model=with_respect_to)
-            if ct_model.exists():
-                if with_respect_to in args:
-                    return sorted(
-                        products, key=lambda x: x.__class__._meta.model_name.startswith(with_respect_to), reverse=True
-                    )
-        return products
+        key = (args, with_respect_to)
+        feed = cache.get(LatestProductsManager.CACHE_KEY) or {}
+        metrics.record_cache('latest_products', key in feed)
+        if key not in feed:
+            feed[key] = LatestProductsManager._fetch_cards(args, with_respect_to)
+            cache.set(LatestProductsManager.CACHE_KEY, feed, None)
+        return feed[key]
+
+    @staticmethod
+    def invalidate_cache():
+        cache.delete(LatestProductsManager.CACHE_KEY)
+
+    @staticmethod
+    def _fetch_cards(model_names, with_respect_to=None, limit=5):
+        # по 5 последних карточек каждого типа из общего каталога одним запросом UNION ALL;
+        # тип with_respect_to идет первым
+        if with_respect_to in model_names:
+            model_names = (with_respect_to,) + tuple(name for name in model_names if name != with_respect_to)
+        types = [product_types.get(name) for name in model_names if product_types.get(name) is not None]
+        if not types:
+            return []
+        qn = connection.ops.quote_name
+        branches, params = [], []
+        for branch, product_type in enumerate(types):
+            branches.append(
+                'SELECT * FROM (SELECT {branch} AS branch, item.* FROM {catalog} AS item '
+                'WHERE item.{type_id} = %s ORDER BY item.{pk} DESC LIMIT {limit}) AS {alias}'.format(
+                    branch=branch, catalog=qn(CatalogItem._meta.db_table), pk=qn('id'),
+                    type_id=qn('content_type_id'), limit=int(limit), alias=qn('feed_{}'.format(branch))
+                )
+            )
+            params.append(product_type.content_type_id)
+        sql = 'SELECT * FROM ({}) AS {} ORDER BY branch, {} DESC'.format(
+            ' UNION ALL '.join(branches), qn('feed'), qn('id')
+        )
+        return list(CatalogItem.objects.raw(sql, params))
 
 
 class LatestProducts:
@@ -48,29 +74,47 @@ class LatestProducts:
 
 
 class CategoryManager(models.Manager):
-    CATEGORY_NAME_COUNT_NAME = {
-        'Холодильники': 'refrigerator__count',
-        'Стиральные машины': 'washer__count',
-        'Посудомоечные машины': 'dishwasher__count'
-    }
+    SIDEBAR_CACHE_KEY = 'categories_for_up_sidebar'
 
     def get_queryset(self):
         return super().get_queryset()
 
     def get_categories_for_up_sidebar(self):
-        models = get_models_for_count('dishwasher', 'refrigerator', 'washer')
-        qs = list(self.get_queryset().annotate(*models))
-        data = [
-            dict(name=c.name, url=c.get_absolute_url(), count=getattr(c, self.CATEGORY_NAME_COUNT_NAME[c.name]))
-            for c in qs
-        ]
+        # количество товаров хранится в самой категории, а готовый список - в кэше до явной инвалидации
+        data = cache.get(self.SIDEBAR_CACHE_KEY)
+        metrics.record_cache('sidebar', data is not None)
+        if data is None:
+            qs = self.get_queryset().only('name', 'slug', 'products_count')
+            data = [dict(name=c.name, url=c.get_absolute_url(), count=c.products_count) for c in qs]
+            cache.set(self.SIDEBAR_CACHE_KEY, data, None)
         return data
 
+    def invalidate_sidebar_cache(self):
+        cache.delete(self.SIDEBAR_CACHE_KEY)
+        page_cache.bump_versions(page_cache.SIDEBAR_SCOPE)
+
+    def change_products_count(self, category_id, delta):
+        self.get_queryset().filter(pk=category_id).update(products_count=models.F('products_count') + delta)
+
+    def recalc_products_count(self, *category_ids):
+        # полный пересчет счетчиков (для восстановления после загрузки фикстур и т.п.)
+        categories = self.get_queryset()
+        if category_ids:
+            categories = categories.filter(pk__in=category_ids)
+        counts = dict.fromkeys(categories.values_list('pk', flat=True), 0)
+        qs = CatalogItem.objects.filter(category__in=counts).values('category').annotate(count=models.Count('id'))
+        for row in qs:
+            counts[row['category']] += row['count']
+        for category_id, count in counts.items():
+            self.get_queryset().filter(pk=category_id).update(products_count=count)
+
 
 class Category(models.Model):
     name = models.CharField(max_length=255, verbose_name='Имя категории')
     # url .../categories/slug, только адекватное имя вместо slug
     slug = models.SlugField(unique=True)
+    # денормализованный счетчик товаров, обновляется сигналами моделей товаров
+    products_count = models.PositiveIntegerField(default=0, editable=False)
     objects = CategoryManager()
 
     def __str__(self):
@@ -86,6 +130,40 @@ class Category(models.Model):
     #     ).prefeatch_related('category').value('feature_key', 'feature_measure', 'feature_name', 'filter_type')
 
 
+class CatalogItem(models.Model):
+    # карточка товара любого типа в общей таблице: списки, корзина и поиск читают одну
+    # индексированную таблицу, а характеристики по-прежнему берутся из таблицы своего типа.
+    # Поддерживается сигналами моделей товаров (mainapp.catalog)
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    content_object = GenericForeignKey('content_type', 'object_id')
+    category = models.ForeignKey(Category, verbose_name='Категория', on_delete=models.CASCADE)
+    title = models.CharField(max_length=255, verbose_name='Наименование')
+    slug = models.SlugField()
+    price = models.DecimalField(max_digits=9, decimal_places=2, verbose_name='Цена')
+    image = models.ImageField(verbose_name='Изображение')
+
+    class Meta:
+        unique_together = ('content_type', 'object_id')
+        indexes = [
+            # страницы категории: новинки и сортировка по цене
+            models.Index(fields=['category', '-id'], name='catalogitem_category_id_idx'),
+            models.Index(fields=['category', 'price', 'id'], name='catalogitem_category_price_idx'),
+            # товар по адресу /<тип>/<slug>/ и последние товары типа для главной
+            models.Index(fields=['content_type', 'slug'], name='catalogitem_type_slug_idx'),
+            models.Index(fields=['content_type', '-id'], name='catalogitem_type_id_idx'),
+        ]
+
+    def __str__(self):
+        return self.title
+
+    def get_model_name(self):
+        return product_types.for_content_type_id(self.content_type_id).name
+
+    def get_absolute_url(self):
+        return reverse('product_detail', kwargs={'ct_model': self.get_model_name(), 'slug': self.slug})
+
+
 class Product(models.Model):
     # масштабирование всех картинок до 700х400
     THUMBNAIL_SIZE = (300, 400)
@@ -101,34 +179,59 @@ class Product(models.Model):
     image = models.ImageField(verbose_name='Изображение')
     description = models.TextField(verbose_name='Описание', null=True)
     price = models.DecimalField(max_digits=9, decimal_places=2, verbose_name='Цена')
+    # sha256 исходной картинки, по которой построена (или строится) текущая миниатюра
+    image_hash = models.CharField(max_length=64, blank=True, editable=False)
+    # время последнего изменения: версия для кэшей отображения товара
+    # (не auto_now, чтобы фикстуры без этого поля загружались)
+    updated_at = models.DateTimeField(default=timezone.now, editable=False)
 
     def __str__(self):
         return self.title
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # исходные значения из БД, чтобы при сохранении видеть, что изменилось
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
     def get_model_name(self):
         return self.__class__.__name__.lower()
 
     def save(self, *args, **kwargs):
-        # уменьшение картинки до нужных размеров
-        background = Image.new('RGB', self.THUMBNAIL_SIZE, "white")
-        source_image = Image.open(self.image).convert("RGB")
-        source_image.thumbnail(self.THUMBNAIL_SIZE)
-        (w, h) = source_image.size
-        background.paste(source_image, ((self.THUMBNAIL_SIZE[0] - w) // 2, (self.THUMBNAIL_SIZE[1] - h) // 2))
-        filestream = BytesIO()
-        background.save(filestream, 'JPEG', quality=90)
-        filestream.seek(0)
-        name = '{}.{}'.format(*self.image.name.split('.'))
-        self.image = InMemoryUploadedFile(
-            filestream, 'ImageField', name, 'jpeg/image', sys.getsizeof(filestream), None
-        )
+        data = None
+        if self.image and not self.image._committed:
+            # загружена новая картинка: миниатюра строится, только если изменилось ее содержимое
+            self.image.seek(0)
+            data = self.image.read()
+            digest = thumbnails.image_digest(data)
+            old_name = getattr(self, '_loaded_values', {}).get('image')
+            if digest == self.image_hash and isinstance(old_name, str) and old_name:
+                self.image = old_name
+                data = None
+            else:
+                self.image_hash = digest
+        self.updated_at = timezone.now()
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'updated_at'}
         super().save(*args, **kwargs)
+        if data is not None and settings.THUMBNAIL_BACKGROUND:
+            # исходник уже сохранен, миниатюры строятся в пуле процессов после фиксации транзакции
+            transaction.on_commit(partial(thumbnails.schedule_thumbnail, type(self), self.pk, self.image_hash, data))
+        elif data is not None:
+            derivatives = thumbnails.render_derivatives(data, self.THUMBNAIL_SIZE)
+            self.image = thumbnails.store_derivatives(type(self), self.pk, self.image_hash, derivatives)
+        self._loaded_values = dict(
+            getattr(self, '_loaded_values', {}), category_id=self.category_id, image=self.image.name
+        )
 
     def get_absolute_url(self):
         return reverse('product_detail', kwargs={'slug': self.slug})
 
 
 class Refrigerator(Product):
+    CATEGORY_SLUG = 'refrigerators'
+
     overall_volume = models.CharField(max_length=255, verbose_name='Общий объем')
     useful_volume = models.CharField(max_length=255, verbose_name='Полезный объем')
     control = models.CharField(max_length=255, verbose_name='Тип управления')
@@ -144,6 +247,8 @@ class Refrigerator(Product):
 
 
 class Washer(Product):
+    CATEGORY_SLUG = 'washers'
+
     max_loading = models.CharField(max_length=255, verbose_name='Максимальный объем загрузки')
     max_spin_speed = models.CharField(max_length=255, verbose_name='Максимальная скорость отжима')
     number_of_programs = models.CharField(max_length=255, verbose_name='Количество программ стирки')
@@ -159,6 +264,8 @@ class Washer(Product):
 
 
 class Dishwasher(Product):
+    CATEGORY_SLUG = 'dishwashers'
+
     max_load = models.CharField(max_length=255, verbose_name='Максимальная загрузка (комплекты посуды)')
     drying = models.BooleanField(default=True, verbose_name='Наличие сушки')
     drying_type = models.CharField(max_length=255, null=True, blank=True, verbose_name='Тип сушки')
@@ -184,14 +291,27 @@ class CartProduct(models.Model):
     object_id = models.PositiveIntegerField()
     content_object = GenericForeignKey('content_type', 'object_id')
     #product = models.ForeignKey(Product, verbose_name='Товар', on_delete=models.CASCADE)
+    # карточка товара из общего каталога: строки корзин и заказов выводятся вместе с ней одним JOIN
+    catalog_item = models.ForeignKey(
+        CatalogItem, null=True, blank=True, editable=False, on_delete=models.SET_NULL, related_name='+'
+    )
     qty = models.PositiveIntegerField(default=1)
     final_price = models.DecimalField(max_digits=9, decimal_places=2, verbose_name='Общая стоимость')
 
+    class Meta:
+        # одна строка на товар в корзине: на ней держатся INSERT ... ON CONFLICT в utils.add_cart_line
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'content_type', 'object_id'], name='cartproduct_unique_line')
+        ]
+
     def __str__(self):
         return "Продукт: {} (для корзины)".format(self.content_object.title)
 
     def save(self, *args, **kwargs):
-        self.final_price = self.qty * self.content_object.price
+        # цена берется из карточки каталога; если карточка уже присвоена, повторного запроса не будет
+        if self.catalog_item_id is None:
+            self.catalog_item = CatalogItem.objects.get(content_type_id=self.content_type_id, object_id=self.object_id)
+        self.final_price = self.qty * self.catalog_item.price
         super().save(*args, **kwargs)
 
 
@@ -254,11 +374,95 @@ class Order(models.Model):
     comment = models.TextField(verbose_name='Комментарий к заказу', null=True, blank=True)
     created_at = models.DateTimeField(auto_now=True, verbose_name='Дата создания заказа')
     order_date = models.DateField(verbose_name='Дата получения заказа', default=timezone.now)
+    idempotency_key = models.CharField(max_length=64, null=True, blank=True, verbose_name='Ключ идемпотентности')
+
+    class Meta:
+        # история заказов покупателя выбирается постранично по (customer, -id)
+        indexes = [models.Index(fields=['customer', '-id'], name='order_customer_id_idx')]
+        # повторная отправка оформления с тем же ключом не создает второй заказ
+        constraints = [
+            models.UniqueConstraint(fields=['customer', 'idempotency_key'], name='order_customer_idempotency_key')
+        ]
 
     def __str__(self):
         return str(self.id)
 
 
+class SpecValue(models.Model):
+    # числовое значение характеристики товара, разобранное из текстового поля ("500 л" -> 500, "л")
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    key = models.CharField(max_length=64)
+    value = models.DecimalField(max_digits=12, decimal_places=3)
+    unit = models.CharField(max_length=32, blank=True)
+
+    class Meta:
+        unique_together = ('content_type', 'object_id', 'key')
+        # фильтр по диапазону значения характеристики внутри типа товара
+        indexes = [models.Index(fields=['content_type', 'key', 'value', 'object_id'], name='specvalue_range_idx')]
+
+    def __str__(self):
+        return '{} = {} {}'.format(self.key, self.value, self.unit)
+
+
+class SearchDocument(models.Model):
+    # проиндексированный товар (любого типа)
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    content_object = GenericForeignKey('content_type', 'object_id')
+
+    class Meta:
+        unique_together = ('content_type', 'object_id')
+
+    def __str__(self):
+        return '{} {}'.format(self.content_type.model, self.object_id)
+
+
+class SearchTerm(models.Model):
+    # инвертированный индекс: нормализованное слово -> документ с весом (сколько раз и где встретилось)
+    term = models.CharField(max_length=64)
+    document = models.ForeignKey(SearchDocument, on_delete=models.CASCADE, related_name='terms')
+    weight = models.PositiveIntegerField()
+
+    class Meta:
+        indexes = [models.Index(fields=['term', 'document'], name='searchterm_term_document_idx')]
+
+    def __str__(self):
+        return self.term
+
+
+class OutgoingEmail(models.Model):
+    # письмо в очереди на отправку (см. outbox.py): сохраняется в той же транзакции, что и данные,
+    # поэтому не теряется при перезапуске процесса
+    STATUS_PENDING = 'pending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (STATUS_PENDING, 'Ожидает отправки'),
+        (STATUS_SENT, 'Отправлено'),
+        (STATUS_FAILED, 'Не удалось отправить')
+    )
+
+    subject = models.CharField(max_length=255, verbose_name='Тема')
+    body = models.TextField(verbose_name='Текст')
+    from_email = models.CharField(max_length=255, verbose_name='Отправитель')
+    recipients = models.JSONField(default=list, verbose_name='Получатели')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING, verbose_name='Статус')
+    attempts = models.PositiveIntegerField(default=0, verbose_name='Попыток отправки')
+    next_attempt_at = models.DateTimeField(default=timezone.now, verbose_name='Следующая попытка')
+    last_error = models.TextField(blank=True, verbose_name='Последняя ошибка')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Создано')
+    sent_at = models.DateTimeField(null=True, blank=True, verbose_name='Отправлено')
+
+    class Meta:
+        # выборка очередной пачки: ожидающие письма, у которых подошло время попытки
+        indexes = [models.Index(fields=['status', 'next_attempt_at'], name='outgoingemail_due_idx')]
+
+    def __str__(self):
+        return '{} -> {}'.format(self.subject, ', '.join(self.recipients))
+
+
 # class ProductFeatures(models.Model):
 #
 #     RADIO = 'radio'
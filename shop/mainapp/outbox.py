@@ -0,0 +1,132 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import OutgoingEmail
+
+logger = logging.getLogger(__name__)
+
+# очередь писем: enqueue сохраняет письмо в БД, send_batch отправляет пачку через одно
+# SMTP-соединение. Доставка "хотя бы один раз": письмо, отправленное перед падением процесса,
+# но не отмеченное, уйдет повторно после окончания аренды
+BATCH_SIZE = 50
+MAX_ATTEMPTS = 5
+# задержка повтора после ошибки удваивается: 1, 2, 4, 8 мин.
+RETRY_DELAY = timedelta(minutes=1)
+# взятые в отправку письма не выдаются другим обработчикам это время
+LEASE = timedelta(minutes=5)
+
+_executor = None
+_lock = threading.Lock()
+_queued = 0
+
+
+def enqueue(subject, body, recipients, from_email=None):
+    email = OutgoingEmail.objects.create(
+        subject=subject, body=body, recipients=list(recipients), from_email=from_email or settings.EMAIL_HOST_USER
+    )
+    if settings.EMAIL_OUTBOX_BACKGROUND:
+        transaction.on_commit(wake_worker)
+    return email
+
+
+def to_message(email):
+    return EmailMessage(email.subject, email.body, email.from_email, email.recipients)
+
+
+def claim_batch(batch_size=BATCH_SIZE):
+    # письма, которые пора отправить; заблокированные другим обработчиком пропускаются,
+    # а взятые откладываются на LEASE, чтобы их не отправили дважды одновременно
+    now = timezone.now()
+    with transaction.atomic():
+        emails = list(
+            OutgoingEmail.objects.select_for_update(skip_locked=True).filter(
+                status=OutgoingEmail.STATUS_PENDING, next_attempt_at__lte=now
+            ).order_by('next_attempt_at', 'pk')[:batch_size]
+        )
+        OutgoingEmail.objects.filter(pk__in=[email.pk for email in emails]).update(next_attempt_at=now + LEASE)
+    return emails
+
+
+def send_batch(batch_size=BATCH_SIZE):
+    # одна пачка через одно соединение; возвращает (отправлено, ошибок)
+    emails = claim_batch(batch_size)
+    if not emails:
+        return 0, 0
+    sent, errors = [], {}
+    try:
+        with get_connection(fail_silently=False) as connection:
+            for email in emails:
+                try:
+                    connection.send_messages([to_message(email)])
+                except Exception as error:
+                    errors[email.pk] = error
+                else:
+                    sent.append(email.pk)
+    except Exception as error:
+        # соединение не открылось или оборвалось - неотправленные письма уходят на повтор
+        for email in emails:
+            if email.pk not in sent:
+                errors.setdefault(email.pk, error)
+    now = timezone.now()
+    OutgoingEmail.objects.filter(pk__in=sent).update(
+        status=OutgoingEmail.STATUS_SENT, sent_at=now, attempts=F('attempts') + 1, last_error=''
+    )
+    failed = [email for email in emails if email.pk in errors]
+    for email in failed:
+        email.attempts += 1
+        email.last_error = repr(errors[email.pk])
+        if email.attempts >= MAX_ATTEMPTS:
+            email.status = OutgoingEmail.STATUS_FAILED
+        else:
+            email.next_attempt_at = now + RETRY_DELAY * 2 ** (email.attempts - 1)
+        logger.warning('Письмо %s не отправлено (попытка %s): %s', email.pk, email.attempts, email.last_error)
+    OutgoingEmail.objects.bulk_update(failed, ['attempts', 'last_error', 'status', 'next_attempt_at'])
+    return len(sent), len(failed)
+
+
+def drain(batch_size=BATCH_SIZE):
+    # пачки подряд, пока есть письма, которые пора отправить
+    total_sent, total_failed = 0, 0
+    while True:
+        sent, failed = send_batch(batch_size)
+        if not sent and not failed:
+            return total_sent, total_failed
+        total_sent, total_failed = total_sent + sent, total_failed + failed
+
+
+def get_executor():
+    # число одновременных отправок в процессе ограничено EMAIL_OUTBOX_WORKERS
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.EMAIL_OUTBOX_WORKERS, thread_name_prefix='outbox')
+    return _executor
+
+
+def wake_worker():
+    # если разбор очереди уже ждет в пуле, он заберет и новое письмо - второй не нужен
+    global _queued
+    with _lock:
+        if _queued:
+            return
+        _queued += 1
+    get_executor().submit(_drain_in_background)
+
+
+def _drain_in_background():
+    global _queued
+    with _lock:
+        _queued -= 1
+    try:
+        drain()
+    except Exception:
+        logger.exception('Не удалось разобрать очередь писем')
+    finally:
+        connections.close_all()
@@ -0,0 +1,55 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+
+# версии (счетчики изменений) входят в ключи закэшированных страниц и фрагментов:
+# вместо поиска и удаления старых записей достаточно увеличить счетчик
+VERSION_KEY = 'cache_version_{}'
+PAGE_KEY = 'page_{}'
+SIDEBAR_SCOPE = 'sidebar'
+PAGE_CACHE_TIMEOUT = getattr(settings, 'PAGE_CACHE_TIMEOUT', 10 * 60)
+
+
+def product_scope(model):
+    return 'products_{}'.format(model._meta.model_name)
+
+
+def _initial_version():
+    # счетчик, вытесненный из кэша, не должен начаться заново с уже использованного значения
+    return time.time_ns() // 1000
+
+
+def get_versions(scopes):
+    keys = [VERSION_KEY.format(scope) for scope in scopes]
+    found = cache.get_many(keys)
+    for key in keys:
+        if key not in found:
+            cache.add(key, _initial_version(), None)
+            found[key] = cache.get(key)
+    return '.'.join(str(found[key]) for key in keys)
+
+
+def bump_versions(*scopes):
+    for scope in scopes:
+        key = VERSION_KEY.format(scope)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _initial_version(), None)
+
+
+def is_page_cacheable(request):
+    # страница целиком кэшируется только для анонимов и без ожидающих показа сообщений
+    return (
+        request.method in ('GET', 'HEAD')
+        and not request.user.is_authenticated
+        and not len(get_messages(request))
+    )
+
+
+def get_page_key(request, version):
+    key = '{}:{}'.format(version, request.get_full_path())
+    return PAGE_KEY.format(hashlib.md5(key.encode()).hexdigest())
@@ -0,0 +1,68 @@
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+
+# реестр типов товаров: имя типа в URL, slug категории и ContentType для каждой модели товара.
+# Модели берутся из реестра приложений один раз; id ContentType - из кэша ContentTypeManager,
+# который заполняется одним запросом при первом обращении и дальше в БД не ходит
+
+
+class ProductType:
+
+    def __init__(self, model):
+        self.model = model
+        self.name = model._meta.model_name
+        self.category_slug = model.CATEGORY_SLUG
+
+    def __repr__(self):
+        return '<ProductType {}>'.format(self.name)
+
+    @property
+    def content_type(self):
+        return ContentType.objects.get_for_model(self.model)
+
+    @property
+    def content_type_id(self):
+        return self.content_type.pk
+
+
+class ProductTypeRegistry:
+
+    def __init__(self):
+        self._types = None
+
+    def _load(self):
+        if self._types is None:
+            from .models import Product
+            self._types = [
+                ProductType(model) for model in apps.get_app_config('mainapp').get_models()
+                if issubclass(model, Product)
+            ]
+            self._by_name = {product_type.name: product_type for product_type in self._types}
+            self._by_category_slug = {product_type.category_slug: product_type for product_type in self._types}
+        return self._types
+
+    def all(self):
+        return list(self._load())
+
+    def models(self):
+        return [product_type.model for product_type in self._load()]
+
+    def get(self, name):
+        # тип по имени из URL (/products/<name>/...); None, если такого типа нет
+        self._load()
+        return self._by_name.get(name)
+
+    def for_category(self, slug):
+        self._load()
+        return self._by_category_slug.get(slug)
+
+    def for_content_type_id(self, content_type_id):
+        self.warm_up()
+        return self.get(ContentType.objects.get_for_id(content_type_id).model)
+
+    def warm_up(self):
+        # ContentType всех типов товаров одним запросом (дальше - из кэша ContentTypeManager)
+        ContentType.objects.get_for_models(*self.models())
+
+
+registry = ProductTypeRegistry()
@@ -0,0 +1,161 @@
+import re
+from collections import Counter
+from itertools import islice
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.db.models import Count, Q, Sum
+
+from .models import CatalogItem, SearchDocument, SearchTerm
+from .templatetags.specifications import PRODUCT_SPEC
+
+# вес слова в зависимости от того, где оно встретилось
+TITLE_WEIGHT = 5
+SPEC_WEIGHT = 2
+DESCRIPTION_WEIGHT = 1
+
+MAX_TERM_LENGTH = SearchTerm._meta.get_field('term').max_length
+MIN_STEM_LENGTH = 3
+BATCH_SIZE = 2000
+
+TOKEN_RE = re.compile(r'\w+')
+# упрощенный стемминг: отбрасываются типичные русские окончания (самые длинные проверяются первыми)
+ENDINGS = sorted((
+    'ами', 'ями', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ой', 'ей', 'ий', 'ый', 'ая', 'яя', 'ое', 'ее',
+    'ые', 'ие', 'ах', 'ях', 'ам', 'ям', 'ом', 'ем', 'ов', 'ев', 'ую', 'юю', 'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь'
+), key=len, reverse=True)
+
+
+def normalize(token):
+    token = token.lower().replace('ё', 'е')
+    if token.isalpha():
+        for ending in ENDINGS:
+            if token.endswith(ending) and len(token) - len(ending) >= MIN_STEM_LENGTH:
+                token = token[:-len(ending)]
+                break
+    return token[:MAX_TERM_LENGTH]
+
+
+def tokenize(text):
+    return [normalize(token) for token in TOKEN_RE.findall(text or '')]
+
+
+def document_terms(product):
+    # слова товара с весами: название, описание и значения характеристик
+    weights = Counter()
+    for term in tokenize(product.title):
+        weights[term] += TITLE_WEIGHT
+    for term in tokenize(product.description):
+        weights[term] += DESCRIPTION_WEIGHT
+    for field_name in PRODUCT_SPEC.get(product._meta.model_name, {}).values():
+        value = getattr(product, field_name)
+        if isinstance(value, str):
+            for term in tokenize(value):
+                weights[term] += SPEC_WEIGHT
+    return weights
+
+
+def get_indexed_fields(model):
+    return {'title', 'description'} | set(PRODUCT_SPEC.get(model._meta.model_name, {}).values())
+
+
+def index_products(products, replace=True):
+    # (пере)индексация пачки товаров одного типа: документы создаются один раз, слова заменяются целиком;
+    # replace=False - индекс этих товаров заведомо пуст (полное перестроение)
+    products = list(products)
+    if not products:
+        return
+    content_type = ContentType.objects.get_for_model(products[0])
+    ids = [product.pk for product in products]
+    with transaction.atomic():
+        documents = {}
+        if replace:
+            documents = dict(
+                SearchDocument.objects.filter(
+                    content_type=content_type, object_id__in=ids
+                ).values_list('object_id', 'pk')
+            )
+        missing = [SearchDocument(content_type=content_type, object_id=pk) for pk in ids if pk not in documents]
+        if missing:
+            SearchDocument.objects.bulk_create(missing, batch_size=BATCH_SIZE)
+            documents = dict(
+                SearchDocument.objects.filter(
+                    content_type=content_type, object_id__in=ids
+                ).values_list('object_id', 'pk')
+            )
+        if replace:
+            SearchTerm.objects.filter(document__in=documents.values()).delete()
+        _insert_terms(
+            (term, documents[product.pk], weight)
+            for product in products
+            for term, weight in document_terms(product).items()
+        )
+
+
+def _insert_terms(rows):
+    # слов в индексе на порядок больше, чем товаров, поэтому они пишутся executemany без создания объектов моделей
+    qn = connection.ops.quote_name
+    sql = 'INSERT INTO {} ({}, {}, {}) VALUES (%s, %s, %s)'.format(
+        qn(SearchTerm._meta.db_table), qn('term'), qn('document_id'), qn('weight')
+    )
+    rows = iter(rows)
+    with connection.cursor() as cursor:
+        while True:
+            batch = list(islice(rows, BATCH_SIZE))
+            if not batch:
+                break
+            cursor.executemany(sql, batch)
+
+
+def index_product(product):
+    index_products([product])
+
+
+def remove_product(product):
+    content_type = ContentType.objects.get_for_model(product)
+    documents = SearchDocument.objects.filter(content_type=content_type, object_id=product.pk)
+    SearchTerm.objects.filter(document__in=documents).delete()
+    documents.delete()
+
+
+def rebuild_index(models, chunk_size=BATCH_SIZE):
+    SearchTerm.objects.all().delete()
+    SearchDocument.objects.all().delete()
+    total = 0
+    for model in models:
+        chunk = []
+        for product in model._base_manager.order_by('pk').iterator(chunk_size=chunk_size):
+            chunk.append(product)
+            if len(chunk) == chunk_size:
+                index_products(chunk, replace=False)
+                total, chunk = total + len(chunk), []
+        index_products(chunk, replace=False)
+        total += len(chunk)
+    return total
+
+
+def search(query):
+    # ранжирование: сначала документы, где нашлось больше слов запроса, затем по сумме весов
+    terms = set(tokenize(query))
+    return SearchTerm.objects.filter(term__in=terms).values('document').annotate(
+        matched=Count('id'), score=Sum('weight')
+    ).order_by('-matched', '-score', 'document')
+
+
+def load_results(rows):
+    # карточки для строк результата из общего каталога: два запроса при любом числе типов товаров
+    rows = list(rows)
+    documents = SearchDocument.objects.filter(pk__in=[row['document'] for row in rows]).values_list(
+        'pk', 'content_type_id', 'object_id'
+    )
+    keys = {(content_type_id, object_id): pk for pk, content_type_id, object_id in documents}
+    if not keys:
+        return []
+    object_ids = {}
+    for content_type_id, object_id in keys:
+        object_ids.setdefault(content_type_id, []).append(object_id)
+    condition = Q()
+    for content_type_id, ids in object_ids.items():
+        condition |= Q(content_type_id=content_type_id, object_id__in=ids)
+    items = {keys[item.content_type_id, item.object_id]: item for item in CatalogItem.objects.filter(condition)}
+    return [items[row['document']] for row in rows if row['document'] in items]
@@ -0,0 +1,93 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from . import catalog, page_cache, search, specs
+from .models import Category, LatestProducts, get_product_models
+
+
+def update_catalog_on_save(sender, instance, update_fields, **kwargs):
+    if update_fields and not set(catalog.CARD_FIELDS) & set(update_fields):
+        return
+    catalog.sync_product(instance)
+
+
+def update_catalog_on_delete(sender, instance, **kwargs):
+    catalog.remove_product(instance)
+
+
+def update_category_counters_on_save(sender, instance, created, raw, **kwargs):
+    counters_changed = True
+    if raw:
+        # loaddata: объект мог уже существовать, поэтому просто пересчитываем категорию
+        Category.objects.recalc_products_count(instance.category_id)
+    elif created:
+        Category.objects.change_products_count(instance.category_id, 1)
+    else:
+        old_category_id = getattr(instance, '_loaded_values', {}).get('category_id')
+        counters_changed = old_category_id is not None and old_category_id != instance.category_id
+        if counters_changed:
+            Category.objects.change_products_count(old_category_id, -1)
+            Category.objects.change_products_count(instance.category_id, 1)
+    # меню категорий показывает только счетчики, поэтому прочие изменения его не сбрасывают
+    if counters_changed:
+        Category.objects.invalidate_sidebar_cache()
+    LatestProducts.objects.invalidate_cache()
+
+
+def update_spec_values_on_save(sender, instance, update_fields, **kwargs):
+    old_category_id = getattr(instance, '_loaded_values', {}).get('category_id')
+    if old_category_id is not None and old_category_id != instance.category_id:
+        specs.invalidate_facets(old_category_id)
+    specs.invalidate_facets(instance.category_id)
+    if update_fields and not specs.get_spec_fields(sender) & set(update_fields):
+        return
+    specs.update_product_specs([instance])
+
+
+def update_spec_values_on_delete(sender, instance, **kwargs):
+    specs.remove_product_specs(instance)
+    specs.invalidate_facets(instance.category_id)
+
+
+def invalidate_product_pages(sender, **kwargs):
+    # страницы и фрагменты с товарами этого типа (главная, категория, карточка товара)
+    page_cache.bump_versions(page_cache.product_scope(sender))
+
+
+def update_category_counters_on_delete(sender, instance, **kwargs):
+    Category.objects.change_products_count(instance.category_id, -1)
+    Category.objects.invalidate_sidebar_cache()
+    LatestProducts.objects.invalidate_cache()
+
+
+def update_search_index_on_save(sender, instance, update_fields, **kwargs):
+    # сохранение только служебных полей (например, картинки) не меняет поисковый документ
+    if update_fields and not search.get_indexed_fields(sender) & set(update_fields):
+        return
+    search.index_product(instance)
+
+
+def update_search_index_on_delete(sender, instance, **kwargs):
+    search.remove_product(instance)
+
+
+# обработчики подключаются только к моделям товаров: слушатель без sender
+# отключил бы быстрое удаление (DELETE без выборки) для всех остальных моделей
+for product_model in get_product_models():
+    # каталог обновляется первым: по нему пересчитываются счетчики категорий
+    post_save.connect(update_catalog_on_save, sender=product_model)
+    post_delete.connect(update_catalog_on_delete, sender=product_model)
+    post_save.connect(update_category_counters_on_save, sender=product_model)
+    post_delete.connect(update_category_counters_on_delete, sender=product_model)
+    post_save.connect(update_search_index_on_save, sender=product_model)
+    post_delete.connect(update_search_index_on_delete, sender=product_model)
+    post_save.connect(update_spec_values_on_save, sender=product_model)
+    post_delete.connect(update_spec_values_on_delete, sender=product_model)
+    post_save.connect(invalidate_product_pages, sender=product_model)
+    post_delete.connect(invalidate_product_pages, sender=product_model)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_sidebar_on_category_change(sender, **kwargs):
+    Category.objects.invalidate_sidebar_cache()
@@ -0,0 +1,153 @@
+import re
+from decimal import Decimal
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Case, Count, DecimalField, F, When
+from django.db.models.functions import Floor
+
+from . import metrics
+from .models import CatalogItem, SpecValue
+from .templatetags.specifications import PRODUCT_SPEC
+
+# характеристики, по которым строятся фильтры категории, и ширина интервала гистограммы
+FACETS = {
+    'refrigerator': (('overall_volume', 50), ('useful_volume', 50), ('noise_level', 2), ('number_of_shelves', 1)),
+    'washer': (('max_loading', 1), ('max_spin_speed', 200), ('number_of_programs', 5), ('water_consumption_per_cycle', 5)),
+    'dishwasher': (('max_load', 2), ('noise_level', 2), ('number_of_programs', 2), ('water_consumption_per_cycle', 2)),
+}
+PRICE_FACET = ('price', 500)
+FACETS_CACHE_KEY = 'category_facets_{}'
+
+VALUE_RE = re.compile(r'^\s*(\d+(?:[.,]\d+)?)\s*(\D*?)[\s.]*$')
+SPEC_VALUE_FIELD = SpecValue._meta.get_field('value')
+
+
+def parse_spec_value(text):
+    # "500 л" -> (Decimal('500'), 'л'); None, если значение не числовое ("нет данных")
+    match = VALUE_RE.match(text or '')
+    if match is None:
+        return None
+    return Decimal(match.group(1).replace(',', '.')), match.group(2).strip()
+
+
+def get_spec_values(product):
+    content_type = ContentType.objects.get_for_model(product)
+    values = []
+    for key in PRODUCT_SPEC.get(product._meta.model_name, {}).values():
+        text = getattr(product, key)
+        parsed = parse_spec_value(text) if isinstance(text, str) else None
+        if parsed is not None:
+            values.append(SpecValue(
+                content_type=content_type, object_id=product.pk, key=key, value=parsed[0], unit=parsed[1]
+            ))
+    return values
+
+
+def get_spec_fields(model):
+    return set(PRODUCT_SPEC.get(model._meta.model_name, {}).values())
+
+
+def update_product_specs(products):
+    # числовые характеристики пачки товаров одного типа пересобираются целиком
+    products = list(products)
+    if not products:
+        return
+    content_type = ContentType.objects.get_for_model(products[0])
+    with transaction.atomic():
+        SpecValue.objects.filter(content_type=content_type, object_id__in=[p.pk for p in products]).delete()
+        SpecValue.objects.bulk_create(
+            (value for product in products for value in get_spec_values(product)), batch_size=2000
+        )
+
+
+def remove_product_specs(product):
+    content_type = ContentType.objects.get_for_model(product)
+    SpecValue.objects.filter(content_type=content_type, object_id=product.pk).delete()
+
+
+def invalidate_facets(category_id):
+    cache.delete(FACETS_CACHE_KEY.format(category_id))
+
+
+def _histogram(rows, width):
+    return [dict(start=row['bucket'], end=row['bucket'] + width, count=row['count']) for row in rows]
+
+
+def get_facets(category, model):
+    # гистограммы по каждой характеристике категории (один сгруппированный запрос) и по цене (еще один);
+    # результат хранится в кэше до изменения товаров категории
+    key = FACETS_CACHE_KEY.format(category.pk)
+    facets = cache.get(key)
+    metrics.record_cache('facets', facets is not None)
+    if facets is not None:
+        return facets
+    widths = dict(FACETS.get(model._meta.model_name, ()))
+    content_type = ContentType.objects.get_for_model(model)
+    # товары одного типа могут быть в разных категориях: учитываются только товары этой
+    rows = SpecValue.objects.filter(
+        content_type=content_type, key__in=widths,
+        object_id__in=CatalogItem.objects.filter(category=category, content_type=content_type).values('object_id')
+    ).annotate(
+        bucket=Case(
+            *[When(key=name, then=Floor(F('value') / width) * width) for name, width in widths.items()],
+            output_field=DecimalField()
+        )
+    ).values('key', 'unit', 'bucket').annotate(count=Count('id')).order_by('key', 'bucket')
+    by_key = {}
+    for row in rows:
+        by_key.setdefault(row['key'], dict(unit=row['unit'], rows=[]))['rows'].append(row)
+    facets = []
+    for name, width in FACETS.get(model._meta.model_name, ()):
+        if name in by_key:
+            facets.append(dict(
+                key=name, name=model._meta.get_field(name).verbose_name, unit=by_key[name]['unit'],
+                buckets=_histogram(by_key[name]['rows'], width)
+            ))
+    price_key, price_width = PRICE_FACET
+    price_rows = CatalogItem.objects.filter(category=category).annotate(
+        bucket=Floor(F(price_key) / price_width) * price_width
+    ).values('bucket').annotate(count=Count('id')).order_by('bucket')
+    facets.append(dict(
+        key=price_key, name=model._meta.get_field(price_key).verbose_name, unit='руб.',
+        buckets=_histogram(price_rows, price_width)
+    ))
+    cache.set(key, facets, None)
+    return facets
+
+
+def parse_filters(model, params):
+    # диапазоны из GET-параметров вида <характеристика>_min / <характеристика>_max
+    filters = {}
+    for name in [name for name, _ in FACETS.get(model._meta.model_name, ())] + [PRICE_FACET[0]]:
+        bounds = []
+        for suffix in ('min', 'max'):
+            try:
+                bounds.append(SPEC_VALUE_FIELD.to_python(params.get('{}_{}'.format(name, suffix)) or None))
+            except ValidationError:
+                bounds.append(None)
+        if bounds != [None, None]:
+            filters[name] = tuple(bounds)
+    return filters
+
+
+def filter_products(queryset, model, filters):
+    # queryset - карточки каталога (CatalogItem) товаров типа model;
+    # цена фильтруется по колонке карточки, характеристики - по индексу SpecValue
+    content_type = ContentType.objects.get_for_model(model)
+    for name, (low, high) in filters.items():
+        if name == PRICE_FACET[0]:
+            if low is not None:
+                queryset = queryset.filter(price__gte=low)
+            if high is not None:
+                queryset = queryset.filter(price__lt=high)
+            continue
+        values = SpecValue.objects.filter(content_type=content_type, key=name)
+        if low is not None:
+            values = values.filter(value__gte=low)
+        if high is not None:
+            values = values.filter(value__lt=high)
+        queryset = queryset.filter(content_type=content_type, object_id__in=values.values('object_id'))
+    return queryset
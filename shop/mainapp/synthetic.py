@@ -0,0 +1,277 @@
+import random
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO
+
+from PIL import Image, UnidentifiedImageError
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from . import thumbnails
+from .models import Cart, CartProduct, CatalogItem, Category, Customer, Order, Refrigerator, Washer, Dishwasher
+
+# синтетический каталог для нагрузочных проверок: товары пишутся через bulk_create,
+# миниатюры строятся один раз на тип товара и общие для всех его строк (без обработки в Product.save)
+BRANDS = (
+    'Bosch', 'Samsung', 'LG', 'Indesit', 'Candy', 'Midea', 'Electrolux', 'Beko', 'Atlant', 'Gorenje', 'Haier',
+    'Hotpoint', 'Whirlpool', 'Siemens', 'Hansa', 'Weissgauff'
+)
+COLORS = ('белый', 'черный', 'серебристый', 'бежевый', 'нержавеющая сталь', 'графит')
+CONTROLS = ('механическое', 'электронное', 'сенсорное')
+FIRST_NAMES = ('Александр', 'Мария', 'Дмитрий', 'Анна', 'Сергей', 'Елена', 'Андрей', 'Ольга', 'Павел', 'Юлия')
+LAST_NAMES = ('Иванов', 'Петрова', 'Сидоров', 'Козлова', 'Новиков', 'Морозова', 'Волков', 'Лебедева', 'Ковалев')
+CITIES = ('Минск', 'Гомель', 'Брест', 'Гродно', 'Витебск', 'Могилев')
+STREETS = ('ул. Ленина', 'пр. Независимости', 'ул. Советская', 'ул. Пушкина', 'пр. Победителей')
+# (статус, вес): в истории в основном завершенные заказы
+ORDER_STATUSES = (
+    (Order.STATUS_COMPLETED, 85), (Order.STATUS_READY, 5), (Order.STATUS_IN_PROGRESS, 5), (Order.STATUS_NEW, 5)
+)
+
+CATALOG = {
+    Refrigerator: {
+        'category': ('refrigerators', 'Холодильники'),
+        'noun': 'Холодильник',
+        'image': 'r_bosh_seria_4.jpeg',
+        'price': (600, 4500),
+        'specs': {
+            'overall_volume': lambda rnd: '{} л'.format(rnd.randint(150, 650)),
+            'useful_volume': lambda rnd: '{} л'.format(rnd.randint(120, 600)),
+            'control': lambda rnd: rnd.choice(CONTROLS),
+            'noise_level': lambda rnd: '{} дБ'.format(rnd.randint(35, 45)),
+            'number_of_shelves': lambda rnd: str(rnd.randint(2, 7)),
+            'number_of_freezer_shelves': lambda rnd: str(rnd.randint(1, 4)),
+        },
+    },
+    Washer: {
+        'category': ('washers', 'Стиральные машины'),
+        'noun': 'Стиральная машина',
+        'image': 'w_Bosch.jpeg',
+        'price': (500, 3000),
+        'specs': {
+            'max_loading': lambda rnd: '{} кг'.format(rnd.randint(5, 12)),
+            'max_spin_speed': lambda rnd: '{} об/мин'.format(rnd.choice((800, 1000, 1200, 1400, 1600))),
+            'number_of_programs': lambda rnd: str(rnd.randint(8, 24)),
+            'shortest_program': lambda rnd: '{} мин.'.format(rnd.choice((12, 15, 20, 30))),
+            'electricity_consumption_per_cycle': lambda rnd: '{:.2f} кВт·ч'.format(rnd.uniform(0.4, 1.2)),
+            'water_consumption_per_cycle': lambda rnd: '{} л'.format(rnd.randint(35, 60)),
+        },
+    },
+    Dishwasher: {
+        'category': ('dishwashers', 'Посудомоечные машины'),
+        'noun': 'Посудомоечная машина',
+        'image': 'dw_Midea.jpeg',
+        'price': (400, 2500),
+        'specs': {
+            'max_load': lambda rnd: str(rnd.randint(6, 16)),
+            'drying': lambda rnd: True,
+            'drying_type': lambda rnd: rnd.choice(('конденсационная', 'турбосушка', 'цеолитовая')),
+            'number_of_programs': lambda rnd: str(rnd.randint(4, 10)),
+            'noise_level': lambda rnd: '{} дБ'.format(rnd.randint(40, 52)),
+            'shortest_program': lambda rnd: '{} мин.'.format(rnd.choice((20, 30, 40, 60))),
+            'water_consumption_per_cycle': lambda rnd: '{:.1f} л'.format(rnd.uniform(6, 14)),
+            'control': lambda rnd: rnd.choice(CONTROLS),
+            'child_lock': lambda rnd: rnd.random() < 0.7,
+        },
+    },
+}
+
+
+def get_categories():
+    categories = {}
+    for model, info in CATALOG.items():
+        slug, name = info['category']
+        categories[model], _ = Category.objects.get_or_create(slug=slug, defaults={'name': name})
+    return categories
+
+
+def read_source_image(storage, name, size):
+    # исходник товара; если его нет или он не читается (в media есть пустые файлы) -
+    # однотонная заглушка размера size
+    if storage.exists(name):
+        with storage.open(name) as file:
+            data = file.read()
+        try:
+            Image.open(BytesIO(data)).verify()
+        except (OSError, UnidentifiedImageError):
+            pass
+        else:
+            return data
+    filestream = BytesIO()
+    Image.new('RGB', size, 'white').save(filestream, 'JPEG')
+    return filestream.getvalue()
+
+
+def prepare_images():
+    # {модель: (имя основной миниатюры, sha256 исходника)}; уже построенные миниатюры не перестраиваются
+    images = {}
+    for model, info in CATALOG.items():
+        storage = model._meta.get_field('image').storage
+        data = read_source_image(storage, info['image'], model.THUMBNAIL_SIZE)
+        digest = thumbnails.image_digest(data)
+        prefix = thumbnails.derivatives_prefix(digest)
+        widths = thumbnails.get_available_widths(storage, prefix)
+        if not widths:
+            derivatives = thumbnails.render_derivatives(data, model.THUMBNAIL_SIZE)
+            for name, content in derivatives.items():
+                if not storage.exists(prefix + name):
+                    storage.save(prefix + name, ContentFile(content))
+            widths = thumbnails.rendered_widths(derivatives)
+        images[model] = (prefix + thumbnails.main_derivative(widths), digest)
+    return images
+
+
+def build_product(model, category, number, rnd, prefix, image):
+    info = CATALOG[model]
+    brand = rnd.choice(BRANDS)
+    code = '{}{}'.format(rnd.choice('ABCDEKMRSTW'), rnd.randint(1000, 99999))
+    fields = dict(
+        category=category,
+        title='{} {} {}'.format(info['noun'], brand, code),
+        slug='{}-{}-{}'.format(model._meta.model_name, prefix, number),
+        image=image[0],
+        image_hash=image[1],
+        description='{} цвет, {} управление'.format(rnd.choice(COLORS).capitalize(), rnd.choice(CONTROLS)),
+        price=Decimal(rnd.randint(info['price'][0] * 100, info['price'][1] * 100)) / 100,
+    )
+    fields.update((name, make_value(rnd)) for name, make_value in info['specs'].items())
+    return model(**fields)
+
+
+def generate_products(per_model, batch_size=5000, seed=None, prefix=None):
+    # создает per_model товаров каждого типа; возвращает префикс их slug
+    rnd = random.Random(seed)
+    prefix = prefix or uuid.uuid4().hex[:8]
+    categories = get_categories()
+    images = prepare_images()
+    for model in CATALOG:
+        for start in range(0, per_model, batch_size):
+            model.objects.bulk_create(
+                build_product(model, categories[model], number, rnd, prefix, images[model])
+                for number in range(start, min(start + batch_size, per_model))
+            )
+    return prefix
+
+
+class KeyAllocator:
+    # первичные ключи назначаются заранее: строки, ссылающиеся друг на друга, пишутся bulk_create
+    # без чтения id обратно (SQLite их не возвращает). Рассчитано на базу без параллельной записи,
+    # счетчики последовательностей выравниваются в reset_sequences
+
+    def __init__(self, models):
+        self.models = models
+        self.next = {
+            model: (model.objects.aggregate(Max('pk'))['pk__max'] or 0) + 1 for model in models
+        }
+
+    def take(self, model):
+        pk = self.next[model]
+        self.next[model] += 1
+        return pk
+
+    def reset_sequences(self):
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), self.models):
+                cursor.execute(sql)
+
+
+# строк корзин и заказов на порядок больше, чем покупателей, поэтому они пишутся executemany
+# кортежами, без создания объектов моделей (как слова поискового индекса)
+CART_COLUMNS = ('id', 'owner_id', 'total_products', 'final_price', 'in_order', 'for_anonymous_user')
+LINE_COLUMNS = ('id', 'user_id', 'cart_id', 'content_type_id', 'object_id', 'catalog_item_id', 'qty', 'final_price')
+CART_LINK_COLUMNS = ('id', 'cart_id', 'cartproduct_id')
+ORDER_COLUMNS = (
+    'id', 'customer_id', 'cart_id', 'first_name', 'last_name', 'phone', 'address', 'status', 'buying_type', 'comment',
+    'created_at', 'order_date'
+)
+ORDER_LINK_COLUMNS = ('id', 'customer_id', 'order_id')
+
+
+def _insert_rows(model, columns, rows):
+    qn = connection.ops.quote_name
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        qn(model._meta.db_table), ', '.join(qn(column) for column in columns), ', '.join(['%s'] * len(columns))
+    )
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+
+
+def build_cart(rows, keys, rnd, items, customer_pk, max_lines, in_order):
+    cart_pk = keys.take(Cart)
+    final_price = 0
+    lines = rnd.sample(items, rnd.randint(1, max_lines))
+    for item_pk, content_type_id, object_id, price in lines:
+        qty = rnd.randint(1, 3)
+        line_pk = keys.take(CartProduct)
+        rows[CartProduct].append(
+            (line_pk, customer_pk, cart_pk, content_type_id, object_id, item_pk, qty, qty * price)
+        )
+        rows[Cart.products.through].append((keys.take(Cart.products.through), cart_pk, line_pk))
+        final_price += qty * price
+    rows[Cart].append((cart_pk, customer_pk, len(lines), final_price, in_order, False))
+    return cart_pk
+
+
+def generate_customers(count, orders_per_customer, max_lines=3, batch_size=5000, seed=None, prefix=None):
+    # создает count покупателей, у каждого открытая корзина и orders_per_customer оформленных заказов
+    # (у каждого заказа своя корзина из 1..max_lines строк) за последние два года;
+    # возвращает префикс имен пользователей
+    rnd = random.Random(seed)
+    prefix = prefix or uuid.uuid4().hex[:8]
+    items = list(CatalogItem.objects.values_list('pk', 'content_type_id', 'object_id', 'price'))
+    if not items:
+        raise ValueError('В каталоге нет товаров')
+    max_lines = min(max_lines, len(items))
+    User = get_user_model()
+    tables = (
+        (Cart, CART_COLUMNS), (CartProduct, LINE_COLUMNS), (Cart.products.through, CART_LINK_COLUMNS),
+        (Order, ORDER_COLUMNS), (Customer.orders.through, ORDER_LINK_COLUMNS)
+    )
+    keys = KeyAllocator((User, Customer) + tuple(model for model, _ in tables))
+    # синтетические пользователи не входят на сайт: хэш пароля не нужен
+    password = make_password(None)
+    statuses, weights = zip(*ORDER_STATUSES)
+    now = timezone.now()
+    # покупателей в пачке столько, чтобы на пачку приходилось около batch_size заказов
+    chunk = max(1, batch_size // max(orders_per_customer, 1))
+    for start in range(0, count, chunk):
+        users, customers, rows = [], [], defaultdict(list)
+        for number in range(start, min(start + chunk, count)):
+            first_name, last_name = rnd.choice(FIRST_NAMES), rnd.choice(LAST_NAMES)
+            user = User(
+                pk=keys.take(User), username='{}-{}'.format(prefix, number), password=password,
+                first_name=first_name, last_name=last_name, email='{}-{}@example.com'.format(prefix, number)
+            )
+            customer = Customer(
+                pk=keys.take(Customer), user_id=user.pk, phone='+375(29){:07d}'.format(rnd.randint(0, 9999999)),
+                address='{}, {}, д. {}'.format(rnd.choice(CITIES), rnd.choice(STREETS), rnd.randint(1, 150))
+            )
+            users.append(user)
+            customers.append(customer)
+            build_cart(rows, keys, rnd, items, customer.pk, max_lines, in_order=False)
+            for _ in range(orders_per_customer):
+                cart_pk = build_cart(rows, keys, rnd, items, customer.pk, max_lines, in_order=True)
+                created_at = now - timedelta(days=rnd.randint(0, 730), seconds=rnd.randint(0, 86399))
+                order_pk = keys.take(Order)
+                rows[Order].append((
+                    order_pk, customer.pk, cart_pk, first_name, last_name, customer.phone, customer.address,
+                    rnd.choices(statuses, weights)[0],
+                    rnd.choice((Order.BUYING_TYPE_SELF, Order.BUYING_TYPE_DELIVERY)), '',
+                    connection.ops.adapt_datetimefield_value(created_at),
+                    connection.ops.adapt_datefield_value((created_at + timedelta(days=rnd.randint(1, 5))).date())
+                ))
+                rows[Customer.orders.through].append((keys.take(Customer.orders.through), customer.pk, order_pk))
+        with transaction.atomic():
+            User.objects.bulk_create(users, batch_size=batch_size)
+            Customer.objects.bulk_create(customers, batch_size=batch_size)
+            # порядок таблиц - порядок внешних ключей
+            for model, columns in tables:
+                _insert_rows(model, columns, rows[model])
+    keys.reset_sequences()
+    return prefix
@@ -0,0 +1,45 @@
+from django import template
+from django.utils.html import format_html, format_html_join
+
+from mainapp import thumbnails
+
+register = template.Library()
+
+# ширина картинки на странице для каждого места вывода (атрибут sizes)
+IMAGE_SIZES = {
+    'card': '(max-width: 768px) 50vw, 300px',
+    'cart': '150px',
+    'detail': '300px',
+}
+
+
+def get_srcset(storage, prefix, extension):
+    return ', '.join(
+        '{} {}w'.format(storage.url('{}{}.{}'.format(prefix, width, extension)), width)
+        for width in thumbnails.get_available_widths(storage, prefix)
+    )
+
+
+# пользовательский тег: <picture> с srcset по всем размерам и форматам миниатюр
+@register.simple_tag
+def product_image(product, place='card', css_class=''):
+    if product is None:
+        # товар удален из каталога - в истории заказов остается строка без картинки
+        return ''
+    image = product.image
+    prefix = thumbnails.get_derivatives_prefix(image.name)
+    if prefix is None:
+        # миниатюры еще строятся - выводится исходная картинка
+        return format_html('<img src="{}" class="{}" alt="">', image.url, css_class)
+    sizes = IMAGE_SIZES[place]
+    sources = format_html_join(
+        '', '<source type="{}" srcset="{}" sizes="{}">',
+        (
+            (mime_type, get_srcset(image.storage, prefix, extension), sizes)
+            for extension, _, mime_type, _ in thumbnails.DERIVATIVE_FORMATS if extension != 'jpeg'
+        )
+    )
+    return format_html(
+        '<picture>{}<img src="{}" srcset="{}" sizes="{}" class="{}" alt=""></picture>',
+        sources, image.url, get_srcset(image.storage, prefix, 'jpeg'), sizes, css_class
+    )
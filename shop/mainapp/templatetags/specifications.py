@@ -1,10 +1,15 @@
 from django import template
+from django.core.cache import cache
+from django.utils.html import conditional_escape
 from django.utils.safestring import mark_safe
 
-from mainapp.models import Dishwasher
+from .. import metrics
 
 register = template.Library()
 
+# старые версии таблиц вытесняются сами (ключ включает время изменения товара)
+SPEC_CACHE_TIMEOUT = 24 * 60 * 60
+
 TABLE_HEAD = """
                 <table class="table">
                   <tbody>
@@ -53,25 +58,48 @@ PRODUCT_SPEC = {
 }
 
 
-def get_product_spec(product, model_name):
-    table_content = ''
-    for name, value in PRODUCT_SPEC[model_name].items():
-        value = getattr(product, value)
-        if value is True:
-            value = 'Да'
-        elif value is False:
-            value = 'Нет'
-        table_content += TABLE_CONTENT.format(name=name, value=value)
-    return table_content
+# характеристики, которые выводятся только при истинном значении другого поля
+SPEC_CONDITIONS = {
+    'dishwasher': {'drying_type': 'drying'},
+}
+
+SPEC_CACHE_KEY = 'product_spec_{}_{}_{}'
+
+
+def compile_spec_plan(model_name):
+    # неизменяемый план таблицы: (название, поле, поле-условие или None) в исходном порядке
+    conditions = SPEC_CONDITIONS.get(model_name, {})
+    return tuple((name, field, conditions.get(field)) for name, field in PRODUCT_SPEC[model_name].items())
+
+
+SPEC_PLANS = {model_name: compile_spec_plan(model_name) for model_name in PRODUCT_SPEC}
+
+
+def format_spec_value(value):
+    if value is True:
+        return 'Да'
+    if value is False:
+        return 'Нет'
+    return conditional_escape(value)
+
+
+def render_product_spec(product, model_name):
+    return TABLE_HEAD + ''.join(
+        TABLE_CONTENT.format(name=name, value=format_spec_value(getattr(product, field)))
+        for name, field, condition in SPEC_PLANS[model_name]
+        if condition is None or getattr(product, condition)
+    ) + TABLE_TAIL
 
 
 # пользовательский фильтр
 @register.filter
 def product_spec(product):
+    # таблица кэшируется до следующего сохранения товара (updated_at)
     model_name = product.__class__._meta.model_name
-    if isinstance(product, Dishwasher):
-        if not product.drying:
-            PRODUCT_SPEC['dishwasher'].pop('Тип сушки')
-        else:
-            PRODUCT_SPEC['dishwasher']['Тип сушки'] = 'drying_type'
-    return mark_safe(TABLE_HEAD + get_product_spec(product, model_name) + TABLE_TAIL)
\ No newline at end of file
+    key = SPEC_CACHE_KEY.format(model_name, product.pk, product.updated_at.timestamp())
+    html = cache.get(key)
+    metrics.record_cache('spec_table', html is not None)
+    if html is None:
+        html = render_product_spec(product, model_name)
+        cache.set(key, html, SPEC_CACHE_TIMEOUT)
+    return mark_safe(html)
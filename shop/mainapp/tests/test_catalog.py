@@ -0,0 +1,66 @@
+from decimal import Decimal
+from io import StringIO
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.test import TestCase
+
+from .. import catalog, page_cache
+from ..models import Cart, CartProduct, CatalogItem, Category, Customer, Refrigerator, User
+from .test_models import TempMediaMixin, make_refrigerator
+
+
+class CatalogTestCases(TempMediaMixin, TestCase):
+
+    def setUp(self) -> None:
+        self.category = Category.objects.create(name='Холодильники', slug='refrigerators')
+        self.other_category = Category.objects.create(name='Акции', slug='sale')
+        self.refrigerator = make_refrigerator(self.category, 'r-1', price=Decimal('1000.00'))
+
+    def get_item(self):
+        return CatalogItem.objects.get(
+            content_type=ContentType.objects.get_for_model(Refrigerator), object_id=self.refrigerator.pk
+        )
+
+    def test_card_follows_product(self):
+        item = self.get_item()
+        self.assertEqual((item.title, item.price, item.image.name), ('Test Refrigerator', Decimal('1000.00'), self.refrigerator.image.name))
+        self.assertEqual(item.get_absolute_url(), '/products/refrigerator/r-1/')
+        self.refrigerator.price = Decimal('900.00')
+        self.refrigerator.category = self.other_category
+        self.refrigerator.save()
+        item = self.get_item()
+        self.assertEqual((item.price, item.category), (Decimal('900.00'), self.other_category))
+        self.refrigerator.delete()
+        self.assertFalse(CatalogItem.objects.exists())
+
+    def test_saving_other_fields_does_not_touch_catalog(self):
+        with self.assertNumQueries(1):
+            self.refrigerator.save(update_fields=['image_hash'])
+
+    def test_rebuild_repairs_catalog(self):
+        CatalogItem.objects.update(title='stale', price=0)
+        make_refrigerator(self.category, 'r-2')
+        CatalogItem.objects.filter(slug='r-2').delete()
+        scope = page_cache.product_scope(Refrigerator)
+        version = page_cache.get_versions([scope])
+        out = StringIO()
+        call_command('rebuild_catalog', stdout=out)
+        self.assertIn('2', out.getvalue())
+        # страницы с товарами, закэшированные до пересборки, больше не отдаются
+        self.assertNotEqual(page_cache.get_versions([scope]), version)
+        self.assertEqual(
+            sorted(CatalogItem.objects.values_list('slug', 'price')),
+            [('r-1', Decimal('1000.00')), ('r-2', Decimal('1000.00'))]
+        )
+        self.assertEqual(Category.objects.get(pk=self.category.pk).products_count, 2)
+
+    def test_cart_lines_are_linked_to_cards(self):
+        customer = Customer.objects.create(user=User.objects.create(username='Bobik'))
+        cart = Cart.objects.create(owner=customer)
+        line = CartProduct.objects.create(user=customer, cart=cart, content_object=self.refrigerator, qty=2)
+        self.assertEqual(line.catalog_item, self.get_item())
+        self.assertEqual(line.final_price, Decimal('2000.00'))
+        CartProduct.objects.update(catalog_item=None)
+        self.assertEqual(catalog.link_cart_products(), 1)
+        self.assertEqual(CartProduct.objects.get().catalog_item, self.get_item())
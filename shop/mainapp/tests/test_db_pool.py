@@ -0,0 +1,157 @@
+import threading
+from unittest import skipUnless
+
+from django.db import connection
+from django.test import SimpleTestCase, TransactionTestCase
+from psycopg2 import OperationalError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS
+
+from ..db_pool.pool import ConnectionPool, PoolTimeout
+
+
+class FakeConnection:
+    # соединение с интерфейсом psycopg2, которое пул использует: состояние транзакции, rollback, SELECT 1
+
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+        self.status = TRANSACTION_STATUS_IDLE
+        self.autocommit = False
+        self.executed = []
+        self.parameters = {'TimeZone': 'UTC', 'client_encoding': 'UTF8'}
+
+    def get_parameter_status(self, name):
+        return self.parameters.get(name)
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.status = TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+class FakeCursor:
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, sql, params=None):
+        if self.connection.broken:
+            raise OperationalError('server closed the connection unexpectedly')
+        self.connection.executed.append(sql)
+        if sql == 'DISCARD ALL':
+            # как на сервере: параметры возвращаются к значениям по умолчанию
+            self.connection.parameters['TimeZone'] = 'Etc/UTC'
+        elif sql.startswith('SELECT set_config'):
+            self.connection.parameters[params[0]] = params[1]
+
+
+class ConnectionPoolTestCases(SimpleTestCase):
+
+    def test_released_connection_is_reused(self):
+        pool = ConnectionPool(max_size=2)
+        first = pool.acquire(FakeConnection)
+        pool.release(first)
+        self.assertIs(pool.acquire(FakeConnection), first)
+        self.assertEqual((pool.stats['connects'], pool.stats['reuses']), (1, 1))
+
+    def test_open_transaction_is_rolled_back_on_release(self):
+        pool = ConnectionPool()
+        first = pool.acquire(FakeConnection)
+        first.status = TRANSACTION_STATUS_INTRANS
+        pool.release(first)
+        self.assertEqual(first.status, TRANSACTION_STATUS_IDLE)
+        self.assertIs(pool.acquire(FakeConnection), first)
+
+    def test_session_state_is_reset_on_release(self):
+        pool = ConnectionPool()
+        first = pool.acquire(FakeConnection)
+        pool.release(first)
+        self.assertTrue(first.autocommit)
+        self.assertEqual(first.executed, ['DISCARD ALL', 'SELECT set_config(%s, %s, false)'])
+        self.assertEqual(first.parameters['TimeZone'], 'UTC')
+        # соединение, которое не удалось сбросить, в пул не возвращается
+        first = pool.acquire(FakeConnection)
+        first.broken = True
+        pool.release(first)
+        self.assertTrue(first.closed)
+        self.assertEqual((pool.size, pool.stats['discards']), (0, 1))
+
+    def test_old_connections_are_recycled(self):
+        pool = ConnectionPool(max_age=0)
+        first = pool.acquire(FakeConnection)
+        pool.release(first)
+        self.assertTrue(first.closed)
+        self.assertIsNot(pool.acquire(FakeConnection), first)
+        self.assertEqual(pool.size, 1)
+
+    def test_broken_connection_is_replaced_after_health_check(self):
+        pool = ConnectionPool(check_interval=0)
+        first = pool.acquire(FakeConnection)
+        pool.release(first)
+        first.broken = True
+        second = pool.acquire(FakeConnection)
+        self.assertIsNot(second, first)
+        self.assertTrue(first.closed)
+        self.assertEqual((pool.size, pool.stats['discards']), (1, 1))
+
+    def test_pool_size_is_bounded(self):
+        pool = ConnectionPool(max_size=1, timeout=0.05)
+        first = pool.acquire(FakeConnection)
+        with self.assertRaises(PoolTimeout):
+            pool.acquire(FakeConnection)
+        # ожидающий поток получает соединение, как только его вернут
+        acquired = []
+        waiter = threading.Thread(target=lambda: acquired.append(pool.acquire(FakeConnection)))
+        pool.timeout = 5
+        waiter.start()
+        pool.release(first)
+        waiter.join()
+        self.assertEqual(acquired, [first])
+        self.assertEqual((pool.size, pool.stats['connects'], pool.stats['timeouts']), (1, 1, 1))
+
+
+@skipUnless(connection.settings_dict['ENGINE'] == 'mainapp.db_pool', 'БД без пула соединений')
+class PooledBackendTestCases(TransactionTestCase):
+
+    def backend_pid(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_backend_pid()')
+            return cursor.fetchone()[0]
+
+    def test_connection_survives_close(self):
+        pid = self.backend_pid()
+        connection.close()
+        self.assertEqual(self.backend_pid(), pid)
+        self.assertIsNotNone(connection.pool)
+
+    def test_session_state_does_not_leak_to_next_request(self):
+        pid = self.backend_pid()
+        with connection.cursor() as cursor:
+            cursor.execute("SET statement_timeout = '1234ms'")
+            cursor.execute('CREATE TEMPORARY TABLE pool_leak (id int)')
+            cursor.execute('SELECT pg_advisory_lock(4242)')
+        connection.close()
+        with connection.cursor() as cursor:
+            self.assertEqual(self.backend_pid(), pid)
+            cursor.execute('SHOW statement_timeout')
+            self.assertEqual(cursor.fetchone()[0], '0')
+            cursor.execute("SELECT to_regclass('pg_temp.pool_leak')")
+            self.assertIsNone(cursor.fetchone()[0])
+            cursor.execute("SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' AND pid = pg_backend_pid()")
+            self.assertEqual(cursor.fetchone()[0], 0)
+            # часовой пояс Django восстановлен без повторного SET при выдаче
+            cursor.execute('SHOW TIME ZONE')
+            self.assertEqual(cursor.fetchone()[0], connection.timezone_name)
@@ -0,0 +1,106 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from django.test import TestCase
+
+from .. import log
+from ..models import Category, Customer, User
+from .test_models import TempMediaMixin, make_refrigerator
+
+
+def make_record(name='mainapp.views.cart', level=logging.INFO, msg='Сообщение %s', args=(1,), **extra):
+    record = logging.LogRecord(name, level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+class LogTestCases(TempMediaMixin, TestCase):
+
+    def test_records_are_json_with_extra_fields(self):
+        record = make_record(request_id='abc', cart=5)
+        data = json.loads(log.JsonFormatter().format(record))
+        self.assertEqual(
+            {key: data[key] for key in ('level', 'logger', 'message', 'request_id', 'cart')},
+            {'level': 'INFO', 'logger': 'mainapp.views.cart', 'message': 'Сообщение 1', 'request_id': 'abc', 'cart': 5}
+        )
+
+    def test_sampling_keeps_whole_requests_and_all_warnings(self):
+        sampling = log.SamplingFilter({'mainapp.views.cart': 0.1})
+        kept = [
+            sampling.filter(make_record(request_id='request-{}'.format(n)))
+            for n in range(1000)
+        ]
+        self.assertTrue(80 < sum(kept) < 120)
+        self.assertEqual(sampling.skipped, 1000 - sum(kept))
+        # записи одного запроса: все или ни одной
+        self.assertEqual(len({sampling.filter(make_record(request_id='same')) for _ in range(10)}), 1)
+        self.assertTrue(sampling.filter(make_record(level=logging.WARNING, request_id='request-1')))
+        self.assertTrue(sampling.filter(make_record(name='mainapp.views', request_id='request-1')))
+
+    def test_background_handler_writes_outside_calling_thread(self):
+        formatted_in = []
+
+        class Formatter(log.JsonFormatter):
+            def format(self, record):
+                formatted_in.append(threading.current_thread())
+                return super().format(record)
+
+        with tempfile.TemporaryDirectory() as directory:
+            handler = log.BackgroundHandler(os.path.join(directory, 'app-{pid}.log'))
+            handler.setFormatter(Formatter())
+            items = [1]
+            handler.handle(make_record(msg='Элементы %s', args=(items,)))
+            # аргументы изменились после вызова - в журнал попадает текст на момент вызова
+            items.append(2)
+            handler.stop()
+            with open(os.path.join(directory, 'app-{}.log'.format(os.getpid())), encoding='utf-8') as file:
+                lines = [json.loads(line) for line in file]
+        self.assertEqual([line['message'] for line in lines], ['Элементы [1]'])
+        # RotatingFileHandler форматирует запись еще и для проверки размера - тоже в потоке записи
+        self.assertTrue(formatted_in)
+        self.assertNotIn(threading.current_thread(), formatted_in)
+
+    def test_full_queue_drops_records(self):
+        handler = log.BackgroundHandler(queue_size=1)
+        handler.queue.put_nowait(make_record())
+        handler.enqueue(make_record())
+        self.assertEqual(handler.dropped, 1)
+
+    def test_request_id_is_attached_to_records_and_response(self):
+        category = Category.objects.create(name='Холодильники', slug='refrigerators')
+        make_refrigerator(category, 'r-1')
+        user = User.objects.create(username='bobik')
+        Customer.objects.create(user=user)
+        self.client.force_login(user)
+        records = []
+        handler = logging.Handler()
+        handler.addFilter(log.RequestIdFilter())
+        handler.emit = records.append
+        logger = logging.getLogger('mainapp.views.cart')
+        logger.addHandler(handler)
+        try:
+            response = self.client.get('/add-to-cart/refrigerator/r-1/', HTTP_X_REQUEST_ID='req-42')
+            generated = self.client.get('/add-to-cart/refrigerator/r-1/', HTTP_X_REQUEST_ID='bad id!')
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(response['X-Request-ID'], 'req-42')
+        self.assertRegex(generated['X-Request-ID'], r'^[0-9a-f]{32}$')
+        self.assertEqual([record.request_id for record in records], ['req-42', generated['X-Request-ID']])
+        self.assertEqual(records[0].cart, records[1].cart)
+
+    def test_request_id_is_attached_to_django_request_records(self):
+        records = []
+        handler = logging.Handler()
+        handler.addFilter(log.RequestIdFilter())
+        handler.emit = records.append
+        logger = logging.getLogger('django.request')
+        logger.addHandler(handler)
+        try:
+            response = self.client.get('/products/no-such-type/no-such-product/', HTTP_X_REQUEST_ID='req-404')
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual([(record.status_code, record.request_id) for record in records], [(404, 'req-404')])
@@ -1,25 +1,317 @@
-from django.test import TestCase
-from ..models import Category
+import shutil
+import tempfile
+from decimal import Decimal
+from io import BytesIO
+from unittest import mock
+
+from PIL import Image
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from .. import thumbnails
+from ..templatetags.product_images import product_image
+from ..models import Category, Dishwasher, LatestProducts, Refrigerator, Washer
+from ..product_types import registry as product_types
+from ..templatetags import specifications
+
+
+class TempMediaMixin:
+    # загрузки и миниатюры тестов пишутся во временный каталог, а не в MEDIA_ROOT проекта;
+    # каталог удаляется после класса
+    @classmethod
+    def setUpClass(cls):
+        media_root = tempfile.mkdtemp(prefix='shop-test-media-')
+        cls.addClassCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=media_root)
+        media_settings.enable()
+        cls.addClassCleanup(media_settings.disable)
+        super().setUpClass()
+
+
+def make_test_image(name='test_image.jpg', size=(600, 800), color='red'):
+    filestream = BytesIO()
+    Image.new('RGB', size, color).save(filestream, 'JPEG')
+    return SimpleUploadedFile(name=name, content=filestream.getvalue(), content_type='image/jpeg')
+
+
+def make_refrigerator(category, slug, **kwargs):
+    fields = dict(
+        category=category,
+        title="Test Refrigerator",
+        slug=slug,
+        image=make_test_image(),
+        price=Decimal('1000.00'),
+        overall_volume="500 л",
+        useful_volume="450 л",
+        control="механическое",
+        noise_level="45 дБ",
+        number_of_shelves="5",
+        number_of_freezer_shelves="2"
+    )
+    fields.update(kwargs)
+    return Refrigerator.objects.create(**fields)
 
 
 class CategoryModelTest(TestCase):
 
     @classmethod
     def setUpTestData(cls):
-        Category.objects.create(name='Холодильники', slug='refrigerators')
+        cls.category = Category.objects.create(name='Холодильники', slug='refrigerators')
 
     def test_name_label(self):
-        category = Category.objects.get(id=1)
+        category = Category.objects.get(id=self.category.id)
         field_label = category._meta.get_field('name').verbose_name
         self.assertEquals(field_label, 'Имя категории')
 
     def test_name_max_length(self):
-        category = Category.objects.get(id=1)
+        category = Category.objects.get(id=self.category.id)
         max_length = category._meta.get_field('name').max_length
         self.assertEquals(max_length, 255)
 
     def test_get_absolute_url(self):
-        category = Category.objects.get(id=1)
+        category = Category.objects.get(id=self.category.id)
         # This will also fail if the urlconf is not defined.
         self.assertEquals(category.get_absolute_url(), '/category/refrigerators/')
 
+
+class CategoryCountersTest(TempMediaMixin, TestCase):
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.category = Category.objects.create(name='Холодильники', slug='refrigerators')
+        self.other_category = Category.objects.create(name='Стиральные машины', slug='washers')
+
+    def get_count(self, category):
+        return Category.objects.get(pk=category.pk).products_count
+
+    def test_counter_follows_create_and_delete(self):
+        refrigerator = make_refrigerator(self.category, 'r-1')
+        make_refrigerator(self.category, 'r-2')
+        self.assertEqual(self.get_count(self.category), 2)
+        refrigerator.delete()
+        self.assertEqual(self.get_count(self.category), 1)
+
+    def test_counter_follows_category_change(self):
+        refrigerator = make_refrigerator(self.category, 'r-1')
+        refrigerator = Refrigerator.objects.get(pk=refrigerator.pk)
+        refrigerator.category = self.other_category
+        refrigerator.save()
+        self.assertEqual(self.get_count(self.category), 0)
+        self.assertEqual(self.get_count(self.other_category), 1)
+
+    def test_recalc_products_count(self):
+        make_refrigerator(self.category, 'r-1')
+        Category.objects.filter(pk=self.category.pk).update(products_count=10)
+        Category.objects.recalc_products_count()
+        self.assertEqual(self.get_count(self.category), 1)
+
+    def test_sidebar_is_cached_until_invalidated(self):
+        Category.objects.get_categories_for_up_sidebar()
+        with self.assertNumQueries(0):
+            data = Category.objects.get_categories_for_up_sidebar()
+        self.assertEqual({c['name']: c['count'] for c in data}, {'Холодильники': 0, 'Стиральные машины': 0})
+        make_refrigerator(self.category, 'r-1')
+        data = Category.objects.get_categories_for_up_sidebar()
+        self.assertEqual({c['name']: c['count'] for c in data}, {'Холодильники': 1, 'Стиральные машины': 0})
+
+
+class LatestProductsTest(TempMediaMixin, TestCase):
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.category = Category.objects.create(name='Холодильники', slug='refrigerators')
+        for i in range(6):
+            make_refrigerator(self.category, 'r-{}'.format(i), price=Decimal('100.50') + i)
+
+    def get_feed(self):
+        return LatestProducts.objects.get_products_for_main_page(
+            'refrigerator', 'washer', 'dishwasher', with_respect_to='dishwasher'
+        )
+
+    def test_single_query_and_cache(self):
+        with self.assertNumQueries(1):
+            products = self.get_feed()
+        with self.assertNumQueries(0):
+            self.get_feed()
+        self.assertEqual([p.slug for p in products], ['r-5', 'r-4', 'r-3', 'r-2', 'r-1'])
+        self.assertEqual(products[0].price, Decimal('105.50'))
+        self.assertEqual(products[0].get_absolute_url(), '/products/refrigerator/r-5/')
+        self.assertEqual(products[0].get_model_name(), 'refrigerator')
+
+    def test_cache_invalidated_on_product_change(self):
+        self.get_feed()
+        make_refrigerator(self.category, 'r-new')
+        self.assertEqual(self.get_feed()[0].slug, 'r-new')
+
+
+class ThumbnailTest(TempMediaMixin, TestCase):
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.category = Category.objects.create(name='Холодильники', slug='refrigerators')
+
+    def image_size(self, product):
+        with Image.open(product.image.path) as image:
+            return image.size
+
+    @override_settings(THUMBNAIL_BACKGROUND=False)
+    def test_thumbnail_only_when_content_changes(self):
+        refrigerator = make_refrigerator(self.category, 'r-1')
+        self.assertEqual(self.image_size(refrigerator), Refrigerator.THUMBNAIL_SIZE)
+        image_name = refrigerator.image.name
+
+        refrigerator = Refrigerator.objects.get(pk=refrigerator.pk)
+        refrigerator.price = Decimal('10.00')
+        with mock.patch.object(thumbnails, 'render_derivatives') as render:
+            refrigerator.save()
+            refrigerator.image = make_test_image()
+            refrigerator.save()
+        render.assert_not_called()
+        self.assertEqual(Refrigerator.objects.get(pk=refrigerator.pk).image.name, image_name)
+
+        refrigerator.image = make_test_image(color='blue')
+        refrigerator.save()
+        self.assertNotEqual(refrigerator.image.name, image_name)
+
+    def test_background_thumbnail(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            refrigerator = make_refrigerator(self.category, 'r-1')
+        # до построения миниатюры хранится исходная картинка
+        self.assertEqual(self.image_size(refrigerator), (600, 800))
+        self.assertEqual(len(callbacks), 1)
+
+        data = open(refrigerator.image.path, 'rb').read()
+        derivatives = thumbnails.render_derivatives(data, Refrigerator.THUMBNAIL_SIZE)
+        thumbnails.store_derivatives(Refrigerator, refrigerator.pk, refrigerator.image_hash, derivatives)
+        refrigerator = Refrigerator.objects.get(pk=refrigerator.pk)
+        self.assertEqual(self.image_size(refrigerator), Refrigerator.THUMBNAIL_SIZE)
+        self.assertEqual(refrigerator.image.name, 'derivatives/{}/300.jpeg'.format(refrigerator.image_hash))
+
+    def test_stale_thumbnail_is_dropped(self):
+        refrigerator = make_refrigerator(self.category, 'r-1')
+        image_name = refrigerator.image.name
+        thumbnails.store_derivatives(Refrigerator, refrigerator.pk, 'other-hash', {})
+        self.assertEqual(Refrigerator.objects.get(pk=refrigerator.pk).image.name, image_name)
+
+    @override_settings(THUMBNAIL_BACKGROUND=False)
+    def test_derivatives_and_srcset(self):
+        refrigerator = make_refrigerator(self.category, 'r-1')
+        prefix = 'derivatives/{}/'.format(refrigerator.image_hash)
+        for width in thumbnails.DERIVATIVE_WIDTHS:
+            for extension, _, _, _ in thumbnails.DERIVATIVE_FORMATS:
+                self.assertTrue(refrigerator.image.storage.exists('{}{}.{}'.format(prefix, width, extension)))
+        html = product_image(refrigerator, 'cart', 'img-fluid')
+        self.assertIn('<source type="image/webp" srcset="/media/{}150.webp 150w'.format(prefix), html)
+        self.assertIn('sizes="150px" class="img-fluid"', html)
+
+    @override_settings(THUMBNAIL_BACKGROUND=False)
+    def test_small_source_is_not_upscaled(self):
+        refrigerator = make_refrigerator(self.category, 'r-1', image=make_test_image(size=(400, 520)))
+        prefix = 'derivatives/{}/'.format(refrigerator.image_hash)
+        storage = refrigerator.image.storage
+        self.assertTrue(storage.exists(prefix + '300.jpeg'))
+        self.assertFalse(storage.exists(prefix + '600.jpeg'))
+        html = product_image(refrigerator, 'card')
+        self.assertIn('300.jpeg 300w', html)
+        self.assertNotIn('600w', html)
+
+        # исходник меньше основной миниатюры: основной становится самая крупная из построенных
+        refrigerator = make_refrigerator(self.category, 'r-2', image=make_test_image(size=(200, 260)))
+        self.assertEqual(refrigerator.image.name, 'derivatives/{}/150.jpeg'.format(refrigerator.image_hash))
+        self.assertEqual(self.image_size(refrigerator), (150, 200))
+        self.assertNotIn('300w', product_image(refrigerator, 'card'))
+
+    def test_plain_img_until_derivatives_ready(self):
+        refrigerator = make_refrigerator(self.category, 'r-1')
+        self.assertEqual(
+            product_image(refrigerator, 'card'), '<img src="{}" class="" alt="">'.format(refrigerator.image.url)
+        )
+
+
+class SpecTableTest(TempMediaMixin, TestCase):
+
+    def setUp(self) -> None:
+        cache.clear()
+        category = Category.objects.create(name='Посудомоечные машины', slug='dishwashers')
+        self.dishwasher = Dishwasher.objects.create(
+            category=category, title='Test Dishwasher', slug='dw', image=make_test_image(), price=Decimal('500.00'),
+            max_load='10', drying=True, drying_type='конденсационная', number_of_programs='6', noise_level='46 дБ',
+            shortest_program='60 мин.', water_consumption_per_cycle='9.9 л', control='<b>электронное</b>',
+            child_lock=False
+        )
+
+    def rows(self, html):
+        return [line.strip()[4:-5] for line in html.splitlines() if line.strip().startswith('<td>')][::2]
+
+    def test_drying_type_row_does_not_change_shared_state(self):
+        spec_before = dict(specifications.PRODUCT_SPEC['dishwasher'])
+        with_drying = self.rows(specifications.product_spec(self.dishwasher))
+        self.dishwasher.drying = False
+        self.dishwasher.save()
+        without_drying = self.rows(specifications.product_spec(self.dishwasher))
+        self.assertEqual(with_drying, list(specifications.PRODUCT_SPEC['dishwasher']))
+        self.assertEqual(without_drying, [name for name in with_drying if name != 'Тип сушки'])
+        self.assertEqual(specifications.PRODUCT_SPEC['dishwasher'], spec_before)
+
+    def test_values_are_escaped_and_cached(self):
+        html = specifications.product_spec(self.dishwasher)
+        self.assertIn('&lt;b&gt;электронное&lt;/b&gt;', html)
+        self.assertIn('<td>Нет</td>', html)
+        with mock.patch.object(specifications, 'render_product_spec') as render:
+            self.assertEqual(specifications.product_spec(self.dishwasher), html)
+        render.assert_not_called()
+
+
+class ProductTypeRegistryTest(TestCase):
+
+    def test_lookups_by_url_name_category_and_content_type(self):
+        self.assertEqual(product_types.models(), [Refrigerator, Washer, Dishwasher])
+        self.assertIs(product_types.get('washer').model, Washer)
+        self.assertIs(product_types.for_category('dishwashers').model, Dishwasher)
+        self.assertIsNone(product_types.get('category'))
+        self.assertIsNone(product_types.for_category('unknown'))
+        refrigerator = product_types.get('refrigerator')
+        self.assertIs(product_types.for_content_type_id(refrigerator.content_type_id), refrigerator)
+
+    def test_no_queries_after_warm_up(self):
+        product_types.warm_up()
+        with self.assertNumQueries(0):
+            for product_type in product_types.all():
+                self.assertIs(product_types.for_content_type_id(product_type.content_type_id), product_type)
+
+
+class CartProductUniqueLineMigrationTest(TransactionTestCase):
+    # дубли сливаются и ограничение создается в одной миграции: на PostgreSQL отложенные
+    # проверки внешних ключей после удаления строк не должны мешать ALTER TABLE
+    before = [('mainapp', '0016_catalog_item')]
+    after = [('mainapp', '0017_cartproduct_unique_line')]
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_duplicate_lines_are_merged(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.before)
+        apps = executor.loader.project_state(self.before).apps
+        user = apps.get_model('auth', 'User').objects.create(username='Bobik')
+        customer = apps.get_model('mainapp', 'Customer').objects.create(user=user)
+        cart = apps.get_model('mainapp', 'Cart').objects.create(owner=customer)
+        content_type = apps.get_model('contenttypes', 'ContentType').objects.get_or_create(
+            app_label='mainapp', model='refrigerator'
+        )[0]
+        CartProduct = apps.get_model('mainapp', 'CartProduct')
+        for qty in (1, 3):
+            cart.products.add(CartProduct.objects.create(
+                user=customer, cart=cart, content_type=content_type, object_id=1,
+                qty=qty, final_price=Decimal(qty * 100)
+            ))
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.after)
+        apps = executor.loader.project_state(self.after).apps
+        cart = apps.get_model('mainapp', 'Cart').objects.get(pk=cart.pk)
+        self.assertEqual([line.qty for line in cart.products.all()], [3])
+        self.assertEqual((cart.total_products, cart.final_price), (1, Decimal('300')))
@@ -0,0 +1,87 @@
+from datetime import timedelta
+from io import StringIO
+
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from .. import outbox
+from ..models import Category, Customer, OutgoingEmail, User
+from .test_models import TempMediaMixin, make_refrigerator
+
+
+class CountingBackend(EmailBackend):
+    # locmem-бэкенд, который считает соединения и не принимает письма на адреса с "fail"
+    opened = 0
+
+    def open(self):
+        CountingBackend.opened += 1
+        return super().open()
+
+    def send_messages(self, messages):
+        for message in messages:
+            if any('fail' in address for address in message.to):
+                raise ConnectionError('Отказ сервера')
+        return super().send_messages(messages)
+
+
+@override_settings(EMAIL_BACKEND='mainapp.tests.test_outbox.CountingBackend')
+class OutboxTestCases(TempMediaMixin, TestCase):
+
+    def setUp(self) -> None:
+        CountingBackend.opened = 0
+
+    def test_batch_is_sent_over_one_connection(self):
+        for n in range(3):
+            outbox.enqueue('Тема {}'.format(n), 'Текст', ['user{}@example.com'.format(n)])
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(outbox.drain(batch_size=10), (3, 0))
+        self.assertEqual(CountingBackend.opened, 1)
+        self.assertEqual([message.subject for message in mail.outbox], ['Тема 0', 'Тема 1', 'Тема 2'])
+        self.assertFalse(OutgoingEmail.objects.exclude(status=OutgoingEmail.STATUS_SENT).exists())
+        self.assertEqual(outbox.drain(), (0, 0))
+
+    def test_failed_email_is_retried_with_backoff(self):
+        failing = outbox.enqueue('Тема', 'Текст', ['fail@example.com'])
+        outbox.enqueue('Тема', 'Текст', ['ok@example.com'])
+        self.assertEqual(outbox.drain(), (1, 1))
+        failing.refresh_from_db()
+        self.assertEqual((failing.status, failing.attempts), (OutgoingEmail.STATUS_PENDING, 1))
+        self.assertIn('Отказ сервера', failing.last_error)
+        self.assertGreater(failing.next_attempt_at, timezone.now() + outbox.RETRY_DELAY / 2)
+        for attempt in range(2, outbox.MAX_ATTEMPTS + 1):
+            OutgoingEmail.objects.filter(pk=failing.pk).update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+            self.assertEqual(outbox.drain(), (0, 1))
+        failing.refresh_from_db()
+        self.assertEqual((failing.status, failing.attempts), (OutgoingEmail.STATUS_FAILED, outbox.MAX_ATTEMPTS))
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_claimed_emails_are_leased(self):
+        outbox.enqueue('Тема', 'Текст', ['user@example.com'])
+        self.assertEqual(len(outbox.claim_batch()), 1)
+        self.assertEqual(outbox.claim_batch(), [])
+
+    def test_registration_and_order_emails_go_through_outbox(self):
+        response = self.client.post('/registration/', {
+            'username': 'bobik', 'password': '1234', 'confirm_password': '1234', 'first_name': 'Боб',
+            'last_name': 'Иванов', 'address': 'Минск', 'phone': '+375(44)1112233', 'email': 'bob@example.com'
+        })
+        self.assertEqual(response.status_code, 302)
+        customer = Customer.objects.get(user__username='bobik')
+        category = Category.objects.create(name='Холодильники', slug='refrigerators')
+        make_refrigerator(category, 'r-1')
+        self.client.get('/add-to-cart/refrigerator/r-1/')
+        self.client.post('/make-order/', {
+            'phone': '+375(44)1112233', 'address': 'Минск', 'buying_type': 'self', 'order_date': '2099-01-01',
+            'comment': ''
+        })
+        order = customer.related_orders.get()
+        self.assertEqual(mail.outbox, [])
+        out = StringIO()
+        call_command('send_outbox', '--once', stdout=out)
+        self.assertIn('Отправлено: 2, ошибок: 0', out.getvalue())
+        self.assertEqual([message.to for message in mail.outbox], [['bob@example.com']] * 2)
+        self.assertEqual(mail.outbox[1].subject, 'Заказ №{} принят'.format(order.pk))
+        self.assertTrue(User.objects.get(username='bobik').check_password('1234'))
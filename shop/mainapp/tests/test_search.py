@@ -0,0 +1,47 @@
+from django.test import TestCase
+
+from .. import search
+from ..models import Category, Refrigerator, SearchDocument
+from .test_models import TempMediaMixin, make_refrigerator
+
+
+class SearchTestCases(TempMediaMixin, TestCase):
+
+    def setUp(self) -> None:
+        self.category = Category.objects.create(name='Холодильники', slug='refrigerators')
+        self.bosch = make_refrigerator(self.category, 'bosch', title='Холодильник Bosch KGN39', description='белый цвет')
+        self.lg = make_refrigerator(
+            self.category, 'lg', title='Холодильник LG GA-B509', description='подходит к технике Bosch'
+        )
+
+    def found(self, query):
+        return [product.slug for product in search.load_results(search.search(query))]
+
+    def test_normalize(self):
+        self.assertEqual(search.tokenize('Холодильники Ёлка'), ['холодильник', 'елк'])
+        self.assertEqual(search.normalize('холодильника'), search.normalize('холодильник'))
+
+    def test_ranking(self):
+        # слово в названии весит больше, чем в описании
+        self.assertEqual(self.found('bosch'), ['bosch', 'lg'])
+        # больше совпавших слов - выше
+        self.assertEqual(self.found('холодильники lg'), ['lg', 'bosch'])
+        self.assertEqual(self.found('samsung'), [])
+
+    def test_reindex_on_save_and_delete(self):
+        self.lg.title = 'Холодильник Samsung RB30'
+        self.lg.save()
+        self.assertEqual(self.found('samsung'), ['lg'])
+        self.lg.delete()
+        self.assertEqual(self.found('samsung'), [])
+        self.assertEqual(SearchDocument.objects.count(), 1)
+
+    def test_rebuild_index(self):
+        self.assertEqual(search.rebuild_index([Refrigerator]), 2)
+        self.assertEqual(self.found('bosch'), ['bosch', 'lg'])
+
+    def test_search_view(self):
+        response = self.client.get('/search/', {'q': 'холодильник lg'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([p.slug for p in response.context['products']], ['lg', 'bosch'])
+        self.assertContains(response, 'Холодильник LG GA-B509')
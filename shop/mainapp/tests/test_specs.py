@@ -0,0 +1,66 @@
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from .. import specs
+from ..models import Category, Refrigerator, SpecValue
+from .test_models import TempMediaMixin, make_refrigerator
+
+
+class SpecValuesTestCases(TempMediaMixin, TestCase):
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.category = Category.objects.create(name='Холодильники', slug='refrigerators')
+        for i, (volume, noise, price) in enumerate([(180, '38 дБ', 700), (320, '41 дБ', 1200), (340, '41,5 дБ', 1600)]):
+            make_refrigerator(
+                self.category, 'r-{}'.format(i), overall_volume='{} л'.format(volume), noise_level=noise,
+                price=Decimal(price), number_of_shelves='нет данных'
+            )
+
+    def test_parse_spec_value(self):
+        self.assertEqual(specs.parse_spec_value('500 л'), (Decimal('500'), 'л'))
+        self.assertEqual(specs.parse_spec_value('0.85 кВт·ч'), (Decimal('0.85'), 'кВт·ч'))
+        self.assertEqual(specs.parse_spec_value('60 мин.'), (Decimal('60'), 'мин'))
+        self.assertEqual(specs.parse_spec_value('1200 об/мин'), (Decimal('1200'), 'об/мин'))
+        self.assertEqual(specs.parse_spec_value('10'), (Decimal('10'), ''))
+        self.assertIsNone(specs.parse_spec_value('нет данных'))
+
+    def test_values_follow_product_changes(self):
+        product = Refrigerator.objects.get(slug='r-0')
+        product.overall_volume = '200 л'
+        product.save()
+        self.assertEqual(SpecValue.objects.get(object_id=product.pk, key='overall_volume').value, Decimal('200'))
+        self.assertFalse(SpecValue.objects.filter(key='number_of_shelves').exists())
+        product.delete()
+        self.assertFalse(SpecValue.objects.filter(object_id=product.pk).exists())
+
+    def test_facets_are_cached_histograms(self):
+        with self.assertNumQueries(2):
+            facets = {facet['key']: facet for facet in specs.get_facets(self.category, Refrigerator)}
+        with self.assertNumQueries(0):
+            specs.get_facets(self.category, Refrigerator)
+        volume = [(b['start'], b['end'], b['count']) for b in facets['overall_volume']['buckets']]
+        self.assertEqual(volume, [(150, 200, 1), (300, 350, 2)])
+        self.assertEqual(facets['overall_volume']['unit'], 'л')
+        self.assertEqual([b['count'] for b in facets['price']['buckets']], [1, 1, 1])
+
+        make_refrigerator(self.category, 'r-new', overall_volume='190 л')
+        facets = {facet['key']: facet for facet in specs.get_facets(self.category, Refrigerator)}
+        self.assertEqual(facets['overall_volume']['buckets'][0]['count'], 2)
+
+    def test_facets_count_only_products_of_category(self):
+        other = Category.objects.create(name='Мини-холодильники', slug='mini-refrigerators')
+        make_refrigerator(other, 'mini-1', overall_volume='50 л', price=Decimal(300))
+        facets = {facet['key']: facet for facet in specs.get_facets(self.category, Refrigerator)}
+        self.assertEqual(sum(b['count'] for b in facets['overall_volume']['buckets']), 3)
+        facets = {facet['key']: facet for facet in specs.get_facets(other, Refrigerator)}
+        self.assertEqual([b['count'] for b in facets['overall_volume']['buckets']], [1])
+
+    def test_category_filtering(self):
+        response = self.client.get('/category/refrigerators/', {'overall_volume_min': 300, 'noise_level_max': 41.5})
+        self.assertEqual([p.slug for p in response.context['category_products']], ['r-1'])
+        response = self.client.get('/category/refrigerators/', {'price_min': 1000, 'overall_volume_min': 'abc'})
+        self.assertEqual(sorted(p.slug for p in response.context['category_products']), ['r-1', 'r-2'])
+        self.assertContains(response, 'price_min=1000')
@@ -1,19 +1,41 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
 from decimal import Decimal
+from io import StringIO
 from unittest import mock
 
 from PIL import Image
-from django.test import TestCase, RequestFactory, Client
+from asgiref.sync import async_to_sync
+from django.test import TestCase, TransactionTestCase, RequestFactory, Client, override_settings, skipUnlessDBFeature
 from django.contrib.auth import get_user_model, authenticate, login
-from django.core.files.uploadedfile import SimpleUploadedFile
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.http import Http404
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.utils import timezone
 
-from ..models import Category, Refrigerator, CartProduct, Cart, Customer
-from ..utils import recalc_cart
-from ..views import AddToCartView, BaseView, DeleteFromCartView, ChangeQtyView, RegistrationView
+from .. import checkout, metrics, synthetic
+from ..middleware import MetricsMiddleware
+from ..mixins import CategoryDetailMixin, ShopperContext
+from ..models import Category, Refrigerator, CartProduct, Cart, CatalogItem, Customer, Order
+from ..utils import recalc_cart, get_cart_totals, load_cart_items, load_order_items, \
+    add_cart_line, remove_cart_line, set_cart_line_qty, get_catalog_item
+from ..views import AddToCartView, BaseView, DeleteFromCartView, ChangeQtyView, RegistrationView, ProfileView, \
+    CategoryDetailView, ProductDetailView, ContactsView, AsyncBaseView, AsyncCategoryDetailView, \
+    AsyncProductDetailView, AsyncContactsView
+
+from .test_models import TempMediaMixin, make_refrigerator, make_test_image
 
 User = get_user_model()
 
 
-class ShopTestCases(TestCase):
+class ShopTestCases(TempMediaMixin, TestCase):
 
     def setUp(self) -> None:
         pass
@@ -32,11 +54,7 @@ class ShopTestCases(TestCase):
             address='TestAddress',
         )
         self.category = Category.objects.create(name='Холодильники', slug='refrigerators')
-        image = SimpleUploadedFile(
-            name='test_image.jpg',
-            content=open('/home/yuliya/ISP/lab3-4/shop/media/r_bosh_seria_4.jpeg', 'rb').read(),
-            content_type='image/jpeg'
-        )
+        image = make_test_image()
         self.refrigerator = Refrigerator.objects.create(
             category=self.category,
             title="Test Refrigerator",
@@ -147,3 +165,581 @@ class ShopTestCases(TestCase):
             response = BaseView.as_view()(request)
             self.assertEqual(response.status_code, 444)
             print(mock_data_.called)
+
+
+class CartItemsLoaderTestCases(TempMediaMixin, TestCase):
+
+    def setUp(self) -> None:
+        user = User.objects.create(username='Bobik')
+        self.customer = Customer.objects.create(user=user)
+        category = Category.objects.create(name='Холодильники', slug='refrigerators')
+        self.cart = Cart.objects.create(owner=self.customer)
+        for i in range(3):
+            refrigerator = make_refrigerator(category, 'r-{}'.format(i))
+            self.cart.products.add(
+                CartProduct.objects.create(user=self.customer, cart=self.cart, content_object=refrigerator)
+            )
+        ContentType.objects.get_for_model(Refrigerator)
+
+    def test_cart_items_loaded_in_bounded_queries(self):
+        cart = Cart.objects.get(pk=self.cart.pk)
+        with self.assertNumQueries(1):
+            load_cart_items(cart)
+        with self.assertNumQueries(0):
+            titles = [item.catalog_item.title for item in cart.products.all()]
+            self.assertEqual(cart.products.count(), 3)
+        self.assertEqual(titles, ['Test Refrigerator'] * 3)
+
+    def test_order_items_loaded_in_bounded_queries(self):
+        for _ in range(3):
+            Order.objects.create(customer=self.customer, cart=self.cart, first_name='Bob', last_name='Smith')
+        # заказы и строки всех их корзин
+        with self.assertNumQueries(2):
+            orders = load_order_items(Order.objects.filter(customer=self.customer).select_related('cart'))
+        with self.assertNumQueries(0):
+            for order in orders:
+                self.assertEqual(len([item.catalog_item.price for item in order.cart.products.all()]), 3)
+
+
+class ProfilePaginationTestCases(TempMediaMixin, TestCase):
+
+    def setUp(self) -> None:
+        user = User.objects.create(username='Bobik')
+        user.set_password('1234')
+        user.save()
+        self.customer = Customer.objects.create(user=user, phone='+375(44)1112233')
+        category = Category.objects.create(name='Холодильники', slug='refrigerators')
+        refrigerator = make_refrigerator(category, 'r-1')
+        for _ in range(ProfileView.paginate_by + 5):
+            cart = Cart.objects.create(owner=self.customer, in_order=True)
+            cart.products.add(CartProduct.objects.create(user=self.customer, cart=cart, content_object=refrigerator))
+            Order.objects.create(customer=self.customer, cart=cart, first_name='Bob', last_name='Smith')
+        self.client.login(username='Bobik', password='1234')
+
+    def test_orders_are_paginated_by_key(self):
+        response = self.client.get('/profile/')
+        orders = response.context['orders']
+        self.assertEqual(len(orders), ProfileView.paginate_by)
+        self.assertEqual([o.id for o in orders], sorted([o.id for o in orders], reverse=True))
+        response = self.client.get('/profile/', {'after': response.context['page'].next_cursor})
+        self.assertEqual(len(response.context['orders']), 5)
+        self.assertFalse(response.context['page'].has_next)
+
+    def test_query_count_does_not_depend_on_history_length(self):
+        self.client.get('/profile/')
+        after = Order.objects.order_by('id')[2].id
+        with CaptureQueriesContext(connection) as short_history:
+            self.client.get('/profile/', {'after': after})
+        with CaptureQueriesContext(connection) as full_page:
+            self.client.get('/profile/')
+        self.assertEqual(len(short_history), len(full_page))
+
+    def test_broken_cursor(self):
+        self.assertEqual(self.client.get('/profile/', {'after': 'abc'}).status_code, 404)
+
+    def test_history_with_deleted_product(self):
+        Refrigerator.objects.get(slug='r-1').delete()
+        response = self.client.get('/profile/')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Товар удален')
+
+
+class ShopperContextTestCases(TempMediaMixin, TestCase):
+
+    def setUp(self) -> None:
+        self.user = User.objects.create(username='Bobik')
+        self.user.set_password('1234')
+        self.user.save()
+        self.customer = Customer.objects.create(user=self.user)
+        self.category = Category.objects.create(name='Холодильники', slug='refrigerators')
+        make_refrigerator(self.category, 'test-slug')
+        self.client.login(username='Bobik', password='1234')
+
+    def test_read_only_pages_do_not_create_cart(self):
+        for url in ('/', '/contacts/', '/cart/', '/category/refrigerators/'):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertFalse(Cart.objects.exists())
+
+    def test_cart_created_on_first_add(self):
+        self.client.get('/add-to-cart/refrigerator/test-slug/')
+        cart = Cart.objects.get(owner=self.customer, in_order=False)
+        self.assertEqual(cart.total_products, 1)
+        self.client.get('/add-to-cart/refrigerator/test-slug/')
+        self.assertEqual(Cart.objects.count(), 1)
+
+    def test_cart_and_customer_in_one_query(self):
+        cart = Cart.objects.create(owner=self.customer)
+        request = RequestFactory().get('/')
+        request.user = self.user
+        shopper = ShopperContext(request)
+        with self.assertNumQueries(1):
+            self.assertEqual(shopper.cart, cart)
+            self.assertEqual(shopper.customer, self.customer)
+
+
+class CartTotalsTestCases(TempMediaMixin, TestCase):
+
+    def setUp(self) -> None:
+        user = User.objects.create(username='Bobik')
+        user.set_password('1234')
+        user.save()
+        self.customer = Customer.objects.create(user=user)
+        category = Category.objects.create(name='Холодильники', slug='refrigerators')
+        make_refrigerator(category, 'r-1', price=Decimal('1000.00'))
+        make_refrigerator(category, 'r-2', price=Decimal('250.50'))
+        self.client.login(username='Bobik', password='1234')
+
+    def assertTotals(self, final_price, total_products):
+        cart = Cart.objects.get(owner=self.customer, in_order=False)
+        self.assertEqual((cart.final_price, cart.total_products), (Decimal(final_price), total_products))
+        self.assertEqual(get_cart_totals(cart), (Decimal(final_price), total_products))
+
+    def test_totals_follow_line_changes(self):
+        self.client.get('/add-to-cart/refrigerator/r-1/')
+        self.client.get('/add-to-cart/refrigerator/r-2/')
+        self.client.get('/add-to-cart/refrigerator/r-2/')
+        self.assertTotals('1501.00', 2)
+        self.client.post('/change-qty-in-cart/refrigerator/r-2/', {'qty': 3})
+        self.assertTotals('1751.50', 2)
+        self.client.get('/remove-from-cart/refrigerator/r-1/')
+        self.assertTotals('751.50', 1)
+
+    def test_changes_without_cart_redirect_to_cart(self):
+        for response in (
+            self.client.get('/remove-from-cart/refrigerator/r-1/', follow=True),
+            self.client.post('/change-qty-in-cart/refrigerator/r-1/', {'qty': 3}, follow=True),
+        ):
+            self.assertRedirects(response, '/cart/')
+            self.assertEqual([m.message for m in response.context['messages']], ['Товара нет в корзине'])
+        self.assertFalse(Cart.objects.exists())
+
+    def test_recalc_carts_command_repairs_totals(self):
+        self.client.get('/add-to-cart/refrigerator/r-1/')
+        Cart.objects.update(final_price=0, total_products=5)
+        call_command('recalc_carts', stdout=StringIO())
+        self.assertTotals('1000.00', 1)
+
+
+class CategoryListingTestCases(TempMediaMixin, TestCase):
+
+    def setUp(self) -> None:
+        cache.clear()
+        category = Category.objects.create(name='Холодильники', slug='refrigerators')
+        prices = [500, 100, 300, 300, 200] * 3
+        for i, price in enumerate(prices):
+            make_refrigerator(category, 'r-{}'.format(i), price=Decimal(price))
+
+    def collect(self, sort):
+        slugs, params = [], {'sort': sort}
+        while True:
+            response = self.client.get('/category/refrigerators/', params)
+            page = response.context['page']
+            self.assertLessEqual(len(page), CategoryDetailMixin.paginate_by)
+            slugs.extend(p.slug for p in response.context['category_products'])
+            if not page.has_next:
+                return slugs
+            params['after'] = page.next_cursor
+
+    def test_sort_orders_walk_all_pages(self):
+        by_price = Refrigerator.objects.order_by('price', 'id').values_list('slug', flat=True)
+        self.assertEqual(self.collect('price'), list(by_price))
+        self.assertEqual(self.collect('-price'), list(reversed(by_price)))
+        self.assertEqual(self.collect('new'), list(Refrigerator.objects.order_by('-id').values_list('slug', flat=True)))
+
+    def test_listing_reads_only_catalog(self):
+        self.client.get('/category/refrigerators/')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/category/refrigerators/', {'sort': 'price'})
+        self.assertEqual(response.context['category_products'][0].get_absolute_url(), '/products/refrigerator/r-1/')
+        self.assertFalse([q for q in queries if 'mainapp_refrigerator' in q['sql']])
+
+
+class PageCacheTestCases(TempMediaMixin, TestCase):
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.category = Category.objects.create(name='Холодильники', slug='refrigerators')
+        Category.objects.create(name='Стиральные машины', slug='washers')
+        self.refrigerator = make_refrigerator(self.category, 'r-1', price=Decimal('1000.00'))
+        user = User.objects.create(username='Bobik')
+        user.set_password('1234')
+        user.save()
+        Customer.objects.create(user=user)
+
+    def test_anonymous_pages_served_from_cache(self):
+        for url in ('/', '/category/refrigerators/', '/products/refrigerator/r-1/'):
+            content = self.client.get(url).content
+            with self.assertNumQueries(0):
+                self.assertEqual(self.client.get(url).content, content)
+
+    def test_product_save_invalidates_its_pages_only(self):
+        self.client.get('/category/refrigerators/')
+        self.client.get('/category/washers/')
+        self.refrigerator.price = Decimal('777.00')
+        self.refrigerator.save()
+        with self.assertNumQueries(0):
+            self.client.get('/category/washers/')
+        self.assertContains(self.client.get('/category/refrigerators/'), '777.00')
+        self.assertContains(self.client.get('/products/refrigerator/r-1/'), '777.00')
+
+    def test_sidebar_counts_follow_new_products(self):
+        self.client.get('/category/washers/')
+        make_refrigerator(self.category, 'r-2')
+        self.assertContains(self.client.get('/category/washers/'), 'Холодильники (2)')
+
+    def test_cart_badge_is_not_cached_for_logged_in_user(self):
+        self.client.login(username='Bobik', password='1234')
+        self.client.get('/category/refrigerators/')
+        self.client.get('/add-to-cart/refrigerator/r-1/')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/category/refrigerators/')
+        self.assertIn('rounded-pill">1</span>', response.content.decode())
+        self.assertFalse([q for q in queries if 'mainapp_refrigerator' in q['sql']])
+
+    def test_pages_with_messages_are_not_cached(self):
+        self.client.get('/')
+        self.client.get('/add-to-cart/refrigerator/r-1/')
+        self.assertContains(self.client.get('/'), 'Для добавления товаров в корзину')
+
+
+class AsyncViewsTestCases(TempMediaMixin, TestCase):
+
+    def setUp(self) -> None:
+        cache.clear()
+        category = Category.objects.create(name='Холодильники', slug='refrigerators')
+        make_refrigerator(category, 'r-1', price=Decimal('1000.00'))
+        self.user = User.objects.create(username='Bobik')
+        cart = Cart.objects.create(owner=Customer.objects.create(user=self.user))
+        add_cart_line(cart, get_catalog_item('refrigerator', 'r-1'), 2)
+
+    def get(self, view_class, path, **kwargs):
+        request = RequestFactory().get(path)
+        request.user = self.user
+        view = view_class.as_view()
+        if asyncio.iscoroutinefunction(view):
+            return async_to_sync(view)(request, **kwargs)
+        response = view(request, **kwargs)
+        return response.render() if hasattr(response, 'render') else response
+
+    def test_async_pages_match_sync(self):
+        pages = (
+            (BaseView, AsyncBaseView, '/', {}),
+            (CategoryDetailView, AsyncCategoryDetailView, '/category/refrigerators/', {'slug': 'refrigerators'}),
+            (ProductDetailView, AsyncProductDetailView, '/products/refrigerator/r-1/',
+             {'ct_model': 'refrigerator', 'slug': 'r-1'}),
+            (ContactsView, AsyncContactsView, '/contacts/', {}),
+        )
+        for sync_view, async_view, path, kwargs in pages:
+            sync_response = self.get(sync_view, path, **kwargs)
+            async_response = self.get(async_view, path, **kwargs)
+            self.assertEqual(async_response.status_code, 200)
+            self.assertEqual(async_response.content.decode(), sync_response.content.decode())
+        with self.assertRaises(Http404):
+            self.get(AsyncProductDetailView, '/products/category/r-1/', ct_model='category', slug='r-1')
+
+    def test_independent_queries_run_concurrently(self):
+        view = AsyncBaseView()
+        view.sequential = False
+        barrier = threading.Barrier(2, timeout=5)
+        # оба вызова ждут друг друга: при последовательном выполнении барьер не дождется второго
+        self.assertEqual(sorted(async_to_sync(view.gather_sync)(barrier.wait, barrier.wait)), [0, 1])
+
+
+class CheckoutTestCases(TempMediaMixin, TestCase):
+
+    def setUp(self) -> None:
+        user = User.objects.create(username='Bobik', first_name='Боб', email='bob@example.com')
+        user.set_password('1234')
+        user.save()
+        self.customer = Customer.objects.create(user=user)
+        category = Category.objects.create(name='Холодильники', slug='refrigerators')
+        make_refrigerator(category, 'r-1', price=Decimal('250.50'))
+        self.client.login(username='Bobik', password='1234')
+        self.client.get('/add-to-cart/refrigerator/r-1/')
+
+    def post(self, **extra):
+        data = {'phone': '+375(44)1112233', 'address': 'Минск', 'buying_type': 'self', 'order_date': '2099-01-01',
+                'comment': ''}
+        data.update(extra)
+        return self.client.post('/make-order/', data, follow=True)
+
+    def test_double_submit_returns_existing_order(self):
+        response = self.client.get('/checkout/')
+        key = response.context['form'].initial['idempotency_key']
+        self.assertContains(response, 'name="idempotency_key" value="{}"'.format(key))
+        self.assertContains(self.post(idempotency_key=key), 'Спасибо за заказ!')
+        order = Order.objects.get()
+        self.assertContains(self.post(idempotency_key=key), 'Заказ №{} уже оформлен'.format(order.pk))
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(list(self.customer.orders.all()), [order])
+        self.assertTrue(order.cart.in_order)
+        self.assertEqual(order.idempotency_key, key)
+
+    def test_reused_key_does_not_order_new_cart(self):
+        self.post(idempotency_key='key-1')
+        self.client.get('/add-to-cart/refrigerator/r-1/')
+        self.assertContains(self.post(idempotency_key='key-1'), 'уже оформлен')
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertTrue(Cart.objects.filter(owner=self.customer, in_order=False).exists())
+
+    def test_checkout_writes_order_once(self):
+        cart = Cart.objects.get(owner=self.customer)
+        data = {'phone': '+375(44)1112233', 'address': 'Минск', 'buying_type': 'self', 'comment': '',
+                'order_date': timezone.now().date()}
+        # UPDATE корзины, INSERT заказа, INSERT связи покупателя, INSERT письма (+ точка сохранения в тесте)
+        with CaptureQueriesContext(connection) as queries:
+            order, created = checkout.place_order(self.customer, cart, self.customer.user, data, 'key-2')
+        self.assertTrue(created)
+        writes = [q['sql'].split()[0] for q in queries if 'SAVEPOINT' not in q['sql']]
+        self.assertEqual(writes, ['UPDATE', 'INSERT', 'INSERT', 'INSERT'])
+        self.assertEqual(checkout.place_order(self.customer, cart, self.customer.user, data), (order, False))
+
+
+class CartApiTestCases(TempMediaMixin, TestCase):
+
+    def setUp(self) -> None:
+        user = User.objects.create(username='Bobik')
+        user.set_password('1234')
+        user.save()
+        self.customer = Customer.objects.create(user=user)
+        category = Category.objects.create(name='Холодильники', slug='refrigerators')
+        for i, price in enumerate(('1000.00', '250.50', '99.99')):
+            make_refrigerator(category, 'r-{}'.format(i), price=Decimal(price))
+        self.client.login(username='Bobik', password='1234')
+
+    def post(self, *operations):
+        return self.client.post(
+            '/api/cart/', {'operations': [dict(op, ct_model='refrigerator') for op in operations]},
+            content_type='application/json'
+        )
+
+    def assertTotalsConsistent(self):
+        cart = Cart.objects.get(owner=self.customer, in_order=False)
+        self.assertEqual((cart.final_price, cart.total_products), get_cart_totals(cart))
+        return cart
+
+    def test_batch_is_applied_in_order(self):
+        response = self.post(
+            {'op': 'add', 'slug': 'r-0'}, {'op': 'add', 'slug': 'r-1', 'qty': 2}, {'op': 'add', 'slug': 'r-2'},
+            {'op': 'set_qty', 'slug': 'r-0', 'qty': 3}, {'op': 'remove', 'slug': 'r-2'}
+        )
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data['total_products'], data['final_price']), (2, '3501.00'))
+        self.assertEqual({item['slug']: item['qty'] for item in data['items']}, {'r-0': 3, 'r-1': 2})
+        cart = self.assertTotalsConsistent()
+        self.assertEqual(cart.final_price, Decimal('3501.00'))
+        self.assertEqual(self.client.get('/api/cart/').json(), data)
+
+    def test_add_to_existing_line_increments_qty(self):
+        self.post({'op': 'add', 'slug': 'r-1'})
+        data = self.post({'op': 'add', 'slug': 'r-1', 'qty': 2}, {'op': 'add', 'slug': 'r-1', 'qty': 3}).json()
+        self.assertEqual(data['items'], [
+            {'ct_model': 'refrigerator', 'slug': 'r-1', 'title': 'Test Refrigerator', 'qty': 6, 'final_price': '1503.00'}
+        ])
+        self.assertEqual((data['total_products'], data['final_price']), (1, '1503.00'))
+        self.assertTotalsConsistent()
+
+    def test_invalid_batch_changes_nothing(self):
+        self.post({'op': 'add', 'slug': 'r-0'})
+        response = self.post({'op': 'remove', 'slug': 'r-0'}, {'op': 'set_qty', 'slug': 'r-1', 'qty': 2})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('r-1', response.json()['errors'][0])
+        self.assertEqual(self.post({'op': 'add', 'slug': 'missing'}).status_code, 400)
+        self.assertEqual(self.post({'op': 'add', 'slug': 'r-1', 'qty': 0}).status_code, 400)
+        bad_json = self.client.post('/api/cart/', 'not json', content_type='application/json')
+        self.assertEqual(bad_json.status_code, 400)
+        self.assertEqual(list(CartProduct.objects.values_list('object_id', 'qty')), [(Refrigerator.objects.get(slug='r-0').pk, 1)])
+        self.assertTotalsConsistent()
+
+    def test_invalid_first_batch_does_not_create_cart(self):
+        response = self.post({'op': 'add', 'slug': 'r-0'}, {'op': 'set_qty', 'slug': 'r-1', 'qty': 2})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Cart.objects.exists())
+        self.assertFalse(CartProduct.objects.exists())
+
+    def test_each_update_is_a_single_line_write(self):
+        self.post(*[{'op': 'add', 'slug': 'r-{}'.format(i)} for i in range(3)])
+        with CaptureQueriesContext(connection) as one:
+            self.post({'op': 'set_qty', 'slug': 'r-0', 'qty': 2})
+        with CaptureQueriesContext(connection) as three:
+            self.post(*[{'op': 'set_qty', 'slug': 'r-{}'.format(i), 'qty': 5} for i in range(3)])
+        # один UPDATE на строку в PostgreSQL, два в SQLite; корзина целиком не перечитывается
+        statements = 1 if connection.vendor == 'postgresql' else 2
+        self.assertEqual(len(three) - len(one), 2 * statements)
+        self.assertTotalsConsistent()
+
+    def test_product_types_do_not_query_content_types(self):
+        self.post({'op': 'add', 'slug': 'r-0'})
+        with CaptureQueriesContext(connection) as queries:
+            self.post({'op': 'add', 'slug': 'r-1'}, {'op': 'set_qty', 'slug': 'r-0', 'qty': 2})
+            self.client.get('/add-to-cart/refrigerator/r-2/')
+        table = ContentType._meta.db_table
+        self.assertFalse([query['sql'] for query in queries if 'FROM "{}"'.format(table) in query['sql']])
+
+    def test_anonymous_user_is_rejected(self):
+        self.client.logout()
+        self.assertEqual(self.post({'op': 'add', 'slug': 'r-0'}).status_code, 403)
+        self.assertFalse(Cart.objects.exists())
+
+
+class CartLineWritesTestCases(TempMediaMixin, TestCase):
+
+    def setUp(self) -> None:
+        self.customer = Customer.objects.create(user=User.objects.create(username='Bobik'))
+        self.cart = Cart.objects.create(owner=self.customer)
+        category = Category.objects.create(name='Холодильники', slug='refrigerators')
+        make_refrigerator(category, 'r-1', price=Decimal('250.50'))
+        self.item = get_catalog_item('refrigerator', 'r-1')
+
+    def test_line_writes_return_exact_deltas(self):
+        self.assertEqual(add_cart_line(self.cart, self.item, 2), (Decimal('501.00'), 1))
+        # повторное добавление увеличивает количество в той же строке
+        self.assertEqual(add_cart_line(self.cart, self.item, 2), (Decimal('501.00'), 0))
+        line = CartProduct.objects.get(cart=self.cart)
+        self.assertEqual((line.qty, line.final_price), (4, Decimal('1002.00')))
+        self.assertEqual(set_cart_line_qty(self.cart, self.item, 1), (Decimal('-751.50'), 0))
+        self.assertEqual(add_cart_line(self.cart, self.item), (Decimal('250.50'), 0))
+        self.assertEqual(remove_cart_line(self.cart, self.item), (Decimal('-501.00'), -1))
+        self.assertEqual(remove_cart_line(self.cart, self.item), (0, 0))
+        self.assertIsNone(set_cart_line_qty(self.cart, self.item, 1))
+        self.assertFalse(Cart.products.through.objects.exists())
+
+    def test_duplicate_lines_are_rejected_by_db(self):
+        add_cart_line(self.cart, self.item)
+        self.assertEqual(self.cart.products.count(), 1)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            CartProduct.objects.create(user=self.customer, cart=self.cart, catalog_item=self.item,
+                                       content_type_id=self.item.content_type_id, object_id=self.item.object_id)
+
+
+@skipUnlessDBFeature('test_db_allows_multiple_connections')
+# без транзакции теста миниатюры строились бы в фоне и после удаления временного MEDIA_ROOT
+@override_settings(THUMBNAIL_BACKGROUND=False)
+class CartConcurrencyTestCases(TempMediaMixin, TransactionTestCase):
+    # параллельные потоки с отдельными соединениями (тестовая БД SQLite в памяти их не поддерживает)
+
+    def test_parallel_writes_keep_totals_consistent(self):
+        category = Category.objects.create(name='Холодильники', slug='refrigerators')
+        for i in range(3):
+            make_refrigerator(category, 'r-{}'.format(i), price=Decimal('100.10') * (i + 1))
+        out = StringIO()
+        call_command('stress_cart', threads=8, iterations=50, products=3, stdout=out)
+        self.assertIn('Итоги совпадают', out.getvalue())
+
+    def test_parallel_adds_increment_quantity(self):
+        category = Category.objects.create(name='Холодильники', slug='refrigerators')
+        for i in range(2):
+            make_refrigerator(category, 'r-{}'.format(i), price=Decimal('100.10') * (i + 1))
+        out = StringIO()
+        call_command('stress_cart', threads=8, iterations=30, products=2, operations='add', stdout=out)
+        self.assertIn('Количество совпадает с добавленным', out.getvalue())
+        self.assertIn('Итоги совпадают', out.getvalue())
+
+
+class BenchUrlsTestCases(TempMediaMixin, TransactionTestCase):
+    # без общей транзакции теста: в ней каждый atomic добавил бы к числу запросов SAVEPOINT и RELEASE
+
+    def test_every_route_fits_query_budget(self):
+        out = StringIO()
+        call_command('bench_urls', products=2, users=2, requests=3, concurrency=1, queries_only=True, stdout=out)
+        self.assertIn('Бюджеты соблюдены', out.getvalue())
+        self.assertFalse(get_user_model().objects.filter(username__startswith='bench-reg-').exists())
+
+
+class SyntheticDataTestCases(TempMediaMixin, TestCase):
+
+    def test_generated_orders_are_consistent(self):
+        out = StringIO()
+        call_command('generate_synthetic', products=2, customers=3, orders_per_customer=4, seed=0, stdout=out)
+        self.assertIn('Покупателей: 3, заказов: 12', out.getvalue())
+        self.assertEqual(CatalogItem.objects.count(), 6)
+        self.assertEqual(Order.objects.count(), 12)
+        self.assertEqual(Cart.objects.filter(in_order=False).count(), 3)
+        for customer in Customer.objects.all():
+            self.assertEqual(customer.orders.count(), 4)
+        for cart in Cart.objects.all():
+            self.assertEqual(get_cart_totals(cart), (cart.final_price, cart.total_products))
+        # ключи назначались заранее: новые строки продолжают нумерацию
+        self.assertGreater(Cart.objects.create(owner=Customer.objects.first()).pk, 15)
+        self.assertTrue(Refrigerator.objects.first().image.name.startswith('derivatives/'))
+
+    def test_empty_source_image_is_replaced_by_placeholder(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        with override_settings(MEDIA_ROOT=media_root):
+            for info in synthetic.CATALOG.values():
+                open(os.path.join(media_root, info['image']), 'wb').close()
+            images = synthetic.prepare_images()
+            for model, (name, digest) in images.items():
+                with Image.open(model._meta.get_field('image').storage.path(name)) as image:
+                    self.assertEqual(image.getpixel((0, 0)), (255, 255, 255))
+
+
+class MetricsTestCases(TempMediaMixin, TestCase):
+
+    def setUp(self) -> None:
+        cache.clear()
+        metrics.reset()
+        category = Category.objects.create(name='Холодильники', slug='refrigerators')
+        make_refrigerator(category, 'r-1')
+        self.staff = User.objects.create(username='admin', is_staff=True)
+
+    def test_views_are_measured(self):
+        self.client.get('/')
+        self.client.get('/')
+        self.client.get('/products/refrigerator/missing/')
+        base = metrics.get_view_metrics('base')
+        self.assertEqual(base.responses, {200: 2})
+        self.assertEqual(sum(base.latency.counts), 2)
+        self.assertGreater(base.queries.sum, 0)
+        self.assertGreater(base.query_seconds, 0)
+        # вторая главная страница - из кэша страниц
+        self.assertGreaterEqual(base.cache_hits, 1)
+        self.assertGreater(base.response_size.sum, 0)
+        self.assertEqual(metrics.get_view_metrics('product_detail').responses, {404: 1})
+
+        self.client.force_login(self.staff)
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn('shop_http_responses_total{view="base",status="200"} 2', text)
+        self.assertIn('shop_http_request_duration_seconds_bucket{view="base",le="+Inf"} 2', text)
+        self.assertIn('shop_cache_hits_total{cache="page"} 1', text)
+        self.assertIn('# TYPE shop_db_queries_per_request histogram', text)
+
+    def test_endpoint_requires_staff_or_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.client.force_login(User.objects.create(username='bobik'))
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        with override_settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+    def test_request_stats_from_parallel_threads_are_exact(self):
+        stats = metrics.RequestStats()
+
+        def work():
+            for _ in range(10000):
+                stats.add_query(0.001)
+                stats.add_cache(True)
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((stats.queries, stats.cache_hits, stats.cache_misses), (80000, 80000, 0))
+        self.assertAlmostEqual(stats.query_time, 80)
+
+    def test_async_views_count_queries_from_worker_threads(self):
+        middleware = MetricsMiddleware(AsyncContactsView.as_view())
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        request = RequestFactory().get('/contacts/')
+        request.user = self.staff
+        request.resolver_match = resolve('/contacts/')
+        response = async_to_sync(middleware)(request)
+        self.assertEqual(response.status_code, 200)
+        contacts = metrics.get_view_metrics('contacts')
+        self.assertEqual(contacts.responses, {200: 1})
+        self.assertGreater(contacts.queries.sum, 0)
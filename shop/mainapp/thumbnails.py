@@ -0,0 +1,157 @@
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from PIL import Image, features
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+# производные картинки лежат в derivatives/<sha256 исходника>/<ширина>.<формат>:
+# имя однозначно задается содержимым, поэтому их можно кэшировать бессрочно
+DERIVATIVES_DIR = 'derivatives'
+DERIVATIVE_WIDTHS = (150, 300, 600)
+# ширина основной миниатюры (Product.image); у маленьких исходников - наибольшая построенная меньше нее
+MAIN_WIDTH = 300
+
+
+def _has_feature(feature):
+    try:
+        return bool(features.check(feature))
+    except ValueError:
+        return False
+
+
+# (расширение, формат PIL, mime-тип, параметры сохранения) от более компактного к универсальному
+DERIVATIVE_FORMATS = tuple(
+    item for item in (
+        ('avif', 'AVIF', 'image/avif', {'quality': 60}),
+        ('webp', 'WEBP', 'image/webp', {'quality': 80}),
+        ('jpeg', 'JPEG', 'image/jpeg', {'quality': 90}),
+    )
+    if item[0] != 'avif' or _has_feature('avif')
+)
+
+
+def image_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _fit(source_image, size):
+    # картинка вписывается в белый фон size (только уменьшение)
+    background = Image.new('RGB', size, "white")
+    image = source_image.copy()
+    image.thumbnail(size)
+    (w, h) = image.size
+    background.paste(image, ((size[0] - w) // 2, (size[1] - h) // 2))
+    return background
+
+
+def _box(width, size):
+    return width, width * size[1] // size[0]
+
+
+def fitting_widths(source_size, size):
+    # ширины, для которых исходник не приходится увеличивать (thumbnail только уменьшает: крупнее было бы
+    # то же изображение на большем белом фоне); самая маленькая строится всегда
+    widths = tuple(
+        width for width in DERIVATIVE_WIDTHS
+        if source_size[0] >= _box(width, size)[0] or source_size[1] >= _box(width, size)[1]
+    )
+    return widths or DERIVATIVE_WIDTHS[:1]
+
+
+def main_derivative(widths):
+    return '{}.jpeg'.format(max(width for width in widths if width <= MAIN_WIDTH))
+
+
+def render_derivatives(data, size):
+    # все размеры и форматы за один разбор исходника; выполняется в пуле процессов
+    source_image = Image.open(BytesIO(data)).convert("RGB")
+    result = {}
+    for width in fitting_widths(source_image.size, size):
+        image = _fit(source_image, _box(width, size))
+        for extension, pil_format, _, options in DERIVATIVE_FORMATS:
+            filestream = BytesIO()
+            image.save(filestream, pil_format, **options)
+            result['{}.{}'.format(width, extension)] = filestream.getvalue()
+    return result
+
+
+def derivatives_prefix(digest):
+    return '{}/{}/'.format(DERIVATIVES_DIR, digest)
+
+
+def rendered_widths(derivatives):
+    # ширины по именам производных ('300.jpeg' и т.п.)
+    return tuple(sorted({int(name.split('.')[0]) for name in derivatives}))
+
+
+# {(хранилище, каталог хранилища, префикс): ширины}: производные неизменны, поэтому список построенных
+# запоминается (каталог - в ключе: MEDIA_ROOT меняется в тестах, а объект хранилища тот же)
+_available_widths = {}
+
+
+def get_available_widths(storage, prefix):
+    key = (storage, getattr(storage, 'location', None), prefix)
+    widths = _available_widths.get(key)
+    if widths is None:
+        widths = tuple(width for width in DERIVATIVE_WIDTHS if storage.exists('{}{}.jpeg'.format(prefix, width)))
+        # пока производных нет, результат не запоминается
+        if widths:
+            _available_widths[key] = widths
+    return widths
+
+
+def get_derivatives_prefix(image_name):
+    # префикс производных, если image уже указывает на одну из них, иначе None
+    parts = (image_name or '').split('/')
+    if len(parts) == 3 and parts[0] == DERIVATIVES_DIR:
+        return derivatives_prefix(parts[1])
+    return None
+
+
+def get_executor():
+    # пул процессов создается при первой загрузке картинки в этом процессе
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=settings.THUMBNAIL_WORKERS)
+    return _executor
+
+
+def schedule_thumbnail(model, pk, digest, data):
+    future = get_executor().submit(render_derivatives, data, model.THUMBNAIL_SIZE)
+    future.add_done_callback(lambda f: _store_from_future(model, pk, digest, f))
+
+
+def _store_from_future(model, pk, digest, future):
+    # выполняется в служебном потоке пула, поэтому соединения с БД закрываются за собой
+    try:
+        store_derivatives(model, pk, digest, future.result())
+    except Exception:
+        logger.exception('Не удалось построить миниатюры %s %s', model._meta.model_name, pk)
+    finally:
+        connections.close_all()
+
+
+def store_derivatives(model, pk, digest, derivatives):
+    # картинку могли заменить, пока строились миниатюры - тогда результат уже не нужен
+    product = model._base_manager.filter(pk=pk, image_hash=digest).first()
+    if product is None:
+        return None
+    storage = product.image.storage
+    prefix = derivatives_prefix(digest)
+    for name, content in derivatives.items():
+        if not storage.exists(prefix + name):
+            storage.save(prefix + name, ContentFile(content))
+    source_name = product.image.name
+    product.image = prefix + main_derivative(rendered_widths(derivatives))
+    product.save(update_fields=['image'])
+    if get_derivatives_prefix(source_name) is None:
+        storage.delete(source_name)
+    return product.image.name
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import path
 from django.contrib.auth.views import LogoutView
 
@@ -14,9 +15,20 @@ from .views import (
     ContactsView,
     LoginView,
     RegistrationView,
-    ProfileView
+    ProfileView,
+    SearchView,
+    CartApiView,
+    AsyncBaseView,
+    AsyncProductDetailView,
+    AsyncCategoryDetailView,
+    AsyncContactsView
 )
 
+if settings.ASYNC_VIEWS:
+    BaseView, ProductDetailView, CategoryDetailView, ContactsView = (
+        AsyncBaseView, AsyncProductDetailView, AsyncCategoryDetailView, AsyncContactsView
+    )
+
 urlpatterns = [
     path('', BaseView.as_view(), name='base'),
     path('products/<str:ct_model>/<str:slug>/', ProductDetailView.as_view(), name='product_detail'),
@@ -31,5 +43,7 @@ urlpatterns = [
     path('login/', LoginView.as_view(), name='login'),
     path('logout/', LogoutView.as_view(next_page="/"), name='logout'),
     path('registration/', RegistrationView.as_view(), name='registration'),
-    path('profile/', ProfileView.as_view(), name='profile')
+    path('profile/', ProfileView.as_view(), name='profile'),
+    path('search/', SearchView.as_view(), name='search'),
+    path('api/cart/', CartApiView.as_view(), name='cart_api')
 ]
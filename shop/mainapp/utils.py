@@ -1,11 +1,201 @@
-from django.db import models
+from decimal import Decimal
 
+from django.core.exceptions import ValidationError
+from django.db import connection, models
+from django.db.models import F, Prefetch, Q, prefetch_related_objects
 
-def recalc_cart(cart):
+from .models import Cart, CartProduct, CatalogItem
+from .product_types import registry as product_types
+
+
+def change_cart_totals(cart, price_delta, products_delta=0):
+    # атомарное изменение итогов корзины на величину изменения строки
+    # (UPDATE ... SET final_price = final_price + delta) вместо пересчета всех строк
+    Cart.objects.filter(pk=cart.pk).update(
+        final_price=F('final_price') + price_delta,
+        total_products=F('total_products') + products_delta
+    )
+    cart.final_price += price_delta
+    cart.total_products += products_delta
+
+
+def get_cart_totals(cart):
+    # итоги корзины, посчитанные заново по ее строкам
     cart_data = cart.products.aggregate(models.Sum('final_price'), models.Count('id'))
-    if cart_data.get('final_price__sum'):
-        cart.final_price = cart_data['final_price__sum']
-    else:
-        cart.final_price = 0
-    cart.total_products = cart_data['id__count']
+    return cart_data.get('final_price__sum') or 0, cart_data['id__count']
+
+
+def recalc_cart(cart):
+    # полный пересчет итогов по строкам корзины (для проверки и восстановления)
+    cart.final_price, cart.total_products = get_cart_totals(cart)
     cart.save()
+
+
+# строки корзины пишутся отдельными SQL-операторами без предварительного чтения:
+# уникальность строки (корзина, товар) гарантирует БД, а изменение итогов корзины
+# берется из RETURNING того же оператора, поэтому параллельные запросы не теряют изменений.
+# Функции возвращают (изменение стоимости, изменение числа строк) для change_cart_totals
+
+
+PRICE_QUANTUM = Decimal('0.01')
+
+
+def _to_price(value):
+    # SQLite возвращает из raw SQL число с плавающей точкой
+    return Decimal(str(value)).quantize(PRICE_QUANTUM)
+
+
+def _line_sql(sql, params):
+    qn = connection.ops.quote_name
+    names = dict(
+        line=qn(CartProduct._meta.db_table), through=qn(Cart.products.through._meta.db_table),
+        id=qn('id'), user=qn('user_id'), cart=qn('cart_id'), type=qn('content_type_id'), object=qn('object_id'),
+        item=qn('catalog_item_id'), qty=qn('qty'), price=qn('final_price'), line_ref=qn('cartproduct_id')
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql.format(**names), params)
+        # без RETURNING строк нет: psycopg2 в этом случае не дает вызвать fetchall
+        return cursor.fetchall() if cursor.description else []
+
+
+def add_cart_line(cart, item, qty=1):
+    # INSERT ... ON CONFLICT DO UPDATE: товар, уже лежащий в корзине, не дублируется, а его количество
+    # и стоимость увеличиваются тем же оператором. Строка новая, если после оператора в ней ровно qty
+    # (у существующей строки количество не меньше 1, и к нему прибавилось qty)
+    final_price = qty * item.price
+    rows = _line_sql(
+        'INSERT INTO {line} ({user}, {cart}, {type}, {object}, {item}, {qty}, {price}) '
+        'VALUES (%s, %s, %s, %s, %s, %s, %s) '
+        'ON CONFLICT ({cart}, {type}, {object}) DO UPDATE SET '
+        '{qty} = {line}.{qty} + excluded.{qty}, {price} = {line}.{price} + excluded.{price} '
+        'RETURNING {id}, {qty}',
+        [cart.owner_id, cart.pk, item.content_type_id, item.object_id, item.pk, qty, final_price]
+    )
+    line_id, line_qty = rows[0]
+    if line_qty != qty:
+        return final_price, 0
+    Cart.products.through.objects.bulk_create(
+        [Cart.products.through(cart_id=cart.pk, cartproduct_id=line_id)], ignore_conflicts=True
+    )
+    return final_price, 1
+
+
+def set_cart_line_qty(cart, item, qty):
+    # None, если такой строки в корзине нет
+    params = [qty, qty * item.price, item.pk, cart.pk, item.content_type_id, item.object_id]
+    if connection.vendor == 'postgresql':
+        # прежняя стоимость читается подзапросом с блокировкой строки внутри того же UPDATE
+        rows = _line_sql(
+            'UPDATE {line} SET {qty} = %s, {price} = %s, {item} = %s '
+            'FROM (SELECT {id}, {price} FROM {line} WHERE {cart} = %s AND {type} = %s AND {object} = %s '
+            'FOR UPDATE) AS prev WHERE {line}.{id} = prev.{id} '
+            'RETURNING {line}.{price} - prev.{price}',
+            params
+        )
+    else:
+        # SQLite не умеет ссылаться в RETURNING на подзапрос: прежняя стоимость берется пустым UPDATE,
+        # который сразу захватывает блокировку записи (другой писатель не вклинится до конца транзакции)
+        where = 'WHERE {cart} = %s AND {type} = %s AND {object} = %s RETURNING {price}'
+        old = _line_sql('UPDATE {line} SET {qty} = {qty} ' + where, params[3:])
+        new = _line_sql('UPDATE {line} SET {qty} = %s, {price} = %s, {item} = %s ' + where, params)
+        rows = [(_to_price(new[0][0]) - _to_price(old[0][0]),)] if old and new else []
+    if not rows:
+        return None
+    return _to_price(rows[0][0]), 0
+
+
+def remove_cart_line(cart, item):
+    # DELETE ... RETURNING: стоимость удаленной строки; повторное удаление ничего не меняет.
+    # Сначала удаляется (и блокируется) сама строка, затем ее связь с корзиной по полученному id:
+    # при обратном порядке связь строки, добавленной параллельно между двумя DELETE, осталась бы
+    # и нарушила внешний ключ (проверка отложена до конца транзакции - вызывать внутри atomic)
+    rows = _line_sql(
+        'DELETE FROM {line} WHERE {cart} = %s AND {type} = %s AND {object} = %s RETURNING {id}, {price}',
+        [cart.pk, item.content_type_id, item.object_id]
+    )
+    if not rows:
+        return 0, 0
+    _line_sql('DELETE FROM {through} WHERE {line_ref} = %s', [rows[0][0]])
+    return -_to_price(rows[0][1]), -1
+
+
+def get_catalog_item(ct_model, slug):
+    # карточка товара по адресу: тип берется из реестра без запроса, поиск - по индексу (тип, slug)
+    product_type = product_types.get(ct_model)
+    if product_type is None:
+        raise CatalogItem.DoesNotExist('Неизвестный тип товара: {}'.format(ct_model))
+    return CatalogItem.objects.get(content_type_id=product_type.content_type_id, slug=slug)
+
+
+def _cart_products_prefetch(lookup='products'):
+    # строки - в порядке добавления (без ORDER BY Postgres возвращает их в произвольном порядке)
+    return Prefetch(lookup, queryset=CartProduct.objects.select_related('catalog_item').order_by('pk'))
+
+
+def load_cart_items(*carts):
+    # подгружает строки корзин вместе с карточками товаров одним запросом (независимо от числа
+    # типов товаров), после чего cart.products.all и item.catalog_item в шаблонах не делают запросов
+    carts = [cart for cart in carts if cart is not None]
+    prefetch_related_objects(carts, _cart_products_prefetch())
+    return carts
+
+
+def load_order_items(orders):
+    # то же для заказов: order.cart должен быть загружен через select_related('cart')
+    orders = list(orders)
+    load_cart_items(*[order.cart for order in orders])
+    return orders
+
+
+class KeysetPage:
+
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def _keyset_fields(queryset, ordering):
+    opts = queryset.model._meta
+    return [(opts.get_field(name.lstrip('-')), name.startswith('-')) for name in ordering]
+
+
+def keyset_paginate(queryset, ordering, cursor=None, page_size=20):
+    # постраничный вывод по ключу (WHERE (a, b) > (..) ORDER BY a, b LIMIT n) вместо OFFSET:
+    # стоимость страницы не зависит от ее номера; последним полем ordering должен быть уникальный ключ
+    fields = _keyset_fields(queryset, ordering)
+    if cursor:
+        values = decode_cursor(cursor, fields)
+        condition, equal = Q(), {}
+        for (field, descending), value in zip(fields, values):
+            lookup = '{}__{}'.format(field.name, 'lt' if descending else 'gt')
+            condition |= Q(**equal, **{lookup: value})
+            equal[field.name] = value
+        queryset = queryset.filter(condition)
+    items = list(queryset.order_by(*ordering)[:page_size + 1])
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        next_cursor = encode_cursor(items[-1], fields)
+    return KeysetPage(items, next_cursor)
+
+
+def encode_cursor(item, fields):
+    return ','.join(str(getattr(item, field.attname)) for field, _ in fields)
+
+
+def decode_cursor(cursor, fields):
+    # ValidationError, если курсор поврежден
+    values = cursor.split(',')
+    if len(values) != len(fields):
+        raise ValidationError('Неверный курсор')
+    return [field.to_python(value) for (field, _), value in zip(fields, values)]
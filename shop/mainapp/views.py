@@ -2,26 +2,35 @@ from django.db import transaction
 from django.shortcuts import render
 from django.contrib import messages
 from django.contrib.auth import authenticate, login
-from django.contrib.contenttypes.models import ContentType
-from django.http import HttpResponseRedirect
+from django.conf import settings
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.paginator import Paginator
+from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse
 from django.views.generic import DetailView, View
-from django.core.mail import send_mail, EmailMessage
 
-from threading import Thread
+import hmac
+import json
+import logging
+import uuid
+from functools import partial
 
-from .models import Refrigerator, Washer, Dishwasher, Category, \
-    LatestProducts, Customer, CartProduct, Order
-from .mixins import CategoryDetailMixin, CartMixin
+from .models import Category, LatestProducts, Customer, Order, get_product_models
+from .product_types import registry as product_types
+from .mixins import AsyncCartMixin, AsyncPageCacheMixin, CategoryDetailMixin, CartMixin, PageCacheMixin
+from . import cart_operations, checkout, metrics, outbox, page_cache, search
 from .forms import OrderForm, LoginForm, RegistrationForm
-from .utils import recalc_cart
-from shop.settings import logging_file, logging_level, EMAIL_HOST_USER
+from .utils import add_cart_line, change_cart_totals, get_catalog_item, keyset_paginate, load_cart_items, \
+    load_order_items, remove_cart_line, set_cart_line_qty
 
-import logging
+logger = logging.getLogger(__name__)
+# изменения корзины - самые частые записи, для них в LOGGING задана выборка
+cart_logger = logging.getLogger(__name__ + '.cart')
 
-logging.basicConfig(filename=logging_file, filemode='w', level=getattr(logging, logging_level))
 
+class BaseView(PageCacheMixin, CartMixin, View):
 
-class BaseView(CartMixin, View):
+    def get_cache_scopes(self):
+        return (page_cache.SIDEBAR_SCOPE,) + tuple(map(page_cache.product_scope, get_product_models()))
 
     def get(self, request, *args, **kwargs):
         categories = Category.objects.get_categories_for_up_sidebar()
@@ -31,22 +40,24 @@ class BaseView(CartMixin, View):
         context = {
             'categories': categories,
             'products': products,
-            'cart': self.cart
+            'cart': self.cart,
+            **self.get_cache_context()
         }
         return render(request, 'base.html', context)
 
 
-class ProductDetailView(CartMixin, CategoryDetailMixin, DetailView):
-    CT_MODEL_MODEL_CLASS = {
-        'refrigerator': Refrigerator,
-        'washer': Washer,
-        'dishwasher': Dishwasher
-    }
+class ProductDetailView(PageCacheMixin, CartMixin, CategoryDetailMixin, DetailView):
 
-    def dispatch(self, request, *args, **kwargs):
-        self.model = self.CT_MODEL_MODEL_CLASS[kwargs['ct_model']]
+    def setup(self, request, *args, **kwargs):
+        super().setup(request, *args, **kwargs)
+        product_type = product_types.get(kwargs['ct_model'])
+        if product_type is None:
+            raise Http404('Неизвестный тип товара')
+        self.model = product_type.model
         self.queryset = self.model._base_manager.all()
-        return super().dispatch(request, *args, **kwargs)
+
+    def get_cache_scopes(self):
+        return super().get_cache_scopes() + (page_cache.product_scope(self.model),)
 
     # model = Model
     # queryset = Model.objects.all()
@@ -59,84 +70,125 @@ class ProductDetailView(CartMixin, CategoryDetailMixin, DetailView):
         context = super().get_context_data(**kwargs)
         context['ct_model'] = self.model._meta.model_name
         context['cart'] = self.cart
+        context.update(self.get_cache_context())
         return context
 
 
-class CategoryDetailView(CartMixin, CategoryDetailMixin, DetailView):
+class CategoryDetailView(PageCacheMixin, CartMixin, CategoryDetailMixin, DetailView):
     model = Category
     queryset = Category.objects.all()
     context_object_name = 'category'
     template_name = 'category_detail.html'
     slug_url_kwarg = 'slug'
 
+    def get_cache_scopes(self):
+        product_type = product_types.for_category(self.kwargs['slug'])
+        return super().get_cache_scopes() + ((page_cache.product_scope(product_type.model),) if product_type else ())
+
     # информация о конкретной модели (строковое представление)
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['cart'] = self.cart
+        context.update(self.get_cache_context())
         return context
 
 
 class AddToCartView(CartMixin, View):
 
     def get(self, request, *args, **kwargs):
-        ct_model, product_slug = kwargs.get('ct_model'), kwargs.get('slug')
-        content_type = ContentType.objects.get(model=ct_model)
-        product = content_type.model_class().objects.get(slug=product_slug)
-        if not self.cart is None:
-            cart_product, created = CartProduct.objects.get_or_create(
-                user=self.cart.owner, cart=self.cart, content_type=content_type, object_id=product.id
-            )
-            if created:
-                self.cart.products.add(cart_product)
-            recalc_cart(self.cart)
+        item = get_catalog_item(kwargs.get('ct_model'), kwargs.get('slug'))
+        cart = self.shopper.get_or_create_cart()
+        if cart is not None:
+            with transaction.atomic():
+                change_cart_totals(cart, *add_cart_line(cart, item))
             messages.info(request, "Товар успешно добавлен")
-            logging.info("Товар успешно добавлен")
+            cart_logger.info("Товар добавлен в корзину", extra={'cart': cart.pk, 'item': item.pk})
             # перевод пользователя в корзину
             return HttpResponseRedirect('/cart/')
         messages.error(request, "Для добавления товаров в корзину пройдите авторизацию/регистрацию")
-        logging.error("Для добавления товаров в корзину пройдите авторизацию/регистрацию")
+        cart_logger.info("Добавление в корзину без авторизации", extra={'item': item.pk})
         return HttpResponseRedirect('/')
 
 
 class DeleteFromCartView(CartMixin, View):
 
     def get(self, request, *args, **kwargs):
-        ct_model, product_slug = kwargs.get('ct_model'), kwargs.get('slug')
-        content_type = ContentType.objects.get(model=ct_model)
-        product = content_type.model_class().objects.get(slug=product_slug)
-        cart_product = CartProduct.objects.get(
-            user=self.cart.owner, cart=self.cart, content_type=content_type, object_id=product.id
-        )
-        self.cart.products.remove(cart_product)
-        cart_product.delete()
-        recalc_cart(self.cart)
+        item = get_catalog_item(kwargs.get('ct_model'), kwargs.get('slug'))
+        if self.cart is None:
+            # корзина еще не создана или пользователь не авторизован
+            messages.error(request, "Товара нет в корзине")
+            return HttpResponseRedirect('/cart/')
+        with transaction.atomic():
+            price_delta, products_delta = remove_cart_line(self.cart, item)
+            if products_delta:
+                change_cart_totals(self.cart, price_delta, products_delta)
         messages.info(request, "Товар успешно удален")
-        logging.info("Товар успешно удален")
+        cart_logger.info("Товар удален из корзины", extra={'cart': self.cart.pk, 'item': item.pk})
         return HttpResponseRedirect('/cart/')
 
 
 class ChangeQtyView(CartMixin, View):
 
     def post(self, request, *args, **kwargs):
-        ct_model, product_slug = kwargs.get('ct_model'), kwargs.get('slug')
-        content_type = ContentType.objects.get(model=ct_model)
-        product = content_type.model_class().objects.get(slug=product_slug)
-        cart_product = CartProduct.objects.get(
-            user=self.cart.owner, cart=self.cart, content_type=content_type, object_id=product.id
-        )
+        item = get_catalog_item(kwargs.get('ct_model'), kwargs.get('slug'))
         qty = int(request.POST.get('qty'))
-        cart_product.qty = qty
-        cart_product.save()
-        recalc_cart(self.cart)
+        if self.cart is None:
+            messages.error(request, "Товара нет в корзине")
+            return HttpResponseRedirect('/cart/')
+        with transaction.atomic():
+            delta = set_cart_line_qty(self.cart, item, qty)
+            if delta is not None:
+                change_cart_totals(self.cart, *delta)
+        if delta is None:
+            messages.error(request, "Товара нет в корзине")
+            return HttpResponseRedirect('/cart/')
         messages.info(request, "Количество успешно изменено")
-        logging.info("Количество успешно изменено")
+        cart_logger.info("Количество изменено", extra={'cart': self.cart.pk, 'item': item.pk, 'qty': qty})
         return HttpResponseRedirect('/cart/')
 
 
+class CartApiView(CartMixin, View):
+    # пакет изменений корзины одним запросом: POST {"operations": [{"op": "add"|"remove"|"set_qty",
+    # "ct_model": ..., "slug": ..., "qty": ...}, ...]} -> итоги корзины в JSON (GET - текущие итоги)
+
+    def get(self, request, *args, **kwargs):
+        if self.shopper.customer is None:
+            return self.error_response('Для работы с корзиной пройдите авторизацию/регистрацию', status=403)
+        cart = self.shopper.cart
+        if cart is None:
+            return JsonResponse({'total_products': 0, 'final_price': '0.00', 'items': []})
+        load_cart_items(cart)
+        return JsonResponse(cart_operations.get_summary(cart, cart.products.all()))
+
+    def post(self, request, *args, **kwargs):
+        if self.shopper.customer is None:
+            return self.error_response('Для работы с корзиной пройдите авторизацию/регистрацию', status=403)
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return self.error_response('Тело запроса должно быть в формате JSON')
+        try:
+            operations = cart_operations.parse_operations(data)
+            items = cart_operations.resolve_items([key for _, key, _ in operations])
+            # новая корзина создается в транзакции пакета: пакет с ошибкой не оставляет пустую корзину
+            with transaction.atomic():
+                cart = self.shopper.get_or_create_cart()
+                lines = cart_operations.apply_operations(cart, operations, items)
+        except ValidationError as e:
+            return self.error_response(*e.messages)
+        cart_logger.info("Корзина изменена: операций %s", len(operations), extra={'cart': cart.pk})
+        return JsonResponse(cart_operations.get_summary(cart, lines))
+
+    @staticmethod
+    def error_response(*messages, status=400):
+        return JsonResponse({'errors': list(messages)}, status=status)
+
+
 class CartView(CartMixin, View):
 
     def get(self, request, *args, **kwargs):
         categories = Category.objects.get_categories_for_up_sidebar()
+        load_cart_items(self.cart)
         context = {
             'cart': self.cart,
             'categories': categories
@@ -148,7 +200,9 @@ class CheckoutView(CartMixin, View):
 
     def get(self, request, *args, **kwargs):
         categories = Category.objects.get_categories_for_up_sidebar()
-        form = OrderForm(request.POST or None)
+        # новый ключ на каждый показ формы: повторная отправка этой же формы не создаст второй заказ
+        form = OrderForm(request.POST or None, initial={'idempotency_key': uuid.uuid4().hex})
+        load_cart_items(self.cart)
         context = {
             'cart': self.cart,
             'categories': categories,
@@ -159,30 +213,24 @@ class CheckoutView(CartMixin, View):
 
 class MakeOrderView(CartMixin, View):
 
-    @transaction.atomic
     def post(self, request, *args, **kwargs):
         form = OrderForm(request.POST or None)
-        customer = Customer.objects.get(user=request.user)
-        logging.error("customer is {}".format(customer.user))
+        # ключ идемпотентности - из скрытого поля формы (см. CheckoutView) или заголовка Idempotency-Key
+        idempotency_key = request.POST.get('idempotency_key') or request.headers.get('Idempotency-Key')
+        if self.cart is None and not idempotency_key:
+            return HttpResponseRedirect('/cart/')
 
         if form.is_valid():
-            new_order = form.save(commit=False)
-            new_order.customer = customer
-            new_order.first_name = request.user.first_name
-            new_order.last_name = request.user.last_name
-            new_order.phone = form.cleaned_data['phone']
-            new_order.address = form.cleaned_data['address']
-            new_order.buying_type = form.cleaned_data['buying_type']
-            new_order.order_date = form.cleaned_data['order_date']
-            new_order.comment = form.cleaned_data['comment']
-            new_order.save()
-            self.cart.in_order = True
-            self.cart.save()
-            new_order.cart = self.cart
-            new_order.save()
-            customer.orders.add(new_order)
-            messages.add_message(request, messages.INFO, 'Спасибо за заказ!')
-            logging.info('Спасибо за заказ!')
+            order, created = checkout.place_order(
+                self.shopper.customer, self.cart, request.user, form.cleaned_data, idempotency_key
+            )
+            if order is None:
+                return HttpResponseRedirect('/cart/')
+            if created:
+                messages.add_message(request, messages.INFO, 'Спасибо за заказ!')
+                logger.info('Оформлен заказ %s', order.pk, extra={'order': order.pk, 'cart': order.cart_id})
+            else:
+                messages.add_message(request, messages.INFO, 'Заказ №{} уже оформлен'.format(order.pk))
             return HttpResponseRedirect('/')
         context = {'form': form, 'cart': self.cart}
         return render(request, 'checkout.html', context)
@@ -244,41 +292,124 @@ class RegistrationView(CartMixin, View):
             new_user.email = form.cleaned_data['email']
             new_user.first_name = form.cleaned_data['first_name']
             new_user.last_name = form.cleaned_data['last_name']
-            new_user.save()
             new_user.set_password(form.cleaned_data['password'])
-            new_user.save()
-            Customer.objects.create(
-                user=new_user,
-                phone=form.cleaned_data['phone'],
-                address=form.cleaned_data['address'],
-            )
-            user = authenticate(username=form.cleaned_data['username'], password=form.cleaned_data['password'])
-            login(request, user)
-
-            # отправка письма об успешной регистрации
-            message = f'''Здравствуйте, {user.first_name} {user.last_name}!  
+            # письмо об успешной регистрации ставится в очередь вместе с пользователем
+            message = f'''Здравствуйте, {new_user.first_name} {new_user.last_name}!
             Регистрация прошла успешно
             Приятных Вам покупок
                                                                                         Администрация Shop'''
-            t = Thread(target=send_mail, args=('Регистрация Shop', message, EMAIL_HOST_USER,
-                                               [user.email]), kwargs={'fail_silently': False})
-            t.start()
-            # send_mail('Регистрация Shop', message, 'shop1234django@gmail.com',
-            #          [user.email], fail_silently=False)
+            with transaction.atomic():
+                new_user.save()
+                Customer.objects.create(
+                    user=new_user,
+                    phone=form.cleaned_data['phone'],
+                    address=form.cleaned_data['address'],
+                )
+                outbox.enqueue('Регистрация Shop', message, [new_user.email])
+            user = authenticate(username=form.cleaned_data['username'], password=form.cleaned_data['password'])
+            login(request, user)
             return HttpResponseRedirect('/')
         context = {'form': form, 'cart': self.cart}
         return render(request, 'registration.html', context)
 
 
 class ProfileView(CartMixin, View):
+    paginate_by = 10
 
     def get(self, request, *args, **kwargs):
-        customer = Customer.objects.get(user=request.user)
-        orders = Order.objects.filter(customer=customer).order_by('-created_at')
+        customer = self.shopper.customer
+        queryset = Order.objects.filter(customer=customer).select_related('cart', 'customer')
+        try:
+            page = keyset_paginate(queryset, ('-id',), request.GET.get('after'), self.paginate_by)
+        except ValidationError:
+            raise Http404('Неверная страница')
+        orders = load_order_items(page.items)
         categories = Category.objects.get_categories_for_up_sidebar()
         context = {
             'orders': orders,
+            'page': page,
             'cart': self.cart,
             'categories': categories
         }
         return render(request, 'profile.html', context)
+
+
+class SearchView(CartMixin, View):
+    paginate_by = 12
+
+    def get(self, request, *args, **kwargs):
+        query = request.GET.get('q', '').strip()
+        paginator = Paginator(search.search(query), self.paginate_by)
+        page = paginator.get_page(request.GET.get('page'))
+        categories = Category.objects.get_categories_for_up_sidebar()
+        context = {
+            'query': query,
+            'page': page,
+            'products': search.load_results(page),
+            'categories': categories,
+            'cart': self.cart
+        }
+        return render(request, 'search.html', context)
+
+
+class MetricsView(View):
+    # метрики процесса для Prometheus: для сотрудников или по токену METRICS_TOKEN (Authorization: Bearer ...)
+
+    def get(self, request, *args, **kwargs):
+        token = settings.METRICS_TOKEN
+        authorization = request.headers.get('Authorization', '')
+        if not request.user.is_staff and not (
+            token and hmac.compare_digest(authorization.encode(), 'Bearer {}'.format(token).encode())
+        ):
+            raise PermissionDenied
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# асинхронные версии страниц каталога (подключаются в urls.py при ASYNC_VIEWS, см. shop/asgi.py):
+# боковое меню, товары и корзина запрашиваются одновременно, шаблон рисуется в потоке пула
+
+
+class AsyncBaseView(AsyncPageCacheMixin, BaseView):
+
+    async def get(self, request, *args, **kwargs):
+        categories, products, cart = await self.gather_sync(
+            Category.objects.get_categories_for_up_sidebar,
+            partial(LatestProducts.objects.get_products_for_main_page,
+                    'refrigerator', 'washer', 'dishwasher', with_respect_to='dishwasher'),
+            lambda: self.cart
+        )
+        context = {
+            'categories': categories,
+            'products': products,
+            'cart': cart,
+            **self.get_cache_context()
+        }
+        return await self.run_sync(render, request, 'base.html', context)
+
+
+class AsyncDetailMixin:
+
+    async def get(self, request, *args, **kwargs):
+        self.object, categories, _ = await self.gather_sync(
+            self.get_object, Category.objects.get_categories_for_up_sidebar, lambda: self.cart
+        )
+        return await self.run_sync(self.render_page, categories=categories)
+
+    def render_page(self, **kwargs):
+        context = self.get_context_data(object=self.object, **kwargs)
+        return self.render_to_response(context).render()
+
+
+class AsyncProductDetailView(AsyncDetailMixin, AsyncPageCacheMixin, ProductDetailView):
+    pass
+
+
+class AsyncCategoryDetailView(AsyncDetailMixin, AsyncPageCacheMixin, CategoryDetailView):
+    pass
+
+
+class AsyncContactsView(AsyncCartMixin, ContactsView):
+
+    async def get(self, request, *args, **kwargs):
+        categories, cart = await self.gather_sync(Category.objects.get_categories_for_up_sidebar, lambda: self.cart)
+        return await self.run_sync(render, request, 'contacts.html', {'categories': categories, 'cart': cart})
@@ -42,6 +42,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'mainapp.middleware.RequestIdMiddleware',
+    # в начале цепочки: учитывает время и SQL-запросы всех остальных слоев (mainapp.metrics, /metrics)
+    'mainapp.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -82,15 +85,33 @@ WSGI_APPLICATION = 'shop.wsgi.application'
 #     }
 # }
 
+# соединения с БД берутся из пула рабочего процесса (mainapp.db_pool) и возвращаются в него в конце
+# запроса (CONN_MAX_AGE = 0), поэтому подключение не повторяется на каждый запрос.
+# SHOP_DB_POOL=0 - без пула: новое соединение на каждый запрос
+DB_POOL = os.environ.get('SHOP_DB_POOL', '1') == '1'
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'ENGINE': 'mainapp.db_pool' if DB_POOL else 'django.db.backends.postgresql_psycopg2',
         'NAME': 'shop_db',
         'USER': 'shopuser',
         'PASSWORD': 'devpass',
         #'HOST': '127.0.0.1',
         'HOST': 'db',
-        'PORT': 5432
+        'PORT': 5432,
+        'CONN_MAX_AGE': 0,
+        'POOL': {
+            # соединений на процесс: одновременные запросы и потоки ASYNC_VIEWS_DB_WORKERS;
+            # при нехватке запрос ждет свободное соединение до TIMEOUT секунд
+            'MAX_SIZE': int(os.environ.get('SHOP_DB_POOL_SIZE', 20)),
+            'TIMEOUT': 10,
+            # соединение закрывается через MAX_AGE секунд после открытия (None - без ограничения)
+            'MAX_AGE': int(os.environ.get('SHOP_DB_POOL_MAX_AGE', 30 * 60)),
+            # простаивавшее дольше CHECK_INTERVAL секунд соединение перед выдачей проверяется SELECT 1
+            'CHECK_INTERVAL': 30,
+            # состояние сеанса (SET, временные таблицы, advisory-блокировки) сбрасывается при возврате в пул
+            'RESET': 'DISCARD ALL',
+        },
     }
 }
 
@@ -148,8 +169,55 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
-logging_file = 'app.log'
-logging_level = 'INFO'
+# миниатюры товаров строятся в пуле процессов после сохранения (False - сразу при сохранении)
+THUMBNAIL_BACKGROUND = True
+THUMBNAIL_WORKERS = 2
+
+# кэш данных, страниц и фрагментов шаблонов; версии страниц хранятся в нем же,
+# поэтому при нескольких процессах сервера нужен общий кэш (например, FileBasedCache)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    }
+}
+PAGE_CACHE_TIMEOUT = 10 * 60
+
+# асинхронные страницы каталога (mainapp.views.Async*): включаются в shop/asgi.py,
+# под WSGI остаются синхронные
+ASYNC_VIEWS = os.environ.get('SHOP_ASYNC_VIEWS') == '1'
+# потоков (и соединений с БД) для запросов асинхронных страниц
+ASYNC_VIEWS_DB_WORKERS = 20
+
+# токен для сбора /metrics без входа сотрудника (заголовок Authorization: Bearer <токен>)
+METRICS_TOKEN = os.environ.get('SHOP_METRICS_TOKEN')
+
+# журнал в JSON через очередь (mainapp.log): файл с ротацией пишет отдельный поток.
+# SHOP_LOG_FILE - путь ({pid} - отдельный файл на рабочий процесс) или "-" для stderr
+LOG_FILE = os.environ.get('SHOP_LOG_FILE', 'app.log')
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'mainapp.log.JsonFormatter'},
+    },
+    'filters': {
+        'request_id': {'()': 'mainapp.log.RequestIdFilter'},
+        # изменения корзины - самые частые записи: в журнал попадает каждый десятый запрос
+        'sampling': {'()': 'mainapp.log.SamplingFilter', 'rates': {'mainapp.views.cart': 0.1}},
+    },
+    'handlers': {
+        'background': {
+            '()': 'mainapp.log.BackgroundHandler',
+            'filename': None if LOG_FILE == '-' else LOG_FILE,
+            'max_bytes': 10 * 1024 * 1024,
+            'backup_count': 5,
+            'formatter': 'json',
+            'filters': ['request_id', 'sampling'],
+        },
+    },
+    'root': {'handlers': ['background'], 'level': 'INFO'},
+}
 
 # для отправки письма
 EMAIL_HOST = 'smtp.gmail.com'
@@ -157,4 +225,9 @@ EMAIL_HOST_USER = 'shop1234django@gmail.com'
 EMAIL_HOST_PASSWORD = 's1h2o3p4'
 EMAIL_PORT = 587
 EMAIL_USE_TLS = True
+# письма отправляются через очередь (mainapp.outbox): после фиксации транзакции ее разбирает пул
+# EMAIL_OUTBOX_WORKERS потоков процесса; повторы после ошибок - команда send_outbox.
+# False - только send_outbox (отдельный процесс)
+EMAIL_OUTBOX_BACKGROUND = True
+EMAIL_OUTBOX_WORKERS = 1
 